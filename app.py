@@ -9,34 +9,68 @@ import uuid
 import subprocess as sp
 import traceback
 import time
+import logging
 import concurrent.futures
 
 # ===================
 # Imports (Third-Party)
 # ===================
-from flask import Flask, request, jsonify, send_from_directory, render_template_string
+from flask import Flask, request, jsonify, send_from_directory, render_template_string, g
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
 from flask_cors import CORS
-import boto3
-from botocore.exceptions import ClientError
 
 # ===================
 # Imports (Local)
 # ===================
 from llm_providers import (
     generate_code_openai, generate_explanation_openai,
-    generate_rewrite_openai
+    generate_rewrite_openai, generate_edit_openai, coalesce_stats,
+    generate_code_candidates_openai
 )
-from parallel import generate_explanation_async
+from parallel import (
+    submit_explanation, start_explanation, finish_explanation, cancel_explanation, explain_with_store,
+    build_explanation_prompt
+)
+from explanation_store import ExplanationStore, code_hash
+import tracing
+import ledger
+import warmup
+import deadline
+import executors
+import profiling
+import fake_llm
+from artifact_optimizer import optimize_artifacts
+from artifact_serving import serve_artifact, serve_artifact_bytes
+from workspace import WorkspaceManager
+from storage import create_storage
+from pipeline import (
+    GENERATE_INSTRUCTION_FILES, QUOTA_ERROR_MESSAGE, validate_generate_request,
+    read_rewrite_instructions, is_quota_error, non_code_response_message, sanitize_code,
+    save_inputs, collect_output_base_names,
+    save_explanation, list_upload_files, build_generate_response,
+    EDIT_INSTRUCTIONS_FILE, JOB_ID_RE, render_diagram, render_failure_payload,
+    read_explanation_mode, RENDER_TIMEOUT, NO_EXPLANATION_PLACEHOLDER
+)
+from layout import validate_layout, read_layout_report, add_layout_timings
+from graph_explanation import explain_graph
+from diagram_edit import EditError, parse_edit_blocks, apply_edit_blocks, is_cosmetic_change
+from diagrams_whitelist import is_code_whitelisted
+from node_catalog import catalog_prompt, unknown_node_message
+from candidates import (
+    read_candidates, prepare_candidates, render_first_success, reported_failure, common_code,
+    candidate_failure_payload, discard_candidates, candidate_summary,
+    CANDIDATE_MAX_TOKENS, CANDIDATE_TEMPERATURE
+)
+from idempotency import (
+    IdempotencyStore, IDEMPOTENCY_HEADER, REPLAYED_HEADER, LEAD, ATTACH, REPLAY,
+    validate_key, fingerprint, wait_attached
+)
+from decompose import read_decompose_mode, should_decompose, generate_decomposed, DecompositionError
 
 # ===================
 # Global Variables & Constants
 # ===================
-S3_BUCKET = os.environ.get('S3_BUCKET')
-if not S3_BUCKET:
-    raise RuntimeError("S3_BUCKET environment variable is not set")
-s3_client = boto3.client("s3")
-
 # Define global UPLOAD_FOLDER - use /tmp for Lambda
 # Check if running in Lambda environment
 IS_LAMBDA = os.environ.get('AWS_LAMBDA_FUNCTION_NAME') is not None
@@ -58,43 +92,58 @@ def get_lambda_safe_path(path):
     else:
         return path
 
+# Per-request workspaces live under the diagrams folder. Warm Lambda containers keep
+# /tmp between invocations, so the manager enforces a byte quota and sweeps old ones.
+workspace = WorkspaceManager(get_lambda_safe_path('diagrams'))
+workspace.start_sweeper()
+
+# Artifact storage backend (s3, local or memory), selected by STORAGE_BACKEND.
+# S3_BUCKET is only required for the s3 backend.
+storage = create_storage(local_root=get_lambda_safe_path('artifacts'))
+
+# Per-request token and latency ledger (JSONL, rotated by size, optionally shipped to storage)
+request_ledger = ledger.Ledger(
+    os.environ.get('LEDGER_DIR') or get_lambda_safe_path('ledger'),
+    storage=storage if ledger.LEDGER_SHIP else None
+)
+
+# Idempotency-Key claims and stored responses for /generate retries
+idempotency_store = IdempotencyStore(storage)
+# LLM explanations by normalized code, shared by /generate, edits and /explain
+explanation_store = ExplanationStore(storage)
+
+# Most programs one batch /explain request may carry
+EXPLAIN_BATCH_MAX = int(os.environ.get('EXPLAIN_BATCH_MAX', '20'))
+NO_NODES_MESSAGE = 'Could not find any diagram nodes to explain in the code.'
+
+# Bearer token for /admin endpoints; they are disabled when unset
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+# Prime Graphviz, fonts, provider imports and connections off the request path.
+# On Lambda the handler module warms synchronously during init instead.
+if warmup.WARMUP_ON_START and not IS_LAMBDA:
+    warmup.start_background(workspace, storage)
 
 
 # ===================
 # Flask App Setup
 # ===================
+CORS_ORIGINS = ["http://localhost:5173", "http://localhost:3000"]
+
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
-CORS(app, origins=["http://localhost:5173", "http://localhost:3000"])
+CORS(app, origins=CORS_ORIGINS)
 
 # ===================
 # Utility Functions
 # ===================
-def fix_svg_inplace(svg_path):
-    try:
-        # Instead of spawning a Python process, directly perform the necessary fix
-        # This avoids process creation overhead
-        with open(svg_path, 'r') as f:
-            content = f.read()
-            
-        # Apply icon fixes (simplified version of what fix_svg_icons.py would do)
-        # This is a basic implementation - adjust based on what fix_svg_icons.py actually does
-        fixed_content = content
-        
-        # Common SVG fixes (example)
-        if "<svg " in content and "xmlns=" not in content:
-            fixed_content = content.replace("<svg ", '<svg xmlns="http://www.w3.org/2000/svg" ')
-            
-        # Write back only if changes were made
-        if fixed_content != content:
-            with open(svg_path, 'w') as f:
-                f.write(fixed_content)
-    except Exception as e:
-        print(f"Error fixing SVG file: {str(e)}")
-
 # New endpoint: Explain diagram code
 @app.route('/explain', methods=['POST'])
 def explain_diagram():
     data = request.json
+    if isinstance(data, dict) and 'items' in data:
+        return explain_batch(data)
     code = data.get('code')
     if not code or not isinstance(code, str):
         return error_response('Valid Python code is required for explanation.', 400)
@@ -102,80 +151,246 @@ def explain_diagram():
     # Get provider from request if provided
     provider = data.get('provider') if data else None
     provider = provider.strip().lower() if provider else None
+
+    # Graph mode answers from the parsed diagram without calling the LLM
+    explanation_mode, error = read_explanation_mode(data)
+    if error:
+        return error_response(*error)
+    if explanation_mode == 'graph':
+        explanation = explain_graph(code, provider)
+        if explanation is None:
+            return error_response(NO_NODES_MESSAGE, 422)
+        return jsonify({'explanation': explanation, 'explanation_source': 'graph'})
     
-    # Original prompt to be used if no provider or rewriting fails
-    original_prompt = (
-        "Given the following diagrams Python code, provide a short, detailed, bullet-point explanation "
-        "of the flow and architecture. Be concise but clear. Do not exceed 8 bullet points.\n\n"
-        "Code:\n"
-        f"{code}"
-    )
-    
-    prompt = original_prompt
-    
-    # If provider is specified, rewrite the explanation prompt
-    if provider and provider in ['aws', 'azure', 'gcp']:
-        try:
-            # Map providers to rewrite instruction files
-            rewrite_provider_map = {
-                'aws': 'instructions/rewrite/instructions_aws_rewrite.md',
-                'azure': 'instructions/rewrite/instructions_azure_rewrite.md',
-                'gcp': 'instructions/rewrite/instructions_gcp_rewrite.md'
-            }
-            
-            rewrite_instructions_file = rewrite_provider_map.get(provider)
-            
-            # Verify the rewrite instructions file exists
-            if rewrite_instructions_file and os.path.exists(rewrite_instructions_file):
-                # Read the rewrite instructions
-                with open(rewrite_instructions_file, 'r') as f:
-                    rewrite_instructions = f.read()
-                
-                # Craft a provider-specific explanation prompt
-                rewrite_prompt = (
-                    f"I need to explain this {provider.upper()} architecture diagram code in the correct terminology. "
-                    f"Please provide a bullet-point explanation using proper {provider.upper()} terminology for this code:\n\n{code}"
-                )
-                
-                # Rewrite the prompt using OpenAI
-                rewritten_prompt = generate_rewrite_openai(rewrite_prompt, rewrite_instructions)
-                
-                # Use the rewritten prompt if successful
-                if rewritten_prompt:
-                    prompt = rewritten_prompt
-        except Exception as e:
-            # If rewriting fails, continue with the original prompt
-            print(f"Warning: Explanation prompt rewriting failed: {str(e)}. Continuing with original prompt.")
-    
+    # Explanations produced by /generate, edits or earlier calls are reused (see explanation_store.py)
     try:
-        explanation = generate_explanation_openai(prompt)
-        response = {
-            'explanation': explanation
-        }
-        
-        # Include original and rewritten prompts if a rewrite was performed
-        if prompt != original_prompt:
-            response['original_prompt'] = original_prompt
-            response['rewritten_prompt'] = prompt
-            response['provider'] = provider
-            
-        return jsonify(response)
+        explanation, source, prompt = explain_with_store(code, provider, explanation_store)
     except Exception as e:
         return error_response(f'Failed to generate explanation: {str(e)}', 500)
+    response = {
+        'explanation': explanation,
+        'explanation_source': source
+    }
+
+    # Include original and rewritten prompts if a rewrite was performed
+    original_prompt = build_explanation_prompt(code)
+    if prompt is not None and prompt != original_prompt:
+        response['original_prompt'] = original_prompt
+        response['rewritten_prompt'] = prompt
+        response['provider'] = provider
+
+    return jsonify(response)
+
+
+def explain_batch(data):
+    """Explain every item of {"items": [{"code", "provider"}, ...]}. Identical programs (same normalized
+    code and provider) are explained once; stored explanations are reused and the rest run concurrently."""
+    items = data.get('items')
+    if not isinstance(items, list) or not items or len(items) > EXPLAIN_BATCH_MAX:
+        return error_response(f'items must be a list of 1 to {EXPLAIN_BATCH_MAX} objects with code.', 400)
+    explanation_mode, error = read_explanation_mode(data)
+    if error:
+        return error_response(*error)
+    default_provider = data.get('provider')
+
+    keys = []  # (code hash, provider) per item, None for unusable items
+    unique = {}
+    for item in items:
+        code = item.get('code') if isinstance(item, dict) else None
+        if not code or not isinstance(code, str):
+            keys.append(None)
+            continue
+        provider = item.get('provider') or default_provider
+        provider = provider.strip().lower() if isinstance(provider, str) and provider.strip() else None
+        key = (code_hash(code), provider)
+        keys.append(key)
+        unique.setdefault(key, code)
+
+    results = {}
+    if explanation_mode == 'graph':
+        for (digest, provider), code in unique.items():
+            results[(digest, provider)] = (explain_graph(code, provider), 'graph')
+    else:
+        futures = {
+            key: executors.llm.submit_or_run(tracing.bind(explain_with_store), code, key[1], explanation_store, key[0])
+            for key, code in unique.items()
+        }
+        try:
+            for key, future in futures.items():
+                try:
+                    results[key] = future.result(timeout=deadline.bound(None, reserve=deadline.DEADLINE_RESERVE))[:2]
+                except concurrent.futures.TimeoutError:
+                    break
+                except Exception as e:
+                    print(f"Error generating explanation: {str(e)}")
+                    results[key] = (None, 'llm')
+        finally:
+            for future in futures.values():
+                future.cancel()
+
+    explanations = []
+    for key in keys:
+        if key is None:
+            explanations.append({'error': 'Valid Python code is required for explanation.'})
+            continue
+        explanation, source = results.get(key, (None, None))
+        if source is None:
+            explanations.append({'code_hash': key[0], 'error': deadline.DEADLINE_MESSAGE})
+        elif not explanation:
+            message = NO_NODES_MESSAGE if source == 'graph' else 'Failed to generate explanation.'
+            explanations.append({'code_hash': key[0], 'error': message})
+        else:
+            explanations.append({'code_hash': key[0], 'explanation': explanation, 'explanation_source': source})
+    ledger.annotate(explain_batch={
+        'items': len(items), 'unique': len(unique),
+        'stored': sum(1 for _, source in results.values() if source == 'stored'),
+    })
+    return jsonify({'explanations': explanations, 'unique': len(unique)})
 
 
 @app.route('/health', methods=['GET'])
 def health():
     print(f"/health route hit. request.path: {request.path}, request.url: {request.url}")
-    return jsonify({"status": "OK", "path": request.path, "url": request.url}), 200
+    return jsonify({
+        "status": "OK",
+        "path": request.path,
+        "url": request.url,
+        "workspace": workspace.usage(),
+        "llm": coalesce_stats(),
+        "executors": executors.stats(),
+        "warmup": warmup.last_report
+    }), 200
+
+@app.route('/warmup', methods=['POST'])
+def warmup_process():
+    """Render a tiny diagram per provider and open pooled connections; reports each step's time"""
+    if not ADMIN_TOKEN or request.headers.get('Authorization') != f'Bearer {ADMIN_TOKEN}':
+        return error_response('Unauthorized', 401)
+    providers, error = warmup.read_providers(request.get_json(silent=True))
+    if error:
+        return error_response(*error)
+    report = warmup.run(workspace, storage, providers=providers)
+    if report is None:
+        return error_response('Warm-up already running', 409, last_report=warmup.last_report)
+    return jsonify(report)
+
+@app.route('/admin/ledger', methods=['GET'])
+def ledger_summary():
+    """Totals and percentiles of ledger records over the last `window` seconds (default 1 hour)"""
+    if not ADMIN_TOKEN or request.headers.get('Authorization') != f'Bearer {ADMIN_TOKEN}':
+        return error_response('Unauthorized', 401)
+    try:
+        window = float(request.args.get('window', 3600))
+    except ValueError:
+        return error_response('window must be a number of seconds.', 400)
+    since = time.time() - window
+    records = request_ledger.read(since=since)
+    provider = request.args.get('provider')
+    if provider:
+        records = (r for r in records if r.get('provider') == provider)
+    summary = ledger.summarize(records)
+    summary.update({'window': window, 'since': since})
+    return jsonify(summary)
+
+# --- Per-request tracing: root span per request, trace id propagated from headers ---
+@app.before_request
+def start_request_trace():
+    g.trace = tracing.start_root_span(
+        'http.request', request.headers,
+        **{'http.method': request.method, 'http.route': request.path,
+           'http.request_bytes': request.content_length or 0}
+    )
+
+# --- Ledger: one record per POST request (LLM usage, stage timings, outcome) ---
+@app.before_request
+def start_ledger_record():
+    if request.method == 'POST':
+        route = request.url_rule.rule if request.url_rule else request.path
+        g.ledger_token = ledger.start_record(tracing.current_trace_id(), route)
+
+# --- Deadline: earliest of the Lambda invocation's remaining time, X-Request-Timeout and REQUEST_TIMEOUT ---
+@app.before_request
+def start_request_deadline():
+    g.deadline_token = deadline.start(deadline.parse_header(request.headers.get(deadline.DEADLINE_HEADER)))
+
+# --- Load tests: canned LLM responses when the server runs with FAKE_LLM=1 (see fake_llm.py) ---
+@app.before_request
+def start_fake_llm():
+    if fake_llm.FAKE_LLM and request.method == 'POST':
+        g.fake_llm_token = fake_llm.activate(request.get_json(silent=True))
+
+@app.teardown_request
+def finish_fake_llm(exc):
+    token = g.pop('fake_llm_token', None)
+    if token is not None:
+        fake_llm.deactivate(token)
+
+# --- Profiling: opt-in per request (X-Profile header or PROFILE_SAMPLE_RATE), see profiling.py ---
+@app.before_request
+def start_request_profile():
+    if request.method == 'POST' and profiling.should_profile(request.headers.get(profiling.PROFILE_HEADER)):
+        g.profile_token = profiling.start()
+
+@app.after_request
+def store_request_profile(response):
+    token = g.pop('profile_token', None)
+    if token is None:
+        return response
+    payload = response.get_json(silent=True) if response.is_json else None
+    folder = None
+    if isinstance(payload, dict) and response.status_code == 200:
+        folder = (payload.get('uploaded_files') or {}).get('s3_folder')
+    urls = profiling.finish(token, storage, folder, tracing.current_trace_id())
+    ledger.annotate(profiled=urls is not None)
+    if urls is not None and isinstance(payload, dict):
+        payload['profile'] = urls
+        response.set_data(json.dumps(payload))
+    return response
+
+@app.after_request
+def add_trace_header(response):
+    trace = g.get('trace')
+    if trace:
+        trace[0].set_attribute('http.status_code', response.status_code)
+        response.headers['X-Trace-Id'] = trace[0].trace_id
+    g.status_code = response.status_code
+    return response
+
+@app.teardown_request
+def end_request_trace(exc):
+    trace = g.pop('trace', None)
+    if trace:
+        tracing.end_root_span(*trace, error=exc)
+
+@app.teardown_request
+def finish_ledger_record(exc):
+    token = g.pop('ledger_token', None)
+    if token is not None:
+        ledger.finish_record(token, request_ledger, g.get('status_code', 500), error=exc)
+
+@app.teardown_request
+def finish_request_deadline(exc):
+    # Explanation threads and LLM calls still running for this request stop at their next check
+    token = g.pop('deadline_token', None)
+    if token is not None:
+        deadline.finish(token)
+
+@app.teardown_request
+def release_workspaces(exc):
+    # Runs for every exit path of a request, including errors and early returns
+    for path in g.pop('workspaces', []):
+        try:
+            workspace.release(path)
+        except Exception as e:
+            print(f"Failed to release workspace {path}: {str(e)}")
 
 # Improved catch-all route for all paths, including root
 @app.route('/', defaults={'path': ''}, methods=['GET', 'POST', 'PUT', 'DELETE', 'PATCH', 'OPTIONS'])
 @app.route('/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE', 'PATCH', 'OPTIONS'])
 def catch_all(path):
     print(f"catch_all route hit. path: {path}, request.path: {request.path}, method: {request.method}")
-    print(f"request.headers: {dict(request.headers)}")
-    print(f"request.data: {request.data}")
+    # Full dumps are expensive on large bodies: only when DEBUG is enabled, and sampled
+    tracing.log_sampled(logger, lambda: f"request.headers: {dict(request.headers)} request.data: {request.data!r}")
     
     # Special handling for root path
     if path == '' and request.method == 'GET':
@@ -195,9 +410,8 @@ def index():
     # Check if this is an API Gateway proxy integration
     if request.headers.get('x-forwarded-proto') or request.headers.get('x-api-gateway-event'):
         print("Detected API Gateway proxy integration")
-        # Log all headers for debugging
-        for header, value in request.headers.items():
-            print(f"Header: {header}: {value}")
+        # Log all headers for debugging (DEBUG level, sampled)
+        tracing.log_sampled(logger, lambda: f"Headers: {dict(request.headers)}")
     
     return 'Diagram AI API is running. Please use the /generate endpoint with POST requests.', 200
 
@@ -212,100 +426,114 @@ def error_response(message, status=400, **kwargs):
 @app.route('/diagrams/<path:filename>')
 def serve_diagram_file(filename):
     try:
-        # Use our helper function to determine the base diagrams folder
-        file_path = get_lambda_safe_path(os.path.join('diagrams', filename))
-        
+        # Use our helper function to determine the base diagrams folder;
+        # safe_join rejects paths that would escape it
+        file_path = safe_join(get_lambda_safe_path('diagrams'), filename)
+
         # Check if file exists in the specified path
-        if not os.path.isfile(file_path):
+        if not file_path or not os.path.isfile(file_path):
             # File not found
             return error_response(f'Diagram file not found: {filename}', 404)
-        
-        # Lambda can't serve files from /tmp directly through send_from_directory
-        # In Lambda, serve files by reading and returning content
-        if IS_LAMBDA:
-            try:
-                with open(file_path, 'rb') as f:
-                    content = f.read()
-                
-                # Set content type based on file extension
-                content_type = 'image/png'  # Default
-                if filename.endswith('.svg'):
-                    content_type = 'image/svg+xml'
-                elif filename.endswith('.pdf'):
-                    content_type = 'application/pdf'
-                elif filename.endswith('.dot'):
-                    content_type = 'text/plain'
-                elif filename.endswith('.py'):
-                    content_type = 'text/plain'
-                elif filename.endswith('.md'):
-                    content_type = 'text/markdown'
-                
-                return content, 200, {'Content-Type': content_type}
-            except Exception as e:
-                return error_response(f'Failed to read diagram file: {str(e)}', 500)
-        else:
-            # For local development, use send_from_directory
-            base_dir = 'diagrams'  # In non-Lambda, it's just the regular diagrams directory
-            return send_from_directory(base_dir, filename)
+
+        workspace.touch(file_path)
+
+        # Same path for Lambda and local: content-hash ETags, conditional GETs,
+        # Range requests, gzip/brotli for text formats, LRU for small files and
+        # chunked streaming for large ones
+        return serve_artifact(file_path)
     except Exception as e:
         # Logging removed
         return error_response(f'Failed to serve diagram file: {filename}', 500)
 
 
 
+# Artifacts stored by the local and memory backends (S3 artifacts use presigned URLs)
+@app.route('/artifacts/<path:key>')
+def serve_stored_artifact(key):
+    # Only job folders are public; ledger/, idempotency/, profiles/ and explanations/ records are not
+    if not JOB_ID_RE.match(key.split('/', 1)[0]):
+        return error_response(f'Artifact not found: {key}', 404)
+    local_path = storage.local_path(key)
+    if local_path:
+        if not os.path.isfile(local_path):
+            return error_response(f'Artifact not found: {key}', 404)
+        # Small files come from the in-memory LRU; larger ones are streamed from disk
+        # (wsgi.file_wrapper, which servers such as gunicorn turn into sendfile())
+        return serve_artifact(local_path)
+    if storage.name != 'memory':
+        return error_response(f'Artifact not found: {key}', 404)
+    data = storage.get_bytes(key)
+    if data is None:
+        return error_response(f'Artifact not found: {key}', 404)
+    return serve_artifact_bytes(key, data)
+
 from llm_providers import generate_code_openai, generate_explanation_openai
 
 @app.route('/generate', methods=['POST'])
-
 def generate_diagram():
-    print("request.data:", request.data)
-    print("request.json:", request.json)
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    if key is None:
+        return _generate_diagram()
+    error = validate_key(key)
+    if error:
+        return error_response(*error)
+
+    # A retry with the same key attaches to the running execution or replays its stored response
+    body_fingerprint = fingerprint(request.get_json(silent=True))
+    outcome, value = idempotency_store.begin('/generate', key, body_fingerprint)
+    ledger.annotate(idempotency=outcome)
+    if outcome == LEAD:
+        payload, status = {'error': 'Internal server error'}, 500
+        try:
+            response = app.make_response(_generate_diagram())
+            payload, status = response.get_json(), response.status_code
+            return response
+        finally:
+            folder = (payload.get('uploaded_files') or {}).get('s3_folder') if status == 200 else None
+            idempotency_store.finish('/generate', key, body_fingerprint, payload, status, folder)
+    payload, status = wait_attached(value) if outcome == ATTACH else value
+    response = app.make_response((jsonify(payload), status))
+    if outcome in (ATTACH, REPLAY):
+        response.headers[REPLAYED_HEADER] = 'true'
+    return response
+
+def _generate_diagram():
+    tracing.log_sampled(logger, lambda: f"request.data: {request.data!r}")
     timings = {}
     start_total = time.time()
 
-    # LLM code generation
-    start = time.time()
     # Predefine code URLs for error handling
     raw_code_url = '/diagrams/generated_diagram_raw.py'
     sanitized_code_url = '/diagrams/generated_diagram.py'
-    import re, subprocess, traceback, resource
-    from diagrams_whitelist import is_code_whitelisted
 
     data = request.json
-    description = data.get('description') if data else None
-    if not isinstance(description, str) or not description.strip():
-        return error_response('Description must be a non-empty string.', 400)
-    if len(description) > 15000:
-        return error_response('Description is too long (max 15000 chars).', 400)
-
-
-    provider = data.get('provider') if data else None
-    provider = provider.strip().lower() if provider else None
-    if not provider:
-        return error_response('No cloud provider specified. Please set provider to aws, azure, or gcp.', 400)
+    description, provider, error = validate_generate_request(data)
+    if error:
+        return error_response(*error)
+    explanation_mode, error = read_explanation_mode(data)
+    if error:
+        return error_response(*error)
+    layout, error = validate_layout(data.get('layout'))
+    if error:
+        return error_response(*error)
+    candidate_count, error = read_candidates(data)
+    if error:
+        return error_response(*error)
+    decompose_mode, error = read_decompose_mode(data)
+    if error:
+        return error_response(*error)
+    ledger.annotate(provider=provider, timings=timings)
 
     # First, run the description through the rewrite endpoint
     original_description = description
     rewritten_description = None
     try:
-        # Map providers to rewrite instruction files
-        rewrite_provider_map = {
-            'aws': 'instructions/rewrite/instructions_aws_rewrite.md',
-            'azure': 'instructions/rewrite/instructions_azure_rewrite.md',
-            'gcp': 'instructions/rewrite/instructions_gcp_rewrite.md'
-        }
-        
-        rewrite_instructions_file = rewrite_provider_map.get(provider)
-        
-        # Verify the rewrite instructions file exists
-        if rewrite_instructions_file and os.path.exists(rewrite_instructions_file):
-            # Read the rewrite instructions
-            with open(rewrite_instructions_file, 'r') as f:
-                rewrite_instructions = f.read()
-                
+        rewrite_instructions = read_rewrite_instructions(provider)
+        if rewrite_instructions:
             # Rewrite the description using OpenAI
-            rewritten_description = generate_rewrite_openai(description, rewrite_instructions)
-                
+            with tracing.span('rewrite', provider=provider, input_bytes=len(description)):
+                rewritten_description = generate_rewrite_openai(description, rewrite_instructions)
+
             # Use the rewritten description instead of the original
             description = rewritten_description
     except Exception as e:
@@ -313,14 +541,8 @@ def generate_diagram():
         print(f"Warning: Description rewriting failed: {str(e)}. Continuing with original description.")
         rewritten_description = None
 
-    # Map providers to instruction files in the /instructions/generate directory
-    provider_map = {
-        'aws': 'instructions/generate/instructions_aws_simplified.md',
-        'azure': 'instructions/generate/instructions_azure_simplified.md',
-        'gcp': 'instructions/generate/instructions_gcp_simplified.md'
-    }
-    provider_prefix = provider if provider in provider_map else 'unknown'
-    instructions_file = provider_map.get(provider)
+    provider_prefix = provider if provider in GENERATE_INSTRUCTION_FILES else 'unknown'
+    instructions_file = GENERATE_INSTRUCTION_FILES.get(provider)
     if not instructions_file:
         return error_response('Invalid provider. Please use aws, azure, or gcp.', 400)
 
@@ -334,352 +556,462 @@ def generate_diagram():
             instructions = f.read()
     except Exception as e:
         return error_response(f'Failed to read {instructions_file}: {e}', 500)
-
+    # Exact class names of the modules this description needs (see node_catalog.py)
+    instructions += catalog_prompt(provider, description)
 
     # Generate code with OpenAI
     start_llm = time.time()
+    decomposition = None
     try:
         # Generate code using OpenAI
-        code = generate_code_openai(description, instructions)
+        with tracing.span('codegen', provider=provider, prompt_bytes=len(instructions) + len(description),
+                          candidates=candidate_count):
+            codes = None
+            # Large descriptions: subsystems are generated in parallel and merged (see decompose.py)
+            if should_decompose(decompose_mode, description):
+                try:
+                    code, decomposition = generate_decomposed(description, instructions)
+                    codes = [code]
+                except DecompositionError as e:
+                    print(f"Warning: Decomposition failed: {str(e)}. Generating the whole description at once.")
+            if codes is None and candidate_count > 1:
+                codes = generate_code_candidates_openai(
+                    description, instructions, candidate_count, CANDIDATE_MAX_TOKENS, CANDIDATE_TEMPERATURE
+                )
+            elif codes is None:
+                codes = [generate_code_openai(description, instructions)]
+            code = codes[0]
+            tracing.set_attribute('code_bytes', len(code))
     except Exception as e:
         tb = traceback.format_exc()
-        if ((hasattr(e, 'status_code') and e.status_code == 429) or 'quota' in str(e).lower() or 'rate limit' in str(e).lower()):
-            return error_response(
-                'OpenAI API quota exceeded. Please check your plan and billing at https://platform.openai.com/account/usage',
-                429,
-                raw_code_url=None,
-                sanitized_code_url=None
-            )
+        if is_quota_error(e):
+            return error_response(QUOTA_ERROR_MESSAGE, 429, raw_code_url=None, sanitized_code_url=None)
+        if deadline.is_exceeded(e):
+            return error_response(deadline.DEADLINE_MESSAGE, 504)
         return error_response(f'OpenAI API error: {str(e)}', 500, traceback=tb)
     timings['llm'] = time.time() - start_llm
+    if decomposition is not None:
+        ledger.annotate(decomposition=decomposition)
 
-    # Check for non-code or fallback LLM responses
-    if code.strip().lower().startswith("sorry") or not ("import" in code or "with Diagram" in code):
-        user_msg = code.strip().splitlines()[0] if code.strip() else "The model could not generate valid code for your request."
-        return error_response(f"The model could not generate valid code for your request: {user_msg}", 422)
+    candidates = None
+    winner = None
+    # The explanation starts as soon as the code it explains is known: with candidates, before the
+    # race if they are all the same program, else once a render wins
+    explanation_started = False
+    stored_explanation, explanation_future = None, None
+    start_explanation_time = None
+    if len(codes) > 1:
+        # --- Speculative candidates: render all of them, keep the first clean render ---
+        candidates = prepare_candidates(
+            workspace, provider_prefix, codes, original_description, rewritten_description
+        )
+        g.workspaces = g.get('workspaces', []) + [c.folder for c in candidates if c.folder]
+        if common_code(candidates) is not None:
+            # Every candidate renders the same program: explain it while they render
+            start_explanation_time = time.time()
+            stored_explanation, explanation_future = start_explanation(
+                common_code(candidates), provider, explanation_mode, explanation_store
+            )
+            explanation_started = True
+        start_exec = time.time()
+        try:
+            with tracing.span('render.candidates', candidates=len(candidates)):
+                winner = render_first_success(candidates, deadline.stage_timeout(RENDER_TIMEOUT), layout)
+                tracing.set_attribute('winner', winner.index if winner else None)
+        except Exception as e:
+            cancel_explanation(explanation_future, explanation_mode)
+            if deadline.is_exceeded(e):
+                return error_response(deadline.DEADLINE_MESSAGE, 504)
+            return error_response(f'Diagram execution error: {str(e)}', 500)
+        if winner is not None and not explanation_started:
+            # The winning code is known: start its explanation before cleaning up the other candidates
+            start_explanation_time = time.time()
+            stored_explanation, explanation_future = start_explanation(
+                winner.code, provider, explanation_mode, explanation_store
+            )
+            explanation_started = True
+        if winner is None:
+            cancel_explanation(explanation_future, explanation_mode)
+        for folder in discard_candidates(workspace, candidates, keep=winner or reported_failure(candidates)):
+            g.workspaces.remove(folder)
+        ledger.annotate(candidates=candidate_summary(candidates))
+        if winner is None and deadline.is_exceeded():
+            return error_response(deadline.DEADLINE_MESSAGE, 504, candidates=candidate_summary(candidates))
+        if winner is None:
+            payload, status = candidate_failure_payload(candidates, raw_code_url, sanitized_code_url)
+            return jsonify(payload), status
+        timings['diagram_execution'] = time.time() - start_exec
+        add_layout_timings(timings, read_layout_report(winner.folder))
+        temp_dir_name, temp_upload_folder, code = winner.name, winner.folder, winner.code
+    else:
+        # Check for non-code or fallback LLM responses
+        non_code_message = non_code_response_message(code)
+        if non_code_message:
+            return error_response(non_code_message, 422)
+
+        # --- Per-request workspace, prefixed by provider ---
+        # Released (deleted, or retained under the quota) by release_workspaces when the request ends
+        temp_dir_name, temp_upload_folder = workspace.allocate(provider_prefix)
+        g.workspaces = g.get('workspaces', []) + [temp_upload_folder]
+
+        # Save raw code
+        start_save_raw = time.time()
+        raw_code_path = os.path.join(temp_upload_folder, 'generated_diagram_raw.py')
+        try:
+            with open(raw_code_path, 'w') as f:
+                f.write(code)
+            # Logging removed
+        except Exception as e:
+            return error_response('Failed to save raw code', 500)
+        timings['save_raw_code'] = time.time() - start_save_raw
 
-    # --- Per-request temp directory, prefixed by provider ---
-    import tempfile, shutil
-    temp_uuid = str(uuid.uuid4())
-    temp_dir_name = f"{provider_prefix}-{temp_uuid}"
+        # Save original and rewritten descriptions
+        start_save_inputs = time.time()
+        try:
+            save_inputs(temp_upload_folder, original_description, rewritten_description)
+        except Exception as e:
+            print(f"Warning: Failed to save input descriptions: {str(e)}")
+            # Continue execution even if saving descriptions fails
+        timings['save_inputs'] = time.time() - start_save_inputs
+
+        # Sanitize code
+        code = sanitize_code(code)
+
+        # Save sanitized code before running it!
+        start_save_sanitized = time.time()
+        sanitized_code_path = os.path.join(temp_upload_folder, 'generated_diagram.py')
+        try:
+            with open(sanitized_code_path, 'w') as f:
+                f.write(code)
+            # Logging removed
+        except Exception as e:
+            return error_response('Failed to save sanitized code', 500)
+        timings['save_sanitized_code'] = time.time() - start_save_sanitized
+
+        # Classes that do not exist would only fail inside the render subprocess
+        unknown_message = unknown_node_message(code)
+        if unknown_message:
+            return error_response(unknown_message, 422)
+
+    # --- Start explanation generation in parallel with diagram execution ---
+    # With candidates it started as soon as the winning code was known
+    skipped = []
+    if not explanation_started:
+        start_explanation_time = time.time()
+        # An explanation stored for this code (by /explain or an earlier job) saves the LLM calls;
+        # otherwise it is submitted to run in parallel (none in graph mode)
+        stored_explanation, explanation_future = start_explanation(
+            code, provider, explanation_mode, explanation_store
+        )
+    try:
+        # Run diagram code (in the main thread). The render subprocess gets the workspace as
+        # its cwd, so this process never changes directory and concurrent requests are safe.
+        if winner is None:
+            start_exec = time.time()
+            try:
+                with tracing.span('render'):
+                    proc = render_diagram(temp_upload_folder, deadline.stage_timeout(RENDER_TIMEOUT), layout)
+                    tracing.set_attribute('returncode', proc.returncode)
+            except Exception as e:
+                if deadline.is_exceeded(e):
+                    return error_response(deadline.DEADLINE_MESSAGE, 504)
+                return error_response(f'Diagram execution error: {str(e)}', 500)
+            if proc.returncode != 0:
+                # Invalid code returns 422, a partially written image 206, anything else 500
+                payload, status = render_failure_payload(
+                    proc.stdout, proc.stderr, temp_upload_folder, code, raw_code_url, sanitized_code_url
+                )
+                return jsonify(payload), status
+
+            timings['diagram_execution'] = time.time() - start_exec
+            add_layout_timings(timings, read_layout_report(temp_upload_folder))
+        
+        # Now get the explanation result, waiting no longer than the deadline allows
+        if stored_explanation:
+            explanation, explanation_source = stored_explanation, 'stored'
+        else:
+            explanation, explanation_source = finish_explanation(
+                explanation_future, code, provider, explanation_mode,
+                timeout=deadline.bound(None, reserve=deadline.DEADLINE_RESERVE)
+            )
+        if explanation_mode == 'llm' and explanation_future is not None and not explanation_future.done():
+            skipped.append('llm_explanation')
+    finally:
+        # Error paths return from inside this block: don't start an explanation nobody reads
+        cancel_explanation(explanation_future, explanation_mode)
+    timings['explanation'] = time.time() - start_explanation_time
+
+    # Collect output files
+    base_names = collect_output_base_names(temp_upload_folder, code)
+
+    # Shrink rendered artifacts before they are uploaded and served (optional: skipped near the deadline)
+    start_optimize = time.time()
+    artifact_sizes = {}
+    if deadline.allows(deadline.OPTIONAL_STAGE_SECONDS):
+        artifact_sizes = optimize_artifacts(temp_upload_folder)
+        ledger.annotate(artifact_bytes=sum(size['after'] for size in artifact_sizes.values()))
+    else:
+        skipped.append('optimize_artifacts')
+    timings['optimize_artifacts'] = time.time() - start_optimize
+
+    # Save explanation as Markdown file
+    save_explanation(temp_upload_folder, explanation)
+
+    # --- Artifact upload (after all outputs and variables are defined) ---
+    start_upload = time.time()
+    s3_folder = temp_dir_name  # Use the same provider-prefixed folder name in storage
     
-    # Create a Lambda-safe path using our helper function
-    temp_upload_folder = get_lambda_safe_path(os.path.join('diagrams', temp_dir_name))
-    os.makedirs(temp_upload_folder, exist_ok=True)
+    # Use parallel upload function instead of sequential uploads
+    upload_files = list_upload_files(temp_upload_folder)
+    uploaded_files = parallel_upload(upload_files, s3_folder, timeout=deadline.bound(None))
+    skipped.extend(skipped_uploads(upload_files, uploaded_files))
+    uploaded_files['s3_folder'] = s3_folder
+    timings['upload'] = time.time() - start_upload
+
+    if base_names:
+        timings['total'] = time.time() - start_total
+        response_data = build_generate_response(
+            uploaded_files, base_names, explanation, artifact_sizes, explanation_source, timings
+        )
+        if candidates is not None:
+            response_data['candidates'] = candidate_summary(candidates)
+        if decomposition is not None:
+            response_data['decomposition'] = decomposition
+        if skipped:
+            # Partial result: optional stages that did not fit before the deadline
+            response_data['skipped'] = skipped
+            ledger.annotate(skipped=skipped)
+        return jsonify(response_data)
+
+    # Final fallback: should never be reached, but ensures a response is always sent
+    return error_response('Unknown server error', 500)
+
+# Incremental edit: patch an existing job's code instead of regenerating it
+@app.route('/generate/<job_id>/edit', methods=['POST'])
+def edit_diagram(job_id):
+    timings = {}
+    start_total = time.time()
+    raw_code_url = None
+    sanitized_code_url = None
+
+    if not JOB_ID_RE.match(job_id):
+        return error_response('Invalid diagram id.', 400)
+    data = request.get_json(silent=True) or {}
+    change_request = data.get('change')
+    if not isinstance(change_request, str) or not change_request.strip():
+        return error_response('change is required and must be a non-empty string.', 400)
+    if len(change_request) > 2000:
+        return error_response('change is too long (max 2000 chars).', 400)
+    provider = job_id.split('-', 1)[0]
+    explanation_mode, error = read_explanation_mode(data)
+    if error:
+        return error_response(*error)
+    layout, error = validate_layout(data.get('layout'))
+    if error:
+        return error_response(*error)
+    ledger.annotate(provider=provider, timings=timings, parent_id=job_id)
+
+    # Load the job's sanitized code from storage
+    stored_code = storage.get_bytes(f'{job_id}/generated_diagram.py')
+    if stored_code is None:
+        return error_response(f'Diagram not found: {job_id}', 404)
+    old_code = stored_code.decode()
 
-    # Save raw code
-    start_save_raw = time.time()
-    raw_code_path = os.path.join(temp_upload_folder, 'generated_diagram_raw.py')
     try:
-        with open(raw_code_path, 'w') as f:
-            f.write(code)
-        # Logging removed
+        with open(EDIT_INSTRUCTIONS_FILE, 'r') as f:
+            instructions = f.read()
     except Exception as e:
-        # No need to clean up as Lambda automatically cleans up /tmp
-        return error_response('Failed to save raw code', 500)
-    timings['save_raw_code'] = time.time() - start_save_raw
+        return error_response(f'Failed to read {EDIT_INSTRUCTIONS_FILE}: {e}', 500)
 
-    # Save original and rewritten descriptions
-    start_save_inputs = time.time()
+    # Ask the model for a patch, not a whole program
+    start_llm = time.time()
     try:
-        # Save the original user input
-        original_input_path = os.path.join(temp_upload_folder, 'original_input.txt')
-        with open(original_input_path, 'w') as f:
-            f.write(original_description or "")
-            
-        # Always save the rewritten description (use original if rewriting failed)
-        rewritten_input_path = os.path.join(temp_upload_folder, 'rewritten_input.txt')
-        with open(rewritten_input_path, 'w') as f:
-            f.write(rewritten_description or original_description or "")
+        with tracing.span('edit.patch', provider=provider, code_bytes=len(old_code)):
+            patch = generate_edit_openai(old_code, change_request, instructions)
     except Exception as e:
-        print(f"Warning: Failed to save input descriptions: {str(e)}")
-        # Continue execution even if saving descriptions fails
-    timings['save_inputs'] = time.time() - start_save_inputs
-
-    # Sanitize code
-    code = re.sub(r'filename\s*=\s*["\']([^"\']+)["\']', 'filename="generated_diagram"', code)
-    code = re.sub(r'outformat\s*=\s*["\']([^"\']+)["\']', 'outformat="png"', code)
-    # Always inject show=False into every with Diagram(...) statement
-    def _inject_show_false(match):
-        args = match.group(1)
-        if 'show=' in args:
-            # Replace any show=... with show=False
-            args = re.sub(r'show\s*=\s*\w+', 'show=False', args)
-        else:
-            if args.strip():
-                args = args.strip() + ', show=False'
-            else:
-                args = 'show=False'
-        return f'with Diagram({args})'
-    code = re.sub(r'with Diagram\(([^)]*)\)', _inject_show_false, code)
-
-    # Save sanitized code before running it!
-    start_save_sanitized = time.time()
-    sanitized_code_path = os.path.join(temp_upload_folder, 'generated_diagram.py')
+        tb = traceback.format_exc()
+        if is_quota_error(e):
+            return error_response(QUOTA_ERROR_MESSAGE, 429)
+        if deadline.is_exceeded(e):
+            return error_response(deadline.DEADLINE_MESSAGE, 504)
+        return error_response(f'OpenAI API error: {str(e)}', 500, traceback=tb)
+    timings['llm'] = time.time() - start_llm
+
+    # Apply and validate the patch locally
+    blocks = parse_edit_blocks(patch)
+    if not blocks:
+        user_msg = patch.strip().splitlines()[0] if patch.strip() else 'No edit returned.'
+        return error_response(f'The model could not edit the diagram: {user_msg}', 422)
+    try:
+        patched_code = apply_edit_blocks(old_code, blocks)
+    except EditError as e:
+        return error_response(f'Failed to apply the edit: {str(e)}', 422, patch=patch)
+    code = sanitize_code(patched_code)
+    try:
+        compile(code, 'generated_diagram.py', 'exec')
+    except SyntaxError as e:
+        return error_response(f'Edited code is not valid Python: {str(e)}', 422, patch=patch)
+    allowed, bad_line = is_code_whitelisted(code)
+    if not allowed:
+        return error_response(f'Edited code uses an import that is not allowed: {bad_line}', 422, patch=patch)
+    unknown_message = unknown_node_message(code)
+    if unknown_message:
+        return error_response(unknown_message, 422, patch=patch)
+
+    # Cosmetic edits (labels, titles, colours) keep the previous LLM explanation
+    cosmetic = is_cosmetic_change(old_code, code)
+    explanation = None
+    explanation_source = None
+    if cosmetic:
+        stored_explanation = storage.get_bytes(f'{job_id}/generated_diagram.md')
+        stored_explanation = stored_explanation.decode().strip() if stored_explanation else None
+        # The parent may only have the placeholder written when it had no explanation, and a
+        # graph explanation names the old labels; it is rebuilt from the new code below instead
+        if (stored_explanation and stored_explanation != NO_EXPLANATION_PLACEHOLDER
+                and stored_explanation != (explain_graph(old_code, provider) or '').strip()):
+            explanation, explanation_source = stored_explanation, 'stored'
+
+    temp_dir_name, temp_upload_folder = workspace.allocate(provider)
+    g.workspaces = g.get('workspaces', []) + [temp_upload_folder]
     try:
-        with open(sanitized_code_path, 'w') as f:
+        with open(os.path.join(temp_upload_folder, 'generated_diagram_raw.py'), 'w') as f:
+            f.write(patched_code)
+        with open(os.path.join(temp_upload_folder, 'generated_diagram.py'), 'w') as f:
             f.write(code)
-        # Logging removed
+        with open(os.path.join(temp_upload_folder, 'edit_request.txt'), 'w') as f:
+            f.write(f"parent: {job_id}\n\n{change_request}")
+        with open(os.path.join(temp_upload_folder, 'edit_patch.txt'), 'w') as f:
+            f.write(patch)
     except Exception as e:
-        # No need to clean up as Lambda automatically cleans up /tmp
-        return error_response('Failed to save sanitized code', 500)
-    timings['save_sanitized_code'] = time.time() - start_save_sanitized
+        return error_response('Failed to save edited code', 500)
 
-    # --- Start explanation generation in parallel with diagram execution ---
-    start_explanation = time.time()
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        # Submit the explanation generation task to run in parallel
-        explanation_future = executor.submit(generate_explanation_async, code, provider)
-        
-        # Run diagram code (in the main thread)
+    # Reuse the parent job's stored inputs
+    for name in ('original_input.txt', 'rewritten_input.txt'):
+        content = storage.get_bytes(f'{job_id}/{name}')
+        if content is not None:
+            with open(os.path.join(temp_upload_folder, name), 'wb') as f:
+                f.write(content)
+
+    start_explanation_time = time.time()
+    if explanation is None and explanation_mode != 'graph':
+        explanation = explanation_store.get(code, provider)
+        explanation_source = 'stored' if explanation else None
+    explanation_future = None
+    if explanation is None:
+        explanation_future = submit_explanation(code, provider, explanation_mode, explanation_store)
+    try:
         start_exec = time.time()
-        cwd = os.getcwd()
         try:
-            os.chdir(temp_upload_folder)
-            proc = subprocess.run(
-                ['python3', 'generated_diagram.py'],
-                capture_output=True,
-                text=True,
-                timeout=60
-            )
-            if proc.returncode != 0:
-                # If it's a SyntaxError or the code is not valid Python, return 422
-                if 'SyntaxError' in proc.stderr or 'invalid syntax' in proc.stderr:
-                    response_data = {
-                        'error': 'Diagram code execution failed due to invalid or non-Python code.',
-                        'stderr': proc.stderr,
-                        'stdout': proc.stdout,
-                        'raw_code_url': raw_code_url,
-                        'sanitized_code_url': sanitized_code_url
-                    }
-                    return jsonify(response_data), 422
-                # If it's a TypeError for list >> list, return a user-friendly error
-                if 'TypeError' in proc.stderr and 'unsupported operand type(s) for >>' in proc.stderr:
-                    response_data = {
-                        'error': 'Diagram code execution failed: You cannot use >> between lists of nodes. Connect nodes individually or use a nested loop.',
-                        'stderr': proc.stderr,
-                        'stdout': proc.stdout,
-                        'raw_code_url': raw_code_url,
-                        'sanitized_code_url': sanitized_code_url
-                    }
-                    return jsonify(response_data), 422
-                # Try to return the diagram if it was generated, even if there was an error
-                image_candidates = []
-                try:
-                    with open('generated_diagram.py', 'r') as f:
-                        code_content = f.read()
-                    m = re.search(r'filename\s*=\s*["\']([^"\']+)["\']', code_content)
-                    if m:
-                        base = m.group(1)
-                        base_png = base if base.endswith('.png') else base + '.png'
-                        image_candidates.append(base_png)
-                        image_candidates.append(os.path.basename(base_png))
-                    else:
-                        m2 = re.search(r'with Diagram\((?:["\'])(.*?)(?:["\'])', code_content)
-                        if m2:
-                            title = m2.group(1)
-                            title_clean = title.lower().replace(' ', '_').replace('/', '_')
-                            image_candidates.append(title_clean + '.png')
-                except Exception as e:
-                    print(f"Could not infer image filename from code: {e}")
-                for candidate in image_candidates:
-                    if os.path.exists(candidate):
-                        image_url = f'/diagrams/{candidate.replace(os.sep, "/")}'
-                        response_data = {
-                            'diagram_path': candidate,
-                            'image_url': image_url,
-                            'error': 'Diagram code execution failed',
-                            'stderr': proc.stderr,
-                            'stdout': proc.stdout
-                        }
-                        return jsonify(response_data), 206
-                # Fallback: search for any .png in folder
-                for fname in os.listdir('.'):
-                    if fname.endswith('.png'):
-                        image_url = f'/diagrams/{fname.replace(os.sep, "/")}'
-                        response_data = {
-                            'diagram_path': fname,
-                            'image_url': image_url,
-                            'error': 'Diagram code execution failed',
-                            'stderr': proc.stderr,
-                            'stdout': proc.stdout
-                        }
-                        return jsonify(response_data), 206
-                response_data = {
-                    'error': 'Diagram code execution failed',
-                    'stderr': proc.stderr,
-                    'stdout': proc.stdout,
-                    'raw_code_url': raw_code_url,
-                    'sanitized_code_url': sanitized_code_url
-                }
-                return jsonify(response_data), 500
+            with tracing.span('render'):
+                proc = render_diagram(temp_upload_folder, deadline.stage_timeout(RENDER_TIMEOUT), layout)
+                tracing.set_attribute('returncode', proc.returncode)
         except Exception as e:
+            if deadline.is_exceeded(e):
+                return error_response(deadline.DEADLINE_MESSAGE, 504)
             return error_response(f'Diagram execution error: {str(e)}', 500)
-        finally:
-            os.chdir(cwd)
-            
+        if proc.returncode != 0:
+            payload, status = render_failure_payload(
+                proc.stdout, proc.stderr, temp_upload_folder, code, raw_code_url, sanitized_code_url
+            )
+            return jsonify(payload), status
         timings['diagram_execution'] = time.time() - start_exec
-        
-        # Now get the explanation result
-        try:
-            explanation = explanation_future.result()
-        except Exception as e:
-            print(f"Error getting explanation result: {str(e)}")
-            explanation = None
-            
-    timings['explanation'] = time.time() - start_explanation
+        add_layout_timings(timings, read_layout_report(temp_upload_folder))
 
-    # Collect output files
-    output_formats = ["png", "svg", "pdf", "dot", "jpg"]
-    base_names = set()
-    try:
-        with open(sanitized_code_path, 'r') as f:
-            code_content = f.read()
-        m = re.search(r'filename\s*=\s*["\']([^"\']+)["\']', code_content)
-        if m:
-            base = m.group(1)
-            base_png = base if base.endswith('.png') else base + '.png'
-            base_names.add(os.path.splitext(os.path.basename(base_png))[0])
-        else:
-            m2 = re.search(r'with Diagram\((?:["\'])(.*?)(?:["\'])', code_content)
-            if m2:
-                title = m2.group(1)
-                title_clean = title.lower().replace(' ', '_').replace('/', '_')
-                base_names.add(title_clean)
-    except Exception as e:
-        print(f"Could not infer image filename from code: {e}")
-    # Fallback: search for any output file in temp_upload_folder and subfolders
-    for root, dirs, files in os.walk(temp_upload_folder):
-        for fname in files:
-            for ext in output_formats:
-                if fname.endswith('.' + ext):
-                    base = os.path.splitext(fname)[0]
-                    base_names.add(base)
-                    # If SVG, fix icons in place by running the script
-                    if ext == "svg":
-                        svg_path = os.path.join(root, fname)
-                        fix_svg_inplace(svg_path)
-
-    # Save explanation as Markdown file
-    try:
-        md_path = os.path.join(temp_upload_folder, 'generated_diagram.md')
-        with open(md_path, 'w') as f:
-            f.write(explanation or "(No explanation generated)")
-    except Exception as e:
-        print(f"Failed to save explanation markdown: {e}")
+        if explanation is None:
+            explanation, explanation_source = finish_explanation(
+                explanation_future, code, provider, explanation_mode,
+                timeout=deadline.bound(None, reserve=deadline.DEADLINE_RESERVE)
+            )
+    finally:
+        cancel_explanation(explanation_future, explanation_mode)
+    timings['explanation'] = time.time() - start_explanation_time
 
-    # --- S3 Upload Logic (after all outputs and variables are defined) ---
-    start_s3 = time.time()
-    s3_folder = temp_dir_name  # Use the same provider-prefixed folder name for S3
-    
-    # Prepare files for parallel upload
-    files_to_upload = {}
-    for root, dirs, files in os.walk(temp_upload_folder):
-        for fname in files:
-            if fname.startswith('.'):
-                continue  # skip hidden files like .DS_Store
-            local_path = os.path.join(root, fname)
-            # Store file path for parallel upload
-            files_to_upload[fname] = local_path
-    
-    # Use parallel upload function instead of sequential uploads
-    uploaded_files = parallel_upload_to_s3(files_to_upload, s3_folder)
-    uploaded_files['s3_folder'] = s3_folder
-    timings['s3_upload'] = time.time() - start_s3
+    base_names = collect_output_base_names(temp_upload_folder, code)
+    skipped = []
+    artifact_sizes = {}
+    if deadline.allows(deadline.OPTIONAL_STAGE_SECONDS):
+        artifact_sizes = optimize_artifacts(temp_upload_folder)
+        ledger.annotate(artifact_bytes=sum(size['after'] for size in artifact_sizes.values()))
+    else:
+        skipped.append('optimize_artifacts')
+    save_explanation(temp_upload_folder, explanation)
 
-    try:
-        if base_names:
-            # Map file extensions to S3 URLs for diagram_files
-            urls = {}
-            for base in base_names:
-                for ext in output_formats:
-                    fname = f"{base}.{ext}"
-                    if fname in uploaded_files:
-                        urls[ext] = uploaded_files[fname]
-            # Use S3 URLs for code and markdown files
-            raw_code_url = uploaded_files.get('generated_diagram_raw.py')
-            sanitized_code_url = uploaded_files.get('generated_diagram.py')
-            explanation_md_url = uploaded_files.get('generated_diagram.md')
-            
-            # Get URLs for input files if they exist
-            original_input_url = uploaded_files.get('original_input.txt')
-            rewritten_input_url = uploaded_files.get('rewritten_input.txt')
-            
-            timings['total'] = time.time() - start_total
-            
-            # Prepare response dictionary
-            response_data = {
-                'diagram_files': urls,  # S3 URLs for images and outputs
-                'raw_code_url': raw_code_url,
-                'sanitized_code_url': sanitized_code_url,
-                'explanation': explanation,
-                'explanation_md_url': explanation_md_url,
-                'uploaded_files': uploaded_files  # all S3 URLs for all files
-            }
-            
-            # Add input URLs if they exist
-            if original_input_url:
-                response_data['original_input_url'] = original_input_url
-            if rewritten_input_url:
-                response_data['rewritten_input_url'] = rewritten_input_url
-                
-            # Return the response
-            return jsonify(response_data)
+    start_upload = time.time()
+    upload_files = list_upload_files(temp_upload_folder)
+    uploaded_files = parallel_upload(upload_files, temp_dir_name, timeout=deadline.bound(None))
+    skipped.extend(skipped_uploads(upload_files, uploaded_files))
+    uploaded_files['s3_folder'] = temp_dir_name
+    timings['upload'] = time.time() - start_upload
 
-        # Final fallback: should never be reached, but ensures a response is always sent
+    if not base_names:
         return error_response('Unknown server error', 500)
-    finally:
-        # Lambda automatically cleans up the /tmp directory between invocations
-        pass
+    timings['total'] = time.time() - start_total
+    response_data = build_generate_response(
+        uploaded_files, base_names, explanation, artifact_sizes, explanation_source, timings
+    )
+    response_data.update({
+        'parent_id': job_id,
+        'cosmetic': cosmetic,
+        'patch': patch
+    })
+    if skipped:
+        response_data['skipped'] = skipped
+        ledger.annotate(skipped=skipped)
+    return jsonify(response_data)
+
+def upload_artifact(local_path, folder, filename):
+    key = f"{folder}/{filename}"
+    with tracing.span('storage.put', key=key, bytes=os.path.getsize(local_path), backend=storage.name):
+        storage.put_file(local_path, key)
+    return key
 
-def upload_file_to_s3(local_path, s3_folder, filename):
-    s3_key = f"{s3_folder}/{filename}"
-    s3_client.upload_file(local_path, S3_BUCKET, s3_key)
-    # No need to delete local files as Lambda automatically cleans up /tmp
-    return s3_key
+def artifact_url(key):
+    with tracing.span('storage.presign', key=key):
+        return storage.url(key)
 
-def parallel_upload_to_s3(files_to_upload, s3_folder):
-    """Upload multiple files to S3 in parallel"""
+def parallel_upload(files_to_upload, folder, timeout=None):
+    """Upload multiple files to the artifact storage in parallel.
+    Files not uploaded within timeout are left out of the result."""
     uploaded_files = {}
     
     # Define a worker function for the thread pool
     def upload_worker(file_info):
         local_path, filename = file_info
         try:
-            s3_key = upload_file_to_s3(local_path, s3_folder, filename)
-            url = generate_presigned_url(s3_key)
+            key = upload_artifact(local_path, folder, filename)
+            url = artifact_url(key)
             return filename, url
         except Exception as e:
             print(f"Error uploading {filename}: {str(e)}")
             return filename, None
     
-    # Use a thread pool to upload files in parallel
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+    # Upload in parallel on the shared upload pool
+    future_to_file = {}
+    try:
         # Submit all upload tasks
         future_to_file = {
-            executor.submit(upload_worker, (local_path, fname)): fname
+            executors.upload.submit_or_run(tracing.bind(upload_worker), (local_path, fname)): fname
             for fname, local_path in files_to_upload.items()
         }
         
         # Collect results as they complete
-        for future in concurrent.futures.as_completed(future_to_file):
+        for future in concurrent.futures.as_completed(future_to_file, timeout=timeout):
             filename, url = future.result()
             if url:
                 uploaded_files[filename] = url
+    except concurrent.futures.TimeoutError:
+        print(f"Upload to {folder} stopped at the request deadline")
+    finally:
+        for future in future_to_file:
+            future.cancel()
                 
     return uploaded_files
 
-def generate_presigned_url(s3_key, expires_in=3600):
-    try:
-        url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': S3_BUCKET, 'Key': s3_key},
-            ExpiresIn=expires_in
-        )
-        return url
-    except ClientError as e:
-        print(f"Failed to generate presigned URL for {s3_key}: {e}")
-        return None
+def skipped_uploads(files_to_upload, uploaded_files):
+    """Files left out because the deadline was reached (plain upload failures are not skips)"""
+    if not deadline.is_exceeded():
+        return []
+    return [f'upload:{name}' for name in files_to_upload if name not in uploaded_files]
 
 # New endpoint: Rewrite user input based on cloud provider
 @app.route('/rewrite', methods=['POST'])
@@ -738,4 +1070,4 @@ def rewrite_endpoint():
     })
 
 if __name__ == '__main__':
-    app.run(host="0.0.0.0", port=5050)
+    app.run(host="0.0.0.0", port=5050, threaded=True)
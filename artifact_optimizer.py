@@ -0,0 +1,204 @@
+import os
+import re
+import struct
+import zlib
+
+# Pillow is optional: it is only needed for lossy palette quantization of PNGs
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# ===================
+# Configuration
+# ===================
+# OPTIMIZE_SVG: "1" to minify SVG output, "0" to leave it untouched
+# OPTIMIZE_PNG: "lossless" (default), "quantize" (palette, needs Pillow) or "off"
+# SVG_PRECISION: number of decimals kept for coordinates in SVG attributes
+OPTIMIZE_SVG = os.environ.get('OPTIMIZE_SVG', '1') == '1'
+OPTIMIZE_PNG = os.environ.get('OPTIMIZE_PNG', 'lossless').lower()
+SVG_PRECISION = int(os.environ.get('SVG_PRECISION', '2'))
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Ancillary PNG chunks that carry metadata only and never affect rendering
+_PNG_DROP_CHUNKS = {b'tEXt', b'zTXt', b'iTXt', b'tIME'}
+
+# SVG attributes whose values are purely numeric/geometric and safe to round
+_SVG_NUMERIC_ATTRS = (
+    'points', 'd', 'x', 'y', 'x1', 'y1', 'x2', 'y2', 'cx', 'cy', 'rx', 'ry', 'r',
+    'width', 'height', 'viewBox', 'transform', 'font-size', 'stroke-width'
+)
+_SVG_NUMERIC_ATTR_RE = re.compile(
+    r'(\s(?:%s))="([^"]*)"' % '|'.join(re.escape(a) for a in _SVG_NUMERIC_ATTRS)
+)
+_FLOAT_RE = re.compile(r'-?\d+\.\d+')
+_DEFS_ITEM_RE = re.compile(r'<(\w+)\s+id="([^"]+)"([^>]*)>(.*?)</\1>', re.DOTALL)
+
+
+# ===================
+# SVG
+# ===================
+def _shorten_number(match, precision):
+    value = round(float(match.group(0)), precision)
+    text = f'{value:.{precision}f}'.rstrip('0').rstrip('.')
+    return '0' if text in ('-0', '') else text
+
+
+def _dedupe_defs(content):
+    """Drop duplicate <defs> entries and point their references at the first copy"""
+    seen = {}
+    aliases = {}
+
+    def _replace_defs(defs_match):
+        def _replace_item(item):
+            tag, item_id, attrs, body = item.groups()
+            signature = (tag, attrs, body)
+            if signature in seen:
+                aliases[item_id] = seen[signature]
+                return ''
+            seen[signature] = item_id
+            return item.group(0)
+
+        inner = _DEFS_ITEM_RE.sub(_replace_item, defs_match.group(1))
+        return f'<defs>{inner}</defs>' if inner.strip() else ''
+
+    content = re.sub(r'<defs>(.*?)</defs>', _replace_defs, content, flags=re.DOTALL)
+    for alias, target in aliases.items():
+        content = content.replace(f'url(#{alias})', f'url(#{target})')
+        content = content.replace(f'href="#{alias}"', f'href="#{target}"')
+    return content
+
+
+def minify_svg(content, precision=SVG_PRECISION):
+    """Minify Graphviz SVG output: strip comments and whitespace, shorten numbers, dedupe defs"""
+    # Comments (Graphviz emits one per node/edge/cluster)
+    content = re.sub(r'<!--.*?-->', '', content, flags=re.DOTALL)
+    # Whitespace between tags
+    content = re.sub(r'>\s+<', '><', content).strip()
+    # Shorten numbers, but only inside geometric attributes so labels stay intact
+    content = _SVG_NUMERIC_ATTR_RE.sub(
+        lambda m: f'{m.group(1)}="{_FLOAT_RE.sub(lambda n: _shorten_number(n, precision), m.group(2))}"',
+        content
+    )
+    return _dedupe_defs(content)
+
+
+# ===================
+# PNG
+# ===================
+def _iter_png_chunks(data):
+    offset = len(PNG_SIGNATURE)
+    while offset + 8 <= len(data):
+        length, chunk_type = struct.unpack('>I4s', data[offset:offset + 8])
+        chunk_data = data[offset + 8:offset + 8 + length]
+        yield chunk_type, chunk_data
+        offset += 12 + length
+        if chunk_type == b'IEND':
+            break
+
+
+def _png_chunk(chunk_type, chunk_data):
+    crc = zlib.crc32(chunk_type + chunk_data) & 0xffffffff
+    return struct.pack('>I', len(chunk_data)) + chunk_type + chunk_data + struct.pack('>I', crc)
+
+
+def recompress_png(data):
+    """Losslessly recompress a PNG: merge IDAT chunks, deflate at max level, drop metadata chunks.
+
+    Returns the original bytes if the result would not be smaller.
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        return data
+
+    chunks = []
+    idat = []
+    for chunk_type, chunk_data in _iter_png_chunks(data):
+        if chunk_type == b'IDAT':
+            if not idat:
+                chunks.append((b'IDAT', None))  # placeholder keeps chunk order
+            idat.append(chunk_data)
+        elif chunk_type not in _PNG_DROP_CHUNKS:
+            chunks.append((chunk_type, chunk_data))
+    if not idat:
+        return data
+
+    raw = zlib.decompress(b''.join(idat))
+    best = None
+    for strategy in (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9, strategy)
+        candidate = compressor.compress(raw) + compressor.flush()
+        if best is None or len(candidate) < len(best):
+            best = candidate
+
+    out = [PNG_SIGNATURE]
+    for chunk_type, chunk_data in chunks:
+        out.append(_png_chunk(chunk_type, best if chunk_type == b'IDAT' else chunk_data))
+    result = b''.join(out)
+    return result if len(result) < len(data) else data
+
+
+def quantize_png(path):
+    """Convert a PNG to an optimized 256-colour palette image in place (requires Pillow).
+
+    The original file is kept if quantization does not make it smaller.
+    """
+    with open(path, 'rb') as f:
+        original = f.read()
+    with Image.open(path) as img:
+        quantized = img.convert('RGBA').quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+    quantized.save(path, format='PNG', optimize=True)
+    if os.path.getsize(path) >= len(original):
+        with open(path, 'wb') as f:
+            f.write(original)
+
+
+# ===================
+# Entry points
+# ===================
+def optimize_artifact(path, svg=OPTIMIZE_SVG, png=OPTIMIZE_PNG):
+    """Optimize a single rendered artifact in place.
+
+    Returns a dict with the byte size before and after, or None if the format is not handled.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.svg' and svg:
+        before = os.path.getsize(path)
+        with open(path, 'r') as f:
+            content = f.read()
+        minified = minify_svg(content)
+        if len(minified.encode()) < before:
+            with open(path, 'w') as f:
+                f.write(minified)
+    elif ext == '.png' and png in ('lossless', 'quantize'):
+        before = os.path.getsize(path)
+        if png == 'quantize' and Image is not None:
+            quantize_png(path)
+        else:
+            if png == 'quantize':
+                print("Warning: Pillow is not installed, falling back to lossless PNG optimization")
+            with open(path, 'rb') as f:
+                data = f.read()
+            optimized = recompress_png(data)
+            if optimized is not data:
+                with open(path, 'wb') as f:
+                    f.write(optimized)
+    else:
+        return None
+    return {'before': before, 'after': os.path.getsize(path)}
+
+
+def optimize_artifacts(folder, svg=OPTIMIZE_SVG, png=OPTIMIZE_PNG):
+    """Optimize every SVG/PNG under folder. Returns {filename: {'before': n, 'after': m}}"""
+    sizes = {}
+    for root, dirs, files in os.walk(folder):
+        for fname in files:
+            try:
+                result = optimize_artifact(os.path.join(root, fname), svg=svg, png=png)
+            except Exception as e:
+                # A failed optimization must never break the response; keep the original file
+                print(f"Error optimizing {fname}: {str(e)}")
+                continue
+            if result:
+                sizes[fname] = result
+    return sizes
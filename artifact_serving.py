@@ -0,0 +1,245 @@
+import os
+import io
+import gzip
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+from flask import request, send_file
+
+# brotli is optional; gzip is always available
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# ===================
+# Configuration
+# ===================
+# ARTIFACT_CACHE_BYTES: total bytes of artifact content kept in the in-memory LRU
+# ARTIFACT_CACHE_FILE_BYTES: files larger than this are streamed from disk instead of cached
+# ARTIFACT_ENCODED_DIR: where compressed copies of text files too large for the cache are kept
+#   (removed when their cache entry is evicted)
+# ARTIFACT_MAX_AGE: Cache-Control max-age (seconds) sent with every artifact
+ARTIFACT_CACHE_BYTES = int(os.environ.get('ARTIFACT_CACHE_BYTES', str(32 * 1024 * 1024)))
+ARTIFACT_CACHE_FILE_BYTES = int(os.environ.get('ARTIFACT_CACHE_FILE_BYTES', str(1024 * 1024)))
+ARTIFACT_MAX_AGE = int(os.environ.get('ARTIFACT_MAX_AGE', '3600'))
+ARTIFACT_ENCODED_DIR = os.environ.get('ARTIFACT_ENCODED_DIR') or os.path.join(
+    tempfile.gettempdir(), 'artifact-encodings'
+)
+
+CONTENT_TYPES = {
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.svg': 'image/svg+xml',
+    '.pdf': 'application/pdf',
+    '.dot': 'text/plain',
+    '.py': 'text/plain',
+    '.md': 'text/markdown',
+    '.txt': 'text/plain',
+    '.json': 'application/json',
+}
+
+# Text formats worth compressing on the wire (images and PDFs are already compressed)
+COMPRESSIBLE_EXTENSIONS = {'.svg', '.dot', '.py', '.md', '.txt', '.json'}
+
+_HASH_CHUNK_SIZE = 64 * 1024
+
+
+class _ArtifactEntry:
+    def __init__(self, etag, data=None):
+        self.etag = etag
+        self.data = data  # None for files too large to keep in memory
+        self.encoded = {}  # encoding -> compressed bytes
+        self.encoded_files = set()  # encodings compressed to ARTIFACT_ENCODED_DIR (large files)
+
+    @property
+    def size(self):
+        return len(self.data or b'') + sum(len(v) for v in self.encoded.values())
+
+    def encoded_path(self, encoding):
+        return os.path.join(ARTIFACT_ENCODED_DIR, f'{self.etag}.{encoding}')
+
+    def discard(self):
+        """Remove the compressed copies on disk once the entry leaves the cache"""
+        for encoding in self.encoded_files:
+            try:
+                os.remove(self.encoded_path(encoding))
+            except OSError:
+                pass
+
+
+class ArtifactCache:
+    """Bounded LRU of artifact content and content-hash ETags, keyed by (path, mtime, size)"""
+
+    def __init__(self, max_bytes=ARTIFACT_CACHE_BYTES, max_entries=4096):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous.size
+            self._entries[key] = entry
+            self._bytes += entry.size
+            self._evict()
+
+    def resize(self, key, delta):
+        """Account for bytes added to an entry after it was inserted (e.g. a compressed variant)"""
+        with self._lock:
+            if key in self._entries:
+                self._bytes += delta
+                self._evict()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes, 'max_bytes': self.max_bytes}
+
+    def _evict(self):
+        while self._entries and (self._bytes > self.max_bytes or len(self._entries) > self.max_entries):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.size
+            evicted.discard()
+
+
+artifact_cache = ArtifactCache()
+
+
+def _load_entry(path, st):
+    """Hash the file once (in chunks) and keep small files in memory"""
+    hasher = hashlib.sha256()
+    data = None
+    with open(path, 'rb') as f:
+        if st.st_size <= ARTIFACT_CACHE_FILE_BYTES:
+            data = f.read()
+            hasher.update(data)
+        else:
+            for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+    return _ArtifactEntry(hasher.hexdigest()[:32], data)
+
+
+def _negotiate_encoding(ext):
+    # Ranges apply to the identity representation only, so never compress a range request
+    if ext not in COMPRESSIBLE_EXTENSIONS or request.range is not None:
+        return None
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def _compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=5)
+    return gzip.compress(data, compresslevel=6)
+
+
+def _open_encoded(path, entry, encoding):
+    """Open the compressed copy of a file too large for the cache, compressing it (streamed) on first use"""
+    encoded = entry.encoded_path(encoding)
+    try:
+        return open(encoded, 'rb')
+    except FileNotFoundError:
+        pass
+    os.makedirs(ARTIFACT_ENCODED_DIR, exist_ok=True)
+    tmp = f'{encoded}.{threading.get_ident()}.tmp'
+    with open(path, 'rb') as src, open(tmp, 'wb') as dst:
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=5)
+            for chunk in iter(lambda: src.read(_HASH_CHUNK_SIZE), b''):
+                dst.write(compressor.process(chunk))
+            dst.write(compressor.finish())
+        else:
+            with gzip.GzipFile(fileobj=dst, mode='wb', compresslevel=6) as compressed:
+                shutil.copyfileobj(src, compressed, _HASH_CHUNK_SIZE)
+    # Opened before the rename, so a concurrent eviction cannot remove it from under this response
+    source = open(tmp, 'rb')
+    os.replace(tmp, encoded)
+    entry.encoded_files.add(encoding)
+    return source
+
+
+def serve_artifact(path):
+    """Serve a file with a strong content-hash ETag, conditional GETs, Range support and compression.
+
+    Small files are served from the in-memory LRU; larger ones are streamed from disk in chunks,
+    text formats from a compressed copy written once to ARTIFACT_ENCODED_DIR.
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    entry = artifact_cache.get(key)
+    if entry is None:
+        entry = _load_entry(path, st)
+        artifact_cache.put(key, entry)
+    return _respond(key, entry, path, st.st_mtime)
+
+
+def serve_artifact_bytes(name, data):
+    """serve_artifact for content held in memory (the memory storage backend); name gives the type"""
+    etag = hashlib.sha256(data).hexdigest()[:32]
+    key = (name, etag)
+    entry = artifact_cache.get(key)
+    if entry is None:
+        entry = _ArtifactEntry(etag, data)
+        artifact_cache.put(key, entry)
+    return _respond(key, entry, name, None)
+
+
+def _respond(key, entry, path, last_modified):
+    ext = os.path.splitext(path)[1].lower()
+    mimetype = CONTENT_TYPES.get(ext, 'application/octet-stream')
+    encoding = _negotiate_encoding(ext)
+
+    if encoding and entry.data is None:
+        # Too large for the cache: compressed to disk once, then streamed like the original
+        source = _open_encoded(path, entry, encoding)
+        etag = f'{entry.etag}-{encoding}'
+    elif encoding:
+        body = entry.encoded.get(encoding)
+        if body is None:
+            body = _compress(entry.data, encoding)
+            entry.encoded[encoding] = body
+            artifact_cache.resize(key, len(body))
+        source = io.BytesIO(body)
+        etag = f'{entry.etag}-{encoding}'
+    elif entry.data is not None:
+        source = io.BytesIO(entry.data)
+        etag = entry.etag
+    else:
+        # Stream large files straight from disk (wsgi.file_wrapper where the server supports it)
+        source = path
+        etag = entry.etag
+
+    response = send_file(
+        source,
+        mimetype=mimetype,
+        etag=etag,
+        last_modified=last_modified,
+        conditional=True,
+        max_age=ARTIFACT_MAX_AGE
+    )
+    response.headers['Accept-Ranges'] = 'bytes'
+    if encoding and entry.data is None and response.status_code == 200:
+        response.content_length = os.fstat(source.fileno()).st_size
+    if ext in COMPRESSIBLE_EXTENSIONS:
+        response.vary.add('Accept-Encoding')
+    if encoding and response.status_code == 200:
+        response.headers['Content-Encoding'] = encoding
+    return response
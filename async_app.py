@@ -0,0 +1,589 @@
+# ===================
+# Imports (Standard Library)
+# ===================
+import os
+import json
+import time
+import asyncio
+import traceback
+
+# ===================
+# Imports (Third-Party)
+# ===================
+from asgiref.wsgi import WsgiToAsgi
+
+# ===================
+# Imports (Local)
+# ===================
+import tracing
+import executors
+import ledger
+import deadline
+import profiling
+import fake_llm
+from app import (
+    app as flask_app, workspace, storage, upload_artifact, artifact_url, skipped_uploads, CORS_ORIGINS,
+    request_ledger, idempotency_store, explanation_store
+)
+from idempotency import (
+    IDEMPOTENCY_HEADER, REPLAYED_HEADER, IDEMPOTENCY_WAIT, IN_PROGRESS_MESSAGE, LEAD, ATTACH, REPLAY,
+    validate_key, fingerprint
+)
+from llm_providers import (
+    generate_code_openai_async, generate_rewrite_openai_async, generate_code_candidates_openai_async
+)
+from parallel import generate_explanation_aio
+from artifact_optimizer import optimize_artifacts
+from pipeline import (
+    GENERATE_INSTRUCTION_FILES, QUOTA_ERROR_MESSAGE, validate_generate_request,
+    read_rewrite_instructions, is_quota_error, non_code_response_message, sanitize_code,
+    save_inputs, render_failure_payload, RENDER_TIMEOUT, render_setup, collect_output_base_names,
+    save_explanation, list_upload_files, build_generate_response, read_explanation_mode
+)
+from graph_explanation import explain_graph
+from node_catalog import catalog_prompt, unknown_node_message
+from layout import validate_layout, read_layout_report, add_layout_timings
+from candidates import (
+    read_candidates, prepare_candidates, reported_failure, candidate_failure_payload, discard_candidates,
+    candidate_summary, common_code, CANDIDATE_MAX_TOKENS, CANDIDATE_TEMPERATURE
+)
+from decompose import read_decompose_mode, should_decompose, generate_decomposed_aio, DecompositionError
+
+# ===================
+# Configuration
+# ===================
+# ASYNC_GENERATE: "1" serves POST /generate natively on the event loop; "0" routes it to Flask
+ASYNC_GENERATE = os.environ.get('ASYNC_GENERATE', '1') == '1'
+
+# Every other route is served by the Flask app
+wsgi_app = WsgiToAsgi(flask_app)
+
+# Hybrid-mode explanation tasks outlive their request; keep references so they aren't collected
+_background_tasks = set()
+
+# /generate requests running on the event loop; a loop-wide profile reports how many overlapped it
+_in_flight = 0
+
+
+async def explain_and_store(code, provider):
+    """LLM explanation of code, kept in the explanation store for later requests"""
+    explanation = await generate_explanation_aio(code, provider)
+    if explanation:
+        await asyncio.to_thread(explanation_store.put, code, provider, explanation)
+    return explanation
+
+
+async def start_explanation_aio(code, provider, mode):
+    """(stored explanation, task): the stored explanation of code, else a task explaining it
+    concurrently with the rest of the request. Both are None in graph mode."""
+    if mode == 'graph':
+        return None, None
+    # An explanation stored for this code (by /explain or an earlier job) saves the LLM calls
+    stored = await asyncio.to_thread(explanation_store.get, code, provider)
+    if stored:
+        return stored, None
+    if mode == 'llm':
+        return None, asyncio.create_task(explain_and_store(code, provider))
+    # Detached from the deadline like the threaded hybrid path (see parallel.submit_explanation)
+    task = asyncio.create_task(deadline.detached(explain_and_store)(code, provider))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return None, task
+
+
+def cancel_explanation_task(task, mode):
+    """Drop a request's LLM explanation; hybrid ones keep going so a late result still lands in the store"""
+    if task is not None and mode == 'llm' and not task.done():
+        task.cancel()
+
+
+# Blocking helpers: the handler runs these with asyncio.to_thread so the loop keeps serving other requests
+def read_generate_instructions(provider, description):
+    """(instructions, error): the provider's generate instructions plus the catalog prompt for description"""
+    instructions_file = GENERATE_INSTRUCTION_FILES.get(provider)
+    if not instructions_file:
+        return None, ('Invalid provider. Please use aws, azure, or gcp.', 400)
+    if not os.path.exists(instructions_file):
+        return None, (f'Instructions file not found at {instructions_file}. Please check your installation.', 500)
+    try:
+        with open(instructions_file, 'r') as f:
+            instructions = f.read()
+    except Exception as e:
+        return None, (f'Failed to read {instructions_file}: {e}', 500)
+    # Exact class names of the modules this description needs (see node_catalog.py)
+    return instructions + catalog_prompt(provider, description), None
+
+
+def write_text(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def release_workspaces(folders):
+    for folder in folders:
+        workspace.release(folder)
+
+
+# ===================
+# Pipeline stages
+# ===================
+async def run_render(folder, timeout=RENDER_TIMEOUT, layout='auto'):
+    """Render generated_diagram.py in folder without blocking the event loop.
+
+    Returns (returncode, stdout, stderr). The process is killed on timeout.
+    """
+    argv, env = await asyncio.to_thread(render_setup, folder, timeout, layout)
+    proc = await asyncio.create_subprocess_exec(
+        *argv,
+        cwd=folder,
+        env=env,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        proc.kill()
+        await proc.wait()
+        raise
+    return proc.returncode, stdout.decode(errors='replace'), stderr.decode(errors='replace')
+
+
+async def render_first_success_aio(candidates, timeout=RENDER_TIMEOUT, layout='auto'):
+    """Render the prepared candidates concurrently; the first clean render wins and the rest are cancelled.
+
+    Returns the winning candidate, or None.
+    """
+    tasks = {
+        asyncio.create_task(run_render(c.folder, timeout, layout)): c
+        for c in candidates if c.folder is not None
+    }
+    winner = None
+    try:
+        pending = set(tasks)
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done, key=lambda t: tasks[t].index):
+                candidate = tasks[task]
+                try:
+                    candidate.result = task.result()
+                except asyncio.TimeoutError:
+                    candidate.result = (None, '', f'Render timed out after {timeout} seconds')
+                except Exception as e:
+                    candidate.result = (None, '', str(e))
+                if winner is None and candidate.result[0] == 0:
+                    winner = candidate
+                    winner.won = True
+        for task in pending:
+            tasks[task].cancelled = True
+    finally:
+        # run_render kills its process when cancelled
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return winner
+
+
+async def upload_all(files_to_upload, folder, timeout=None):
+    """Upload files concurrently. boto3 is blocking, so each call runs on the shared upload pool
+    (bounded, and reported under /health). Files not uploaded within timeout are left out of the result."""
+    async def _upload(fname, local_path):
+        try:
+            key = await executors.upload.run_async(tracing.bind(upload_artifact), local_path, folder, fname)
+            return fname, await executors.upload.run_async(tracing.bind(artifact_url), key)
+        except Exception as e:
+            print(f"Error uploading {fname}: {str(e)}")
+            return fname, None
+
+    tasks = [asyncio.create_task(_upload(f, p)) for f, p in files_to_upload.items()]
+    if not tasks:
+        return {}
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    if pending:
+        print(f"Upload to {folder} stopped at the request deadline")
+        for task in pending:
+            task.cancel()
+    results = [task.result() for task in done]
+    return {fname: url for fname, url in results if url}
+
+
+async def generate_diagram_aio(data):
+    """Async implementation of /generate. Returns (payload, status)."""
+    timings = {}
+    start_total = time.time()
+
+    # Predefine code URLs for error handling
+    raw_code_url = '/diagrams/generated_diagram_raw.py'
+    sanitized_code_url = '/diagrams/generated_diagram.py'
+
+    description, provider, error = validate_generate_request(data)
+    if error:
+        message, status = error
+        return {'error': message}, status
+    explanation_mode, error = read_explanation_mode(data)
+    if error:
+        message, status = error
+        return {'error': message}, status
+    layout, error = validate_layout(data.get('layout'))
+    if error:
+        message, status = error
+        return {'error': message}, status
+    candidate_count, error = read_candidates(data)
+    if error:
+        message, status = error
+        return {'error': message}, status
+    decompose_mode, error = read_decompose_mode(data)
+    if error:
+        message, status = error
+        return {'error': message}, status
+    ledger.annotate(provider=provider, timings=timings)
+
+    # First, rewrite the description with provider-specific terminology
+    original_description = description
+    rewritten_description = None
+    try:
+        rewrite_instructions = await asyncio.to_thread(read_rewrite_instructions, provider)
+        if rewrite_instructions:
+            with tracing.span('rewrite', provider=provider, input_bytes=len(description)):
+                rewritten_description = await generate_rewrite_openai_async(description, rewrite_instructions)
+            description = rewritten_description
+    except Exception as e:
+        print(f"Warning: Description rewriting failed: {str(e)}. Continuing with original description.")
+        rewritten_description = None
+
+    instructions, error = await asyncio.to_thread(read_generate_instructions, provider, description)
+    if error:
+        message, status = error
+        return {'error': message}, status
+
+    # Generate code with OpenAI
+    start_llm = time.time()
+    decomposition = None
+    try:
+        with tracing.span('codegen', provider=provider, prompt_bytes=len(instructions) + len(description),
+                          candidates=candidate_count):
+            codes = None
+            # Large descriptions: subsystems are generated in parallel and merged (see decompose.py)
+            if should_decompose(decompose_mode, description):
+                try:
+                    code, decomposition = await generate_decomposed_aio(description, instructions)
+                    codes = [code]
+                except DecompositionError as e:
+                    print(f"Warning: Decomposition failed: {str(e)}. Generating the whole description at once.")
+            if codes is None and candidate_count > 1:
+                codes = await generate_code_candidates_openai_async(
+                    description, instructions, candidate_count, CANDIDATE_MAX_TOKENS, CANDIDATE_TEMPERATURE
+                )
+            elif codes is None:
+                codes = [await generate_code_openai_async(description, instructions)]
+            code = codes[0]
+            tracing.set_attribute('code_bytes', len(code))
+    except Exception as e:
+        if is_quota_error(e):
+            return {'error': QUOTA_ERROR_MESSAGE, 'raw_code_url': None, 'sanitized_code_url': None}, 429
+        if deadline.is_exceeded(e):
+            return {'error': deadline.DEADLINE_MESSAGE}, 504
+        return {'error': f'OpenAI API error: {str(e)}', 'traceback': traceback.format_exc()}, 500
+    timings['llm'] = time.time() - start_llm
+    if decomposition is not None:
+        ledger.annotate(decomposition=decomposition)
+
+    candidates = None
+    winner = None
+    folders = []  # workspaces released when the request ends
+    # The explanation starts as soon as the code it explains is known: with candidates, before the
+    # race if they are all the same program, else once a render wins
+    explanation_started = False
+    stored_explanation, explanation_task = None, None
+    start_explanation = None
+    if len(codes) > 1:
+        # Speculative candidates: render all of them, keep the first clean render
+        candidates = await asyncio.to_thread(
+            prepare_candidates, workspace, provider, codes, original_description, rewritten_description
+        )
+        folders = [c.folder for c in candidates if c.folder]
+        if common_code(candidates) is not None:
+            start_explanation = time.time()
+            stored_explanation, explanation_task = await start_explanation_aio(
+                common_code(candidates), provider, explanation_mode
+            )
+            explanation_started = True
+    else:
+        non_code_message = non_code_response_message(code)
+        if non_code_message:
+            return {'error': non_code_message}, 422
+        temp_dir_name, temp_upload_folder = await asyncio.to_thread(workspace.allocate, provider)
+        folders = [temp_upload_folder]
+    try:
+        if candidates is not None:
+            start_exec = time.time()
+            try:
+                with tracing.span('render.candidates', candidates=len(candidates)):
+                    winner = await render_first_success_aio(candidates, deadline.stage_timeout(RENDER_TIMEOUT), layout)
+                    tracing.set_attribute('winner', winner.index if winner else None)
+            except Exception as e:
+                cancel_explanation_task(explanation_task, explanation_mode)
+                if deadline.is_exceeded(e):
+                    return {'error': deadline.DEADLINE_MESSAGE}, 504
+                return {'error': f'Diagram execution error: {str(e)}'}, 500
+            if winner is not None and not explanation_started:
+                # The winning code is known: start its explanation before cleaning up the other candidates
+                start_explanation = time.time()
+                stored_explanation, explanation_task = await start_explanation_aio(
+                    winner.code, provider, explanation_mode
+                )
+                explanation_started = True
+            if winner is None:
+                cancel_explanation_task(explanation_task, explanation_mode)
+            discarded = await asyncio.to_thread(
+                discard_candidates, workspace, candidates, keep=winner or reported_failure(candidates)
+            )
+            for folder in discarded:
+                folders.remove(folder)
+            ledger.annotate(candidates=candidate_summary(candidates))
+            if winner is None and deadline.is_exceeded():
+                return {'error': deadline.DEADLINE_MESSAGE, 'candidates': candidate_summary(candidates)}, 504
+            if winner is None:
+                return await asyncio.to_thread(candidate_failure_payload, candidates, raw_code_url, sanitized_code_url)
+            timings['diagram_execution'] = time.time() - start_exec
+            add_layout_timings(timings, await asyncio.to_thread(read_layout_report, winner.folder))
+            temp_dir_name, temp_upload_folder, code = winner.name, winner.folder, winner.code
+        else:
+            try:
+                await asyncio.to_thread(write_text, os.path.join(temp_upload_folder, 'generated_diagram_raw.py'), code)
+            except Exception as e:
+                return {'error': 'Failed to save raw code'}, 500
+            try:
+                await asyncio.to_thread(save_inputs, temp_upload_folder, original_description, rewritten_description)
+            except Exception as e:
+                print(f"Warning: Failed to save input descriptions: {str(e)}")
+
+            code = await asyncio.to_thread(sanitize_code, code)
+            try:
+                await asyncio.to_thread(write_text, os.path.join(temp_upload_folder, 'generated_diagram.py'), code)
+            except Exception as e:
+                return {'error': 'Failed to save sanitized code'}, 500
+            unknown_message = await asyncio.to_thread(unknown_node_message, code)
+            if unknown_message:
+                return {'error': unknown_message}, 422
+
+        # Explanation runs as a task concurrently with the render subprocess (none in graph mode)
+        skipped = []
+        if not explanation_started:
+            start_explanation = time.time()
+            stored_explanation, explanation_task = await start_explanation_aio(code, provider, explanation_mode)
+        try:
+            if winner is None:
+                start_exec = time.time()
+                try:
+                    with tracing.span('render'):
+                        returncode, stdout, stderr = await run_render(
+                            temp_upload_folder, deadline.stage_timeout(RENDER_TIMEOUT), layout
+                        )
+                        tracing.set_attribute('returncode', returncode)
+                except Exception as e:
+                    if deadline.is_exceeded(e):
+                        return {'error': deadline.DEADLINE_MESSAGE}, 504
+                    return {'error': f'Diagram execution error: {str(e)}'}, 500
+                if returncode != 0:
+                    return await asyncio.to_thread(
+                        render_failure_payload, stdout, stderr, temp_upload_folder, code, raw_code_url, sanitized_code_url
+                    )
+                timings['diagram_execution'] = time.time() - start_exec
+                add_layout_timings(timings, await asyncio.to_thread(read_layout_report, temp_upload_folder))
+            explanation = stored_explanation
+            if explanation_task is not None and explanation_task.done():
+                explanation = explanation_task.result()
+            elif explanation_task is not None and explanation_mode == 'llm':
+                # Wait no longer than the deadline allows, then fall back to the graph explanation
+                try:
+                    explanation = await asyncio.wait_for(
+                        asyncio.shield(explanation_task), deadline.bound(None, reserve=deadline.DEADLINE_RESERVE)
+                    )
+                except asyncio.TimeoutError:
+                    print("Explanation not ready before the request deadline; using the graph explanation")
+                    skipped.append('llm_explanation')
+        finally:
+            # Error paths return before awaiting the explanation; don't leave it running
+            cancel_explanation_task(explanation_task, explanation_mode)
+        explanation_source = 'stored' if stored_explanation else 'llm'
+        if not explanation:
+            with tracing.span('explanation.graph'):
+                explanation, explanation_source = await asyncio.to_thread(explain_graph, code, provider), 'graph'
+        timings['explanation'] = time.time() - start_explanation
+
+        base_names = await asyncio.to_thread(collect_output_base_names, temp_upload_folder, code)
+        start_optimize = time.time()
+        artifact_sizes = {}
+        if deadline.allows(deadline.OPTIONAL_STAGE_SECONDS):
+            artifact_sizes = await executors.render.run_async(tracing.bind(optimize_artifacts), temp_upload_folder)
+            ledger.annotate(artifact_bytes=sum(size['after'] for size in artifact_sizes.values()))
+        else:
+            skipped.append('optimize_artifacts')
+        timings['optimize_artifacts'] = time.time() - start_optimize
+        await asyncio.to_thread(save_explanation, temp_upload_folder, explanation)
+
+        start_upload = time.time()
+        upload_files = await asyncio.to_thread(list_upload_files, temp_upload_folder)
+        uploaded_files = await upload_all(upload_files, temp_dir_name, timeout=deadline.bound(None))
+        skipped.extend(skipped_uploads(upload_files, uploaded_files))
+        uploaded_files['s3_folder'] = temp_dir_name
+        timings['upload'] = time.time() - start_upload
+
+        if base_names:
+            timings['total'] = time.time() - start_total
+            response_data = build_generate_response(
+                uploaded_files, base_names, explanation, artifact_sizes, explanation_source, timings
+            )
+            if candidates is not None:
+                response_data['candidates'] = candidate_summary(candidates)
+            if decomposition is not None:
+                response_data['decomposition'] = decomposition
+            if skipped:
+                # Partial result: optional stages that did not fit before the deadline
+                response_data['skipped'] = skipped
+                ledger.annotate(skipped=skipped)
+            return response_data, 200
+        return {'error': 'Unknown server error'}, 500
+    finally:
+        await asyncio.to_thread(release_workspaces, folders)
+
+
+async def generate_idempotent_aio(data, key):
+    """Run /generate under an Idempotency-Key. Returns (payload, status, replayed)."""
+    error = validate_key(key)
+    if error:
+        message, status = error
+        return {'error': message}, status, False
+    body_fingerprint = fingerprint(data)
+    outcome, value = await asyncio.to_thread(idempotency_store.begin, '/generate', key, body_fingerprint)
+    ledger.annotate(idempotency=outcome)
+    if outcome == LEAD:
+        payload, status = {'error': 'Internal server error'}, 500
+        try:
+            payload, status = await generate_diagram_aio(data)
+            return payload, status, False
+        finally:
+            folder = (payload.get('uploaded_files') or {}).get('s3_folder') if status == 200 else None
+            await asyncio.to_thread(
+                idempotency_store.finish, '/generate', key, body_fingerprint, payload, status, folder
+            )
+    if outcome == ATTACH:
+        try:
+            payload, status = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(value)), IDEMPOTENCY_WAIT)
+        except asyncio.TimeoutError:
+            return {'error': IN_PROGRESS_MESSAGE}, 409, False
+        return payload, status, True
+    payload, status = value
+    return payload, status, outcome == REPLAY
+
+
+# ===================
+# ASGI application
+# ===================
+async def _read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+def _cors_headers(scope):
+    # Mirror flask_cors for the natively served route
+    headers = dict(scope.get('headers') or [])
+    origin = headers.get(b'origin', b'').decode()
+    if origin in CORS_ORIGINS:
+        return [(b'access-control-allow-origin', origin.encode()), (b'vary', b'Origin')]
+    return []
+
+
+async def _send_json(send, scope, payload, status, extra_headers=()):
+    body = json.dumps(payload).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode())
+        ] + _cors_headers(scope) + list(extra_headers)
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def app(scope, receive, send):
+    """ASGI entry point: /generate runs on the event loop, everything else goes to Flask"""
+    global _in_flight
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if (ASYNC_GENERATE and scope['type'] == 'http'
+            and scope['path'] == '/generate' and scope['method'] == 'POST'):
+        body = await _read_body(receive)
+        headers = {k.decode('latin-1'): v.decode('latin-1') for k, v in scope.get('headers') or []}
+        span, token = tracing.start_root_span(
+            'http.request', headers,
+            **{'http.method': 'POST', 'http.route': '/generate', 'http.request_bytes': len(body)}
+        )
+        ledger_token = ledger.start_record(span.trace_id, '/generate')
+        deadline_token = deadline.start(deadline.parse_header(headers.get(deadline.DEADLINE_HEADER.lower())))
+        profiling.request_started()
+        _in_flight += 1
+        profile_token = None
+        if profiling.should_profile(headers.get(profiling.PROFILE_HEADER.lower())):
+            # cProfile and the sampler see the whole loop thread, not just this request
+            profile_token = profiling.start(profiling.LOOP_SCOPE, overlapping=_in_flight - 1)
+        fake_llm_token = None
+        error = None
+        status = 500
+        try:
+            try:
+                data = json.loads(body) if body else None
+            except ValueError:
+                data = None
+            fake_llm_token = fake_llm.activate(data)
+            extra_headers = [(b'x-trace-id', span.trace_id.encode())]
+            try:
+                key = headers.get(IDEMPOTENCY_HEADER.lower())
+                if key is None:
+                    payload, status = await generate_diagram_aio(data)
+                else:
+                    payload, status, replayed = await generate_idempotent_aio(data, key)
+                    if replayed:
+                        extra_headers.append((REPLAYED_HEADER.lower().encode(), b'true'))
+            except Exception as e:
+                error = e
+                payload, status = {'error': f'Internal server error: {str(e)}'}, 500
+            if profile_token is not None:
+                # Stopped on the loop thread (cProfile hooks the thread that enabled it), stored off it
+                profiler = profiling.stop(profile_token)
+                profile_token = None
+                folder = (payload.get('uploaded_files') or {}).get('s3_folder') if status == 200 else None
+                urls = await asyncio.to_thread(profiling.store, profiler, storage, folder, span.trace_id)
+                ledger.annotate(profiled=urls is not None, profile_overlapping_requests=profiler.overlapping)
+                if urls is not None:
+                    payload = dict(payload, profile=urls, profile_scope=profiler.scope,
+                                   profile_overlapping_requests=profiler.overlapping)
+            span.set_attribute('http.status_code', status)
+            await _send_json(send, scope, payload, status, extra_headers)
+        finally:
+            _in_flight -= 1
+            if profile_token is not None:
+                profiling.stop(profile_token)  # the request failed before its profile was stored
+            if fake_llm_token is not None:
+                fake_llm.deactivate(fake_llm_token)
+            deadline.finish(deadline_token)
+            record = ledger.close_record(ledger_token, status, error=error)
+            tracing.end_root_span(span, token, error=error)
+            # Appending may rotate the ledger and ship it to storage
+            await asyncio.to_thread(ledger.append_record, request_ledger, record)
+        return
+
+    await wsgi_app(scope, receive, send)
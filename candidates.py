@@ -0,0 +1,205 @@
+# Speculative code candidates for /generate.
+# Opt-in with "candidates": N (or CODEGEN_CANDIDATES). The code model returns N completions
+# from one call, so the prompt is billed once. Each candidate is checked, sanitized and
+# rendered in its own workspace concurrently; the first clean render wins and the other
+# render processes are killed. A candidate that fails to render then costs nothing but
+# its tokens, instead of a failed request and a full retry of the pipeline.
+import os
+import subprocess
+import concurrent.futures
+
+import executors
+from node_catalog import unknown_node_message
+from pipeline import (
+    non_code_response_message, sanitize_code, save_inputs, render_setup, render_failure_payload, RENDER_TIMEOUT
+)
+
+# ===================
+# Configuration
+# ===================
+# CODEGEN_CANDIDATES: candidates per request when the request does not say (1 = no speculation)
+# CODEGEN_MAX_CANDIDATES: upper bound for the per-request "candidates" field
+# CANDIDATE_MAX_TOKENS: completion tokens each candidate may use
+# CANDIDATE_TOKEN_BUDGET: completion tokens all candidates of one request may use together;
+#   requests for more candidates than fit are rejected
+# CANDIDATE_TEMPERATURE: sampling temperature (at 0 every candidate would be the same program)
+CODEGEN_CANDIDATES = int(os.environ.get('CODEGEN_CANDIDATES', '1'))
+CODEGEN_MAX_CANDIDATES = int(os.environ.get('CODEGEN_MAX_CANDIDATES', '4'))
+CANDIDATE_MAX_TOKENS = int(os.environ.get('CANDIDATE_MAX_TOKENS', '8000'))
+CANDIDATE_TOKEN_BUDGET = int(os.environ.get('CANDIDATE_TOKEN_BUDGET', '24000'))
+CANDIDATE_TEMPERATURE = float(os.environ.get('CANDIDATE_TEMPERATURE', '0.7'))
+
+INVALID_CODE_MESSAGE = 'Diagram code execution failed due to invalid or non-Python code.'
+
+
+def candidate_limit():
+    """Most candidates a request may ask for: CODEGEN_MAX_CANDIDATES, lowered to fit CANDIDATE_TOKEN_BUDGET"""
+    return max(1, min(CODEGEN_MAX_CANDIDATES, CANDIDATE_TOKEN_BUDGET // CANDIDATE_MAX_TOKENS))
+
+
+def read_candidates(data):
+    """Return (count, error) for the optional candidates field, error as (message, status).
+
+    Counts above candidate_limit() are rejected rather than quietly lowered; the server
+    default (CODEGEN_CANDIDATES) is lowered to it.
+    """
+    limit = candidate_limit()
+    if 'candidates' not in (data or {}):
+        return max(1, min(CODEGEN_CANDIDATES, limit)), None
+    count = data['candidates']
+    if isinstance(count, bool) or not isinstance(count, int) or not 1 <= count <= limit:
+        return None, (f'candidates must be an integer from 1 to {limit}.', 400)
+    return count, None
+
+
+class Candidate:
+    """One generated program and the workspace it is rendered in"""
+
+    def __init__(self, index, raw_code):
+        self.index = index
+        self.raw_code = raw_code
+        self.code = sanitize_code(raw_code)
+        self.error = check_candidate(raw_code, self.code)  # set when rejected before rendering
+        self.name = None
+        self.folder = None
+        self.result = None  # (returncode, stdout, stderr); returncode None if the render did not finish
+        self.cancelled = False
+        self.won = False
+
+    @property
+    def status(self):
+        if self.won:
+            return 'won'
+        if self.error:
+            return 'rejected'
+        if self.cancelled:
+            return 'cancelled'
+        if self.result is None:
+            return 'pending'
+        return 'rendered' if self.result[0] == 0 else 'failed'
+
+
+def check_candidate(raw_code, code):
+    """Return why a candidate is not worth rendering, or None"""
+    message = non_code_response_message(raw_code)
+    if message:
+        return message
+    try:
+        compile(code, 'generated_diagram.py', 'exec')
+    except SyntaxError:
+        return INVALID_CODE_MESSAGE
+    return unknown_node_message(code)
+
+
+def prepare_candidates(workspace, prefix, codes, original_description, rewritten_description):
+    """Check every candidate and write the ones worth rendering to their own workspace"""
+    candidates = [Candidate(index, code) for index, code in enumerate(codes)]
+    for candidate in candidates:
+        if candidate.error:
+            continue
+        candidate.name, candidate.folder = workspace.allocate(prefix)
+        with open(os.path.join(candidate.folder, 'generated_diagram_raw.py'), 'w') as f:
+            f.write(candidate.raw_code)
+        try:
+            save_inputs(candidate.folder, original_description, rewritten_description)
+        except Exception as e:
+            print(f"Warning: Failed to save input descriptions: {str(e)}")
+        with open(os.path.join(candidate.folder, 'generated_diagram.py'), 'w') as f:
+            f.write(candidate.code)
+    return candidates
+
+
+def common_code(candidates):
+    """The code the winner will render if every renderable candidate is the same program, else None.
+    The explanation of that code can then start before the race, as with a single candidate."""
+    codes = {c.code for c in candidates if c.folder is not None}
+    return codes.pop() if len(codes) == 1 else None
+
+
+def _wait(proc, timeout):
+    try:
+        stdout, stderr = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        stdout, stderr = proc.communicate()
+        return None, stdout, f'Render timed out after {timeout} seconds'
+    return proc.returncode, stdout, stderr
+
+
+def render_first_success(candidates, timeout=RENDER_TIMEOUT, layout='auto'):
+    """Render the prepared candidates concurrently. Returns the first that renders cleanly, or None.
+
+    Renders still running when a winner is found are killed and marked cancelled.
+    """
+    runnable = [c for c in candidates if c.folder is not None]
+    if not runnable:
+        return None
+    procs = {}
+    winner = None
+    pending = {}
+    try:
+        for candidate in runnable:
+            argv, env = render_setup(candidate.folder, timeout, layout)
+            procs[candidate.index] = subprocess.Popen(
+                argv, cwd=candidate.folder, env=env,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+            )
+        # Waiting threads come from the shared render pool; when it is saturated a wait runs
+        # in this thread instead, which only delays noticing the winner
+        pending = {executors.render.submit_or_run(_wait, procs[c.index], timeout): c for c in runnable}
+        while pending and winner is None:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            # Lowest index first when several finish together, so results are deterministic
+            for future in sorted(done, key=lambda f: pending[f].index):
+                candidate = pending.pop(future)
+                candidate.result = future.result()
+                if winner is None and candidate.result[0] == 0:
+                    winner = candidate
+                    winner.won = True
+        for candidate in pending.values():
+            candidate.cancelled = True
+    finally:
+        # Killing makes the pool threads' communicate() return, so no worker stays blocked
+        for proc in procs.values():
+            if proc.poll() is None:
+                proc.kill()
+        concurrent.futures.wait(pending)
+    return winner
+
+
+def reported_failure(candidates):
+    """The candidate whose failure is reported when none rendered: the first one that was rendered"""
+    for candidate in candidates:
+        if candidate.result is not None:
+            return candidate
+    return None
+
+
+def candidate_failure_payload(candidates, raw_code_url, sanitized_code_url):
+    """Build the (payload, status) for a request where no candidate rendered"""
+    candidate = reported_failure(candidates)
+    if candidate is None:
+        payload, status = {'error': candidates[0].error}, 422
+    elif candidate.result[0] is None:
+        payload, status = {'error': f'Diagram execution error: {candidate.result[2]}'}, 500
+    else:
+        returncode, stdout, stderr = candidate.result
+        payload, status = render_failure_payload(
+            stdout, stderr, candidate.folder, candidate.code, raw_code_url, sanitized_code_url
+        )
+    payload['candidates'] = candidate_summary(candidates)
+    return payload, status
+
+
+def discard_candidates(workspace, candidates, keep=None):
+    """Delete the workspaces of every candidate except keep. Returns the released folders."""
+    released = []
+    for candidate in candidates:
+        if candidate.folder is not None and candidate is not keep:
+            workspace.release(candidate.folder, retain=False)
+            released.append(candidate.folder)
+    return released
+
+
+def candidate_summary(candidates):
+    return [{'index': c.index, 'status': c.status} for c in candidates]
@@ -0,0 +1,11 @@
+import os
+import tempfile
+
+# Run the test suite against the in-memory artifact storage: no S3 bucket or network needed
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+
+# Keep ledger records out of the working tree
+os.environ.setdefault('LEDGER_DIR', tempfile.mkdtemp(prefix='ledger-'))
+
+# Delete request workspaces when requests finish instead of retaining them under diagrams/
+os.environ.setdefault('WORKSPACE_RETAIN', '0')
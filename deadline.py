@@ -0,0 +1,161 @@
+# Request-scoped deadlines and cancellation.
+# A request's deadline is the earliest of: the Lambda invocation's remaining time, the
+# client's X-Request-Timeout header and REQUEST_TIMEOUT. Stages bound their own timeouts
+# by it, optional stages are skipped when they no longer fit, and work that depends on
+# the request (explanation threads, LLM calls) stops once the request has finished.
+# The deadline travels in a contextvar, so tracing.bind carries it into worker threads.
+import os
+import time
+import asyncio
+import threading
+import contextvars
+
+# ===================
+# Configuration
+# ===================
+# REQUEST_TIMEOUT: default seconds per request when neither Lambda nor the client sets one (unset: none)
+# DEADLINE_RESERVE: seconds kept back from the deadline for uploading artifacts and responding
+# DEADLINE_MARGIN: seconds taken off the Lambda remaining time so a response is still sent
+REQUEST_TIMEOUT = float(os.environ['REQUEST_TIMEOUT']) if os.environ.get('REQUEST_TIMEOUT') else None
+DEADLINE_RESERVE = float(os.environ.get('DEADLINE_RESERVE', '3'))
+DEADLINE_MARGIN = float(os.environ.get('DEADLINE_MARGIN', '1'))
+
+DEADLINE_HEADER = 'X-Request-Timeout'  # seconds the client is willing to wait
+DEADLINE_MESSAGE = 'The request deadline was reached before the diagram was finished.'
+
+# Rough cost of an optional stage (artifact optimization); it is skipped when this no longer fits
+OPTIONAL_STAGE_SECONDS = 2.0
+
+
+class DeadlineExceeded(Exception):
+    """The request's deadline passed, or the request already finished"""
+
+
+class _Scope:
+    def __init__(self, at):
+        self.at = at  # time.monotonic() value, or None for no deadline
+        self.cancelled = threading.Event()
+
+
+_scope = contextvars.ContextVar('deadline', default=None)
+
+# Lambda runs one invocation per container at a time, so the handler can set this globally
+_invocation_deadline = None
+
+
+def set_invocation_deadline(context):
+    """Record the Lambda invocation's end time from its context (None clears it)"""
+    global _invocation_deadline
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        _invocation_deadline = None
+    else:
+        _invocation_deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN
+
+
+def parse_header(value):
+    """Seconds from the X-Request-Timeout header, or None if absent or not a positive number"""
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        return None
+    return seconds if seconds > 0 else None
+
+
+def start(timeout=None):
+    """Open the deadline scope of a request. Returns a token for finish()."""
+    now = time.monotonic()
+    candidates = [at for at in (
+        _invocation_deadline,
+        now + timeout if timeout else None,
+        now + REQUEST_TIMEOUT if REQUEST_TIMEOUT else None,
+    ) if at is not None]
+    return _scope.set(_Scope(min(candidates) if candidates else None))
+
+
+def finish(token):
+    """Close the request's scope: dependent work still running in it is cancelled"""
+    scope = _scope.get()
+    if scope is not None:
+        scope.cancelled.set()
+    try:
+        _scope.reset(token)
+    except ValueError:
+        _scope.set(None)  # reset from a different context (e.g. Flask teardown)
+
+
+def cancel():
+    """Cancel dependent work of the current request, e.g. when returning an error early"""
+    scope = _scope.get()
+    if scope is not None:
+        scope.cancelled.set()
+
+
+def detached(fn):
+    """Wrap fn (a function or coroutine function) to run outside the request's deadline,
+    for work meant to outlive the request"""
+    if asyncio.iscoroutinefunction(fn):
+        async def run_async(*args, **kwargs):
+            token = _scope.set(None)
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                _scope.reset(token)
+        return run_async
+
+    def run(*args, **kwargs):
+        token = _scope.set(None)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _scope.reset(token)
+    return run
+
+
+def remaining():
+    """Seconds left before the deadline, or None if the request has none"""
+    scope = _scope.get()
+    if scope is None or scope.at is None:
+        return None
+    return scope.at - time.monotonic()
+
+
+def check():
+    """Raise DeadlineExceeded if the request's deadline passed or the request was cancelled"""
+    scope = _scope.get()
+    if scope is None:
+        return
+    if scope.cancelled.is_set():
+        raise DeadlineExceeded('Request already finished')
+    if scope.at is not None and time.monotonic() >= scope.at:
+        raise DeadlineExceeded('Request deadline exceeded')
+
+
+def bound(timeout, reserve=0.0):
+    """timeout capped by the time left (minus reserve); never below zero"""
+    left = remaining()
+    if left is None:
+        return timeout
+    left = max(0.0, left - reserve)
+    return left if timeout is None else min(timeout, left)
+
+
+def allows(seconds, reserve=DEADLINE_RESERVE):
+    """True if a stage expected to take seconds still fits before the deadline minus reserve"""
+    left = remaining()
+    return left is None or left - reserve >= seconds
+
+
+def is_exceeded(error=None):
+    """True if error came from the deadline, or the deadline is (nearly) up"""
+    if isinstance(error, DeadlineExceeded):
+        return True
+    left = remaining()
+    return left is not None and left <= DEADLINE_RESERVE
+
+
+def stage_timeout(timeout, minimum=1.0):
+    """Timeout for a required stage, leaving DEADLINE_RESERVE. Raises DeadlineExceeded if less than minimum is left."""
+    bounded = bound(timeout, reserve=DEADLINE_RESERVE)
+    if bounded is not None and bounded < minimum:
+        raise DeadlineExceeded('Not enough time left before the request deadline')
+    return bounded
@@ -0,0 +1,283 @@
+# Decomposition of large descriptions into sub-diagrams.
+# A description near the length limit means one huge prompt and one very long code
+# completion. In decompose mode the model first splits the description into subsystems
+# (a short JSON plan), code for each subsystem is generated in parallel, and the
+# programs are merged locally with ast into a single Diagram: one Cluster per subsystem,
+# cross-subsystem edges resolved by node label. Completion latency then follows the
+# largest subsystem instead of the whole diagram.
+import os
+import re
+import ast
+import json
+import asyncio
+
+import tracing
+import executors
+from llm_providers import (
+    generate_code_openai, generate_code_openai_async,
+    generate_decomposition_openai, generate_decomposition_openai_async
+)
+
+# ===================
+# Configuration
+# ===================
+# DECOMPOSE_MODE: default when a request does not set "decompose":
+#   off    - always generate the whole description at once
+#   auto   - decompose descriptions of at least DECOMPOSE_MIN_CHARS characters
+#   always - decompose every description
+# DECOMPOSE_MIN_CHARS: description length (after rewriting) from which auto decomposes
+DECOMPOSE_MODES = ('off', 'auto', 'always')
+DEFAULT_DECOMPOSE_MODE = os.environ.get('DECOMPOSE_MODE', 'off').lower()
+DECOMPOSE_MIN_CHARS = int(os.environ.get('DECOMPOSE_MIN_CHARS', '6000'))
+DECOMPOSE_MAX_SUBSYSTEMS = 8
+
+DECOMPOSE_INSTRUCTIONS_FILE = 'instructions/decompose/instructions_decompose.md'
+
+# Imported by the merged program itself; subsystem imports of these are dropped
+MERGED_DIAGRAM_IMPORTS = ('Cluster', 'Diagram', 'Edge')
+
+
+class DecompositionError(ValueError):
+    """The plan was unusable or the subsystem programs could not be merged"""
+
+
+def read_decompose_mode(data):
+    """Return (mode, error) for the optional decompose field, error as (message, status)"""
+    mode = (data or {}).get('decompose') or DEFAULT_DECOMPOSE_MODE
+    if not isinstance(mode, str) or mode.strip().lower() not in DECOMPOSE_MODES:
+        return None, (f"decompose must be one of: {', '.join(DECOMPOSE_MODES)}.", 400)
+    return mode.strip().lower(), None
+
+
+def should_decompose(mode, description):
+    return mode == 'always' or (mode == 'auto' and len(description) >= DECOMPOSE_MIN_CHARS)
+
+
+def _normalize_label(label):
+    return re.sub(r'\s+', ' ', label).strip().lower()
+
+
+# ===================
+# Plan
+# ===================
+def parse_plan(text):
+    """Validate the model's JSON plan. Returns {'title', 'subsystems', 'connections'}."""
+    match = re.search(r'```(?:json)?(.*?)```', text, re.DOTALL | re.IGNORECASE)
+    try:
+        plan = json.loads(match.group(1) if match else text)
+    except ValueError as e:
+        raise DecompositionError(f'plan is not valid JSON: {e}')
+    subsystems = plan.get('subsystems') if isinstance(plan, dict) else None
+    if not isinstance(subsystems, list) or not 2 <= len(subsystems) <= DECOMPOSE_MAX_SUBSYSTEMS:
+        raise DecompositionError(f'plan must have 2 to {DECOMPOSE_MAX_SUBSYSTEMS} subsystems')
+    cleaned = []
+    for subsystem in subsystems:
+        if (not isinstance(subsystem, dict) or not isinstance(subsystem.get('name'), str)
+                or not isinstance(subsystem.get('description'), str) or not subsystem['description'].strip()):
+            raise DecompositionError('every subsystem needs a name and a description')
+        nodes = subsystem.get('nodes') if isinstance(subsystem.get('nodes'), list) else []
+        cleaned.append({
+            'name': subsystem['name'].strip() or 'Subsystem',
+            'description': subsystem['description'].strip(),
+            'nodes': [n for n in nodes if isinstance(n, str) and n.strip()],
+        })
+    connections = []
+    for connection in plan.get('connections') or []:
+        if isinstance(connection, dict) and isinstance(connection.get('from'), str) and isinstance(connection.get('to'), str):
+            label = connection.get('label')
+            connections.append({
+                'from': connection['from'],
+                'to': connection['to'],
+                'label': label if isinstance(label, str) and label.strip() else None,
+            })
+    title = plan.get('title') if isinstance(plan.get('title'), str) and plan['title'].strip() else 'Architecture'
+    return {'title': title.strip(), 'subsystems': cleaned, 'connections': connections}
+
+
+def subsystem_prompt(plan, subsystem):
+    """Description handed to the code model for one subsystem"""
+    lines = [
+        f'Draw only the "{subsystem["name"]}" subsystem of the "{plan["title"]}" architecture.',
+        'Do not draw components of other subsystems and do not add a cluster named after this subsystem; '
+        'it is placed in one when the subsystems are combined.',
+    ]
+    if subsystem['nodes']:
+        lines.append('Assign each of these components to its own variable and use exactly these labels: '
+                     + ', '.join(f'"{n}"' for n in subsystem['nodes']) + '.')
+    return '\n'.join(lines) + '\n\n' + subsystem['description']
+
+
+# ===================
+# Merge
+# ===================
+class _Renamer(ast.NodeTransformer):
+    def __init__(self, names):
+        self.names = names
+
+    def visit_Name(self, node):
+        if node.id in self.names:
+            node.id = self.names[node.id]
+        return node
+
+
+def _call_name(call):
+    if isinstance(call.func, ast.Name):
+        return call.func.id
+    if isinstance(call.func, ast.Attribute):
+        return call.func.attr
+    return None
+
+
+def _diagram_block(tree):
+    for stmt in tree.body:
+        if isinstance(stmt, ast.With) and any(
+            isinstance(item.context_expr, ast.Call) and _call_name(item.context_expr) == 'Diagram'
+            for item in stmt.items
+        ):
+            return stmt
+    return None
+
+
+def _node_label(call):
+    if call.args and isinstance(call.args[0], ast.Constant) and isinstance(call.args[0].value, str):
+        return call.args[0].value
+    for kw in call.keywords:
+        if kw.arg == 'label' and isinstance(kw.value, ast.Constant) and isinstance(kw.value.value, str):
+            return kw.value.value
+    return None
+
+
+def merge_subsystems(plan, codes):
+    """Merge one program per subsystem into a single diagram program.
+
+    Returns (code, report). Raises DecompositionError if a program has no `with Diagram(...)` block.
+    """
+    imported = {}        # local name -> (module, name) across all subsystems
+    import_stmts = []
+    plain_imports = {}   # ast dump -> `import x` statement
+    preamble = []        # module-level statements other than imports, e.g. graph_attr dicts
+    clusters = []
+    labels = {}          # normalized node label -> variable in the merged program
+
+    for index, (subsystem, code) in enumerate(zip(plan['subsystems'], codes)):
+        try:
+            tree = ast.parse(code)
+        except SyntaxError as e:
+            raise DecompositionError(f'subsystem "{subsystem["name"]}" is not valid Python: {e}')
+        diagram = _diagram_block(tree)
+        if diagram is None:
+            raise DecompositionError(f'subsystem "{subsystem["name"]}" has no `with Diagram(...)` block')
+
+        # Variables get a per-subsystem prefix so subsystems can't overwrite each other's nodes
+        prefix = f's{index}_'
+        renames = {
+            n.id: prefix + n.id for n in ast.walk(tree) if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Store)
+        }
+        module_stmts = []
+        for stmt in tree.body:
+            if isinstance(stmt, ast.ImportFrom) and stmt.module and stmt.module.split('.')[0] == 'diagrams':
+                names = []
+                for alias in stmt.names:
+                    local = alias.asname or alias.name
+                    if stmt.module == 'diagrams' and alias.name in MERGED_DIAGRAM_IMPORTS:
+                        continue
+                    if imported.get(local, (stmt.module, alias.name)) != (stmt.module, alias.name):
+                        renames[local] = f'{local}_{index}'  # same name, different class
+                        local = renames[local]
+                    if local not in imported:
+                        imported[local] = (stmt.module, alias.name)
+                        names.append(ast.alias(name=alias.name, asname=local if local != alias.name else None))
+                if names:
+                    import_stmts.append(ast.ImportFrom(module=stmt.module, names=names, level=0))
+            elif isinstance(stmt, ast.Import):
+                plain_imports.setdefault(ast.dump(stmt), stmt)
+            elif stmt is not diagram:
+                module_stmts.append(stmt)
+
+        # Node labels, for resolving connections between subsystems
+        for stmt in ast.walk(diagram):
+            if (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and isinstance(stmt.targets[0], ast.Name)
+                    and isinstance(stmt.value, ast.Call)):
+                label = _node_label(stmt.value)
+                if label:
+                    labels.setdefault(_normalize_label(label), renames.get(stmt.targets[0].id, stmt.targets[0].id))
+
+        renamer = _Renamer(renames)
+        preamble.extend(renamer.visit(stmt) for stmt in module_stmts)
+        body = [renamer.visit(stmt) for stmt in diagram.body]
+        clusters.append(ast.With(
+            items=[ast.withitem(
+                context_expr=ast.Call(func=ast.Name(id='Cluster', ctx=ast.Load()),
+                                      args=[ast.Constant(value=subsystem['name'])], keywords=[]),
+                optional_vars=None
+            )],
+            body=body or [ast.Pass()]
+        ))
+
+    edges = []
+    unresolved = []
+    for connection in plan['connections']:
+        src = labels.get(_normalize_label(connection['from']))
+        dst = labels.get(_normalize_label(connection['to']))
+        if src is None or dst is None:
+            unresolved.append(f"{connection['from']} -> {connection['to']}")
+            continue
+        edge = f' >> Edge(label={connection["label"]!r}) >> ' if connection['label'] else ' >> '
+        edges.extend(ast.parse(f'{src}{edge}{dst}').body)
+
+    diagram = ast.parse(
+        f'with Diagram({plan["title"]!r}, outformat=["png", "svg"], direction="TB"):\n    pass'
+    ).body[0]
+    diagram.body = clusters + edges
+    module = ast.Module(
+        body=ast.parse(f'from diagrams import {", ".join(MERGED_DIAGRAM_IMPORTS)}').body
+             + list(plain_imports.values()) + import_stmts + preamble + [diagram],
+        type_ignores=[]
+    )
+    code = ast.unparse(ast.fix_missing_locations(module))
+    report = {
+        'subsystems': [s['name'] for s in plan['subsystems']],
+        'connections': len(edges),
+        'unresolved_connections': unresolved,
+    }
+    return code, report
+
+
+# ===================
+# Generation
+# ===================
+def _read_instructions():
+    with open(DECOMPOSE_INSTRUCTIONS_FILE, 'r') as f:
+        return f.read()
+
+
+def generate_decomposed(description, instructions):
+    """Plan, generate every subsystem in parallel and merge. Returns (code, report).
+
+    Raises DecompositionError when the plan or the merge fails, so the caller can fall back
+    to generating the whole description at once. LLM errors propagate unchanged.
+    """
+    with tracing.span('decompose.plan', description_bytes=len(description)):
+        plan = parse_plan(generate_decomposition_openai(description, _read_instructions()))
+        tracing.set_attribute('subsystems', len(plan['subsystems']))
+    with tracing.span('decompose.codegen', subsystems=len(plan['subsystems'])):
+        futures = [
+            executors.llm.submit_or_run(tracing.bind(generate_code_openai), subsystem_prompt(plan, s), instructions)
+            for s in plan['subsystems']
+        ]
+        codes = [future.result() for future in futures]
+    with tracing.span('decompose.merge'):
+        return merge_subsystems(plan, codes)
+
+
+async def generate_decomposed_aio(description, instructions):
+    """Coroutine version of generate_decomposed for the async request path"""
+    with tracing.span('decompose.plan', description_bytes=len(description)):
+        plan = parse_plan(await generate_decomposition_openai_async(description, _read_instructions()))
+        tracing.set_attribute('subsystems', len(plan['subsystems']))
+    with tracing.span('decompose.codegen', subsystems=len(plan['subsystems'])):
+        codes = await asyncio.gather(*(
+            generate_code_openai_async(subsystem_prompt(plan, s), instructions) for s in plan['subsystems']
+        ))
+    with tracing.span('decompose.merge'):
+        return merge_subsystems(plan, codes)
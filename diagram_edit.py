@@ -0,0 +1,73 @@
+import ast
+import re
+
+# Edit blocks returned by the model for POST /generate/<id>/edit
+_EDIT_BLOCK_RE = re.compile(
+    r'<{5,9} SEARCH\n(.*?)\n?={5,9}\n(.*?)\n?>{5,9} REPLACE',
+    re.DOTALL
+)
+
+
+class EditError(ValueError):
+    """Raised when a model patch cannot be applied to the current code"""
+
+
+def parse_edit_blocks(text):
+    """Parse SEARCH/REPLACE blocks into a list of (search, replace) pairs"""
+    return [(m.group(1), m.group(2)) for m in _EDIT_BLOCK_RE.finditer(text or '')]
+
+
+def _find_loose(code_lines, search_lines):
+    """Find search_lines in code_lines ignoring trailing whitespace. Returns the start index or -1."""
+    target = [l.rstrip() for l in search_lines]
+    stripped = [l.rstrip() for l in code_lines]
+    matches = [
+        i for i in range(len(stripped) - len(target) + 1)
+        if stripped[i:i + len(target)] == target
+    ]
+    return matches[0] if len(matches) == 1 else -1
+
+
+def apply_edit_blocks(code, blocks):
+    """Apply (search, replace) pairs in order. Raises EditError if a block does not match exactly once."""
+    if not blocks:
+        raise EditError('The model did not return any edit blocks.')
+    for search, replace in blocks:
+        if not search.strip():
+            raise EditError('Edit block has an empty SEARCH section.')
+        count = code.count(search)
+        if count == 1:
+            code = code.replace(search, replace, 1)
+            continue
+        if count > 1:
+            raise EditError(f'Edit block matches {count} places: {search.splitlines()[0]!r}')
+        # Fall back to a line-based match that tolerates trailing whitespace differences
+        code_lines = code.splitlines()
+        search_lines = search.splitlines()
+        start = _find_loose(code_lines, search_lines)
+        if start < 0:
+            raise EditError(f'Edit block does not match the current code: {search.splitlines()[0]!r}')
+        code_lines[start:start + len(search_lines)] = replace.splitlines()
+        code = '\n'.join(code_lines) + '\n'
+    return code
+
+
+class _StripStrings(ast.NodeTransformer):
+    def visit_Constant(self, node):
+        if isinstance(node.value, str):
+            return ast.copy_location(ast.Constant(value=''), node)
+        return node
+
+
+def is_cosmetic_change(old_code, new_code):
+    """True if the edit only changed string literals (labels, colours, titles).
+
+    Nodes, imports, clusters and edges are identical, so the explanation of the
+    previous version still describes the new diagram.
+    """
+    try:
+        old_tree = _StripStrings().visit(ast.parse(old_code))
+        new_tree = _StripStrings().visit(ast.parse(new_code))
+    except SyntaxError:
+        return False
+    return ast.dump(old_tree) == ast.dump(new_tree)
@@ -0,0 +1,156 @@
+# Process-wide thread pools, one per workload.
+# Requests used to create their own pools (one for the explanation, ten upload threads,
+# one thread per candidate render or decomposed subsystem) and tear them down again, so
+# the thread count grew with request concurrency. These long-lived pools keep it flat:
+#   llm         LLM calls made alongside other work (explanations, decomposed subsystems)
+#   enrichment  hybrid-mode LLM explanations that outlive their request
+#   upload      artifact uploads and presigning
+#   render      threads waiting on candidate render subprocesses, and artifact optimization
+# Each pool accepts at most workers + EXECUTOR_QUEUE_SIZE unfinished tasks. Past that,
+# submit_or_run() runs the task in the caller's thread (back-pressure instead of an
+# unbounded queue), submit() raises ExecutorBusy for work that can be dropped, and
+# run_async() (the asyncio path, which must not run blocking work inline) waits for a slot.
+# /health reports active workers, queue depth and queue wait per pool under "executors".
+import os
+import time
+import asyncio
+import threading
+import collections
+import concurrent.futures
+
+from ledger import percentiles
+
+# ===================
+# Configuration
+# ===================
+# EXECUTOR_LLM_WORKERS: threads for LLM calls made alongside other work
+# EXECUTOR_ENRICHMENT_WORKERS: threads for hybrid-mode explanations that outlive their request
+# EXECUTOR_UPLOAD_WORKERS: threads for artifact uploads
+# EXECUTOR_RENDER_WORKERS: threads waiting on candidate render subprocesses and optimizing artifacts
+# EXECUTOR_QUEUE_SIZE: tasks each pool queues beyond its busy workers before callers run them inline
+EXECUTOR_LLM_WORKERS = int(os.environ.get('EXECUTOR_LLM_WORKERS', '16'))
+EXECUTOR_ENRICHMENT_WORKERS = int(os.environ.get('EXECUTOR_ENRICHMENT_WORKERS', '4'))
+EXECUTOR_UPLOAD_WORKERS = int(os.environ.get('EXECUTOR_UPLOAD_WORKERS', '16'))
+EXECUTOR_RENDER_WORKERS = int(os.environ.get('EXECUTOR_RENDER_WORKERS', '8'))
+EXECUTOR_QUEUE_SIZE = int(os.environ.get('EXECUTOR_QUEUE_SIZE', '64'))
+
+# Queue waits kept per pool for the percentiles in stats()
+WAIT_SAMPLES = 1000
+
+
+class ExecutorBusy(Exception):
+    """The pool's workers are busy and its queue is full"""
+
+
+class BoundedExecutor:
+    """A named thread pool that refuses work beyond workers + max_queue unfinished tasks"""
+
+    def __init__(self, name, max_workers, max_queue=EXECUTOR_QUEUE_SIZE):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        self._waits = collections.deque(maxlen=WAIT_SAMPLES)
+        self._counts = {'submitted': 0, 'completed': 0, 'cancelled': 0, 'rejected': 0, 'inline': 0}
+        self._active = 0
+        self._queued = 0
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedule fn(*args, **kwargs). Raises ExecutorBusy when the queue is full."""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._counts['rejected'] += 1
+            raise ExecutorBusy(f'{self.name} executor is busy')
+        return self._submit(time.monotonic(), fn, args, kwargs)
+
+    async def run_async(self, fn, *args):
+        """Await fn(*args) on this pool from a coroutine.
+
+        A full queue does not block the event loop: the coroutine polls for a free slot, and
+        that time counts as queue wait. Callers bind their context (tracing.bind) if fn needs it.
+        """
+        queued_at = time.monotonic()
+        delay = 0.005
+        while not self._slots.acquire(blocking=False):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+        return await asyncio.wrap_future(self._submit(queued_at, fn, args, {}))
+
+    def _submit(self, queued_at, fn, args, kwargs):
+        """Schedule fn on the pool; the caller holds one of its slots"""
+        started = []
+
+        def run():
+            with self._lock:
+                self._queued -= 1
+                self._active += 1
+                self._waits.append(time.monotonic() - queued_at)
+            started.append(True)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    self._counts['completed'] += 1
+
+        def release(future):
+            if not started:
+                # Cancelled while still queued
+                with self._lock:
+                    self._queued -= 1
+                    self._counts['cancelled'] += 1
+            self._slots.release()
+
+        with self._lock:
+            self._queued += 1
+            self._counts['submitted'] += 1
+        try:
+            future = self._pool.submit(run)
+        except BaseException:
+            with self._lock:
+                self._queued -= 1
+            self._slots.release()
+            raise
+        future.add_done_callback(release)
+        return future
+
+    def submit_or_run(self, fn, *args, **kwargs):
+        """Like submit, but a full queue runs fn in the calling thread and returns its finished future"""
+        try:
+            return self.submit(fn, *args, **kwargs)
+        except ExecutorBusy:
+            pass
+        with self._lock:
+            self._counts['inline'] += 1
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                self._counts,
+                workers=self.max_workers,
+                queue_limit=self.max_queue,
+                active=self._active,
+                queued=self._queued,
+                wait=percentiles(self._waits),
+            )
+
+
+llm = BoundedExecutor('llm', EXECUTOR_LLM_WORKERS)
+enrichment = BoundedExecutor('enrichment', EXECUTOR_ENRICHMENT_WORKERS)
+upload = BoundedExecutor('upload', EXECUTOR_UPLOAD_WORKERS)
+render = BoundedExecutor('render', EXECUTOR_RENDER_WORKERS)
+
+EXECUTORS = (llm, enrichment, upload, render)
+
+
+def stats():
+    """Per-pool counters, active workers, queue depth and queue-wait percentiles"""
+    return {executor.name: executor.stats() for executor in EXECUTORS}
@@ -0,0 +1,64 @@
+# LLM explanations keyed by the code they explain.
+# /generate, edits and /explain used to pay for the explanation (a rewrite call and an
+# explanation call) every time, even for code explained moments earlier. Explanations are
+# now kept in the artifact storage, so every instance sees them:
+#   explanations/<sha256 of normalized code>/<provider or none>.md
+# The code is normalized before hashing: sanitized like a render (output filename, format,
+# show=False, fixed imports), then reduced to its tokens, so comments, blank lines and
+# whitespace do not change the key.
+# Entries are never expired here. The local backend counts explanations/ toward
+# ARTIFACT_LOCAL_QUOTA_BYTES and evicts the oldest entries with job folders, the memory backend (tests
+# and benchmarks) keeps them for the life of the process, and on S3 a lifecycle rule on the
+# explanations/ prefix should bound them.
+import io
+import re
+import hashlib
+import tokenize
+
+from pipeline import normalize_render_code
+
+EXPLANATION_PREFIX = 'explanations/'
+
+# Tokens that carry no meaning for the explanation
+_SKIPPED_TOKENS = {tokenize.COMMENT, tokenize.NL, tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT,
+                   tokenize.ENCODING, tokenize.ENDMARKER}
+
+
+def normalize_code(code):
+    """The code's tokens without comments, blank lines or spacing; collapsed whitespace if it does not tokenize"""
+    code, _ = normalize_render_code(code)  # sanitize_code without its logging and ledger note
+    try:
+        tokens = [tok.string for tok in tokenize.generate_tokens(io.StringIO(code).readline)
+                  if tok.type not in _SKIPPED_TOKENS]
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        return re.sub(r'\s+', ' ', code).strip()
+    return ' '.join(tokens)
+
+
+def code_hash(code):
+    return hashlib.sha256(normalize_code(code).encode()).hexdigest()
+
+
+class ExplanationStore:
+    def __init__(self, storage):
+        self.storage = storage
+
+    def _key(self, digest, provider):
+        return f'{EXPLANATION_PREFIX}{digest}/{provider or "none"}.md'
+
+    def get(self, code, provider, digest=None):
+        """The stored explanation of code for provider, or None"""
+        try:
+            data = self.storage.get_bytes(self._key(digest or code_hash(code), provider))
+        except Exception as e:
+            print(f"Warning: Failed to read stored explanation: {str(e)}")
+            return None
+        return data.decode() if data else None
+
+    def put(self, code, provider, explanation, digest=None):
+        if not explanation:
+            return
+        try:
+            self.storage.put_bytes(explanation.encode(), self._key(digest or code_hash(code), provider))
+        except Exception as e:
+            print(f"Warning: Failed to store explanation: {str(e)}")
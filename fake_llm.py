@@ -0,0 +1,59 @@
+# Canned LLM responses for load tests (replay.py --fake-llm).
+# With FAKE_LLM=1 a request may carry a "fake_llm" object; its LLM calls then return the
+# canned text for their pipeline stage instead of calling OpenAI, so a load test measures
+# rendering, storage and the server itself without spending tokens:
+#   {"fake_llm": {"rewrite": "...", "code": "...", "explanation": "...", "delay": 0.5}}
+# Never enable FAKE_LLM on a deployment that serves users.
+import os
+import contextvars
+from types import SimpleNamespace
+
+# ===================
+# Configuration
+# ===================
+# FAKE_LLM: "1" honours the fake_llm field of requests (default off)
+FAKE_LLM = os.environ.get('FAKE_LLM', '0') == '1'
+
+FAKE_LLM_FIELD = 'fake_llm'
+
+# Pipeline stage (the span around the LLM call) -> canned text used for it
+STAGE_TEXT = {
+    'rewrite': 'rewrite',
+    'codegen': 'code',
+    'explanation': 'explanation',
+}
+
+_canned = contextvars.ContextVar('fake_llm', default=None)
+
+
+def activate(data):
+    """Use the request's canned responses for the rest of the request. Returns a token, or None."""
+    spec = data.get(FAKE_LLM_FIELD) if FAKE_LLM and isinstance(data, dict) else None
+    if not isinstance(spec, dict) or not isinstance(spec.get('code'), str):
+        return None
+    return _canned.set(spec)
+
+
+def deactivate(token):
+    try:
+        _canned.reset(token)
+    except ValueError:
+        _canned.set(None)
+
+
+def canned(stage, n=1):
+    """(response, delay) standing in for the LLM call of stage, or None when not faking.
+
+    Stages without canned text get the code, which other stages reject like any
+    unusable model output (e.g. a decomposition plan falls back to whole generation).
+    """
+    spec = _canned.get()
+    if spec is None:
+        return None
+    text = spec.get(STAGE_TEXT.get(stage, 'code')) or spec['code']
+    choices = [SimpleNamespace(index=i, message=SimpleNamespace(content=text)) for i in range(n)]
+    try:
+        delay = max(0.0, float(spec.get('delay') or 0))
+    except (TypeError, ValueError):
+        delay = 0.0
+    return SimpleNamespace(choices=choices, usage=None), delay
@@ -0,0 +1,403 @@
+# Deterministic, LLM-free explanation of a diagram.
+# Parses the generated diagrams code with ast (nothing is executed), rebuilds the
+# graph of nodes, clusters and edges, and renders bullet points from templates.
+import re
+import ast
+import importlib
+from functools import lru_cache
+
+MAX_BULLETS = 8
+MAX_LISTED = 6          # names listed per bullet before "and N more"
+MAX_LOOP_ITERATIONS = 50
+MAX_PATH_STEPS = 2000   # bound on the longest-path search per entry point
+
+PROVIDER_NAMES = {
+    'aws': 'AWS',
+    'azure': 'Azure',
+    'gcp': 'Google Cloud',
+    'k8s': 'Kubernetes',
+    'onprem': 'on-premises',
+    'generic': 'generic',
+}
+
+# Last segment of diagrams.<provider>.<category>
+DATA_STORE_CATEGORIES = {'database', 'storage'}
+CATEGORY_TITLES = {
+    'compute': 'Compute',
+    'network': 'Networking',
+    'database': 'Databases',
+    'storage': 'Storage',
+    'integration': 'Integration',
+    'analytics': 'Analytics',
+    'security': 'Security',
+    'ml': 'Machine learning',
+    'management': 'Management',
+    'devtools': 'Developer tools',
+    'identity': 'Identity',
+    'iot': 'IoT',
+    'web': 'Web',
+}
+
+
+class DiagramGraph:
+    """Nodes, clusters and edges recovered from diagrams code"""
+
+    def __init__(self):
+        self.title = None
+        self.nodes = []     # dicts: label, service, provider, category, cluster
+        self.edges = []     # (src, dst, label) node indexes
+        self.clusters = []  # dicts: name, parent
+        self.imports = {}   # local name -> (module below diagrams., class name)
+
+
+class _Pending:
+    """Left side of `a >> Edge(...)`, waiting for its right-hand node"""
+
+    def __init__(self, nodes, label):
+        self.nodes = nodes
+        self.label = label
+
+
+def _camel_to_words(name):
+    return re.sub(r'(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])', ' ', name)
+
+
+@lru_cache(maxsize=2048)
+def _service_name(module, class_name):
+    """Readable service name. Resolves diagrams aliases (ELB -> ElasticLoadBalancing) when installed."""
+    try:
+        class_name = getattr(importlib.import_module(f'diagrams.{module}'), class_name).__name__
+    except Exception:
+        pass
+    return _camel_to_words(class_name)
+
+
+def _string_value(node):
+    """Best-effort text of a str constant or f-string (formatted parts are dropped)"""
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if isinstance(node, ast.JoinedStr):
+        return ''.join(v.value for v in node.values if isinstance(v, ast.Constant) and isinstance(v.value, str))
+    return None
+
+
+def _call_name(call):
+    func = call.func
+    if isinstance(func, ast.Name):
+        return func.id
+    if isinstance(func, ast.Attribute):
+        return func.attr
+    return None
+
+
+def _call_label(call, keyword='label'):
+    if call.args:
+        value = _string_value(call.args[0])
+        if value is not None:
+            return value
+    for kw in call.keywords:
+        if kw.arg == keyword:
+            return _string_value(kw.value)
+    return None
+
+
+class _GraphBuilder:
+    def __init__(self):
+        self.graph = DiagramGraph()
+        self.env = {}
+        self.cluster_stack = []
+        self._evaluated = {}  # id(expr) -> value, for splitting tuple assignments
+
+    # --- statements ---
+    def visit_body(self, body):
+        for stmt in body:
+            self.visit(stmt)
+
+    def visit(self, stmt):
+        if isinstance(stmt, ast.ImportFrom) and stmt.module and stmt.module.startswith('diagrams.'):
+            for alias in stmt.names:
+                self.graph.imports[alias.asname or alias.name] = (stmt.module[len('diagrams.'):], alias.name)
+        elif isinstance(stmt, ast.With):
+            pushed = 0
+            for item in stmt.items:
+                call = item.context_expr
+                name = _call_name(call) if isinstance(call, ast.Call) else None
+                if name == 'Diagram' and self.graph.title is None:
+                    self.graph.title = _call_label(call, 'name')
+                elif name == 'Cluster':
+                    self.graph.clusters.append({
+                        'name': _call_label(call) or 'Cluster',
+                        'parent': self.cluster_stack[-1] if self.cluster_stack else None
+                    })
+                    self.cluster_stack.append(len(self.graph.clusters) - 1)
+                    pushed += 1
+                    if isinstance(item.optional_vars, ast.Name):
+                        self.env[item.optional_vars.id] = []
+            self.visit_body(stmt.body)
+            for _ in range(pushed):
+                self.cluster_stack.pop()
+        elif isinstance(stmt, ast.Assign):
+            value = self.evaluate(stmt.value)
+            for target in stmt.targets:
+                self._bind(target, stmt.value, value)
+        elif isinstance(stmt, ast.AugAssign) and isinstance(stmt.target, ast.Name):
+            self.env[stmt.target.id] = self.env.get(stmt.target.id, []) + self._nodes(self.evaluate(stmt.value))
+        elif isinstance(stmt, ast.Expr):
+            self.evaluate(stmt.value)
+        elif isinstance(stmt, ast.For):
+            self._visit_for(stmt)
+        elif isinstance(stmt, ast.If):
+            self.visit_body(stmt.body)
+            self.visit_body(stmt.orelse)
+        elif isinstance(stmt, ast.Try):
+            self.visit_body(stmt.body)
+
+    def _bind(self, target, value_node, value):
+        if isinstance(target, ast.Name):
+            self.env[target.id] = self._nodes(value)
+        elif isinstance(target, (ast.Tuple, ast.List)) and isinstance(value_node, (ast.Tuple, ast.List)):
+            # a, b = EC2("a"), EC2("b"): evaluated together above, split back per element
+            values = [self._nodes(self._evaluated.get(id(elt), [])) for elt in value_node.elts]
+            for elt, elt_value in zip(target.elts, values):
+                if isinstance(elt, ast.Name):
+                    self.env[elt.id] = elt_value
+
+    def _visit_for(self, stmt):
+        """Run the loop body once per element so per-element edges are recovered"""
+        iterator = stmt.iter
+        if (isinstance(iterator, ast.Call) and _call_name(iterator) == 'zip'
+                and isinstance(stmt.target, ast.Tuple)):
+            columns = [self._nodes(self.evaluate(arg)) for arg in iterator.args]
+            rows = list(zip(*columns))
+            names = stmt.target.elts
+        else:
+            rows = [(n,) for n in self._nodes(self.evaluate(iterator))]
+            names = [stmt.target]
+            if not rows:  # e.g. range(): visit the body once to pick up the nodes it creates
+                self.visit_body(stmt.body)
+                return
+        for row in rows[:MAX_LOOP_ITERATIONS]:
+            for name, node in zip(names, row):
+                if isinstance(name, ast.Name):
+                    self.env[name.id] = [node]
+            self.visit_body(stmt.body)
+
+    # --- expressions: return a list of node indexes, or a _Pending edge ---
+    def evaluate(self, expr):
+        result = self._evaluate(expr)
+        self._evaluated[id(expr)] = result
+        return result
+
+    def _evaluate(self, expr):
+        if isinstance(expr, ast.Name):
+            return list(self.env.get(expr.id, []))
+        if isinstance(expr, ast.Call):
+            return self._evaluate_call(expr)
+        if isinstance(expr, (ast.List, ast.Tuple, ast.Set)):
+            nodes = []
+            for elt in expr.elts:
+                nodes.extend(self._nodes(self.evaluate(elt)))
+            return nodes
+        if isinstance(expr, ast.ListComp):
+            return self._evaluate_comprehension(expr)
+        if isinstance(expr, ast.Subscript):
+            return self._nodes(self.evaluate(expr.value))[:1]
+        if isinstance(expr, ast.BinOp) and isinstance(expr.op, (ast.RShift, ast.LShift, ast.Sub)):
+            return self._evaluate_edge(expr)
+        if isinstance(expr, ast.BinOp) and isinstance(expr.op, ast.Add):
+            return self._nodes(self.evaluate(expr.left)) + self._nodes(self.evaluate(expr.right))
+        return []
+
+    def _evaluate_call(self, call):
+        name = _call_name(call)
+        if name == 'Edge':
+            return _Pending([], _call_label(call))
+        if isinstance(call.func, ast.Name) and name in self.graph.imports:
+            module, class_name = self.graph.imports[name]
+            self.graph.nodes.append({
+                'label': (_call_label(call) or '').replace('\n', ' ').strip(),
+                'service': _service_name(module, class_name),
+                'provider': module.split('.')[0],
+                'category': module.split('.')[-1],
+                'cluster': self.cluster_stack[-1] if self.cluster_stack else None
+            })
+            return [len(self.graph.nodes) - 1]
+        for arg in call.args:
+            self.evaluate(arg)
+        return []
+
+    def _evaluate_comprehension(self, comp):
+        count = 1
+        generator = comp.generators[0] if comp.generators else None
+        if (generator is not None and isinstance(generator.iter, ast.Call)
+                and _call_name(generator.iter) == 'range' and len(generator.iter.args) == 1
+                and isinstance(generator.iter.args[0], ast.Constant)
+                and isinstance(generator.iter.args[0].value, int)):
+            count = max(1, min(generator.iter.args[0].value, MAX_LOOP_ITERATIONS))
+        nodes = []
+        for _ in range(count):
+            nodes.extend(self._nodes(self.evaluate(comp.elt)))
+        return nodes
+
+    def _evaluate_edge(self, expr):
+        left = self.evaluate(expr.left)
+        right = self.evaluate(expr.right)
+        if isinstance(right, _Pending):
+            # a >> Edge(label=...): wait for the node on the other side
+            return _Pending(self._nodes(left), right.label)
+        label = left.label if isinstance(left, _Pending) else None
+        sources = self._nodes(left)
+        targets = self._nodes(right)
+        if isinstance(expr.op, ast.LShift):
+            sources, targets = targets, sources
+        for src in sources:
+            for dst in targets:
+                self.graph.edges.append((src, dst, label))
+        return self._nodes(right)
+
+    @staticmethod
+    def _nodes(value):
+        if isinstance(value, _Pending):
+            return value.nodes
+        return value or []
+
+
+def parse_diagram(code):
+    """Build a DiagramGraph from diagrams code. Raises SyntaxError for unparsable code."""
+    builder = _GraphBuilder()
+    builder.visit_body(ast.parse(code).body)
+    return builder.graph
+
+
+# ===================
+# Rendering
+# ===================
+def _node_name(graph, index):
+    node = graph.nodes[index]
+    if node['label'] and node['label'].lower() != node['service'].lower():
+        return f"{node['label']} ({node['service']})"
+    return node['service']
+
+
+def _listing(items):
+    """Comma-separated names; repeats are collapsed to "name ×n" (e.g. nodes created in a loop)"""
+    counts = {}
+    for item in items:
+        counts[item] = counts.get(item, 0) + 1
+    items = [f"{item} ×{count}" if count > 1 else item for item, count in counts.items()]
+    if len(items) > MAX_LISTED:
+        return ', '.join(items[:MAX_LISTED]) + f' and {len(items) - MAX_LISTED} more'
+    return ', '.join(items)
+
+
+def _longest_path(start, adjacency):
+    """Longest simple path from start, bounded by MAX_PATH_STEPS expansions"""
+    best = [start]
+    steps = 0
+    stack = [(start, [start])]
+    while stack and steps < MAX_PATH_STEPS:
+        node, path = stack.pop()
+        steps += 1
+        if len(path) > len(best):
+            best = path
+        for nxt in adjacency.get(node, []):
+            if nxt not in path:
+                stack.append((nxt, path + [nxt]))
+    return best
+
+
+def _cluster_path(graph, index):
+    names = []
+    while index is not None:
+        names.append(graph.clusters[index]['name'])
+        index = graph.clusters[index]['parent']
+    return ' › '.join(reversed(names))
+
+
+def _unique_edges(graph):
+    seen = {}
+    for src, dst, label in graph.edges:
+        if src != dst and (src, dst) not in seen:
+            seen[(src, dst)] = label
+    return seen
+
+
+def explain_graph(code, provider=None):
+    """Bullet-point explanation built from the diagram graph. Returns None if there is nothing to explain."""
+    try:
+        graph = parse_diagram(code)
+    except SyntaxError:
+        return None
+    if not graph.nodes:
+        return None
+
+    edges = _unique_edges(graph)
+    adjacency = {}
+    indegree = {i: 0 for i in range(len(graph.nodes))}
+    for src, dst in edges:
+        adjacency.setdefault(src, []).append(dst)
+        indegree[dst] += 1
+
+    providers = {n['provider'] for n in graph.nodes}
+    provider = provider or (providers.pop() if len(providers) == 1 else None)
+    provider_name = PROVIDER_NAMES.get(provider, provider.upper() if provider else '')
+    title = f"**{graph.title}**" if graph.title else 'The diagram'
+    overview = f"{title} is {'an' if provider_name[:1].upper() in 'AEIOU' and provider_name else 'a'} "
+    overview += f"{provider_name} architecture" if provider_name else 'cloud architecture'
+    overview += f" with {len(graph.nodes)} component{'s' if len(graph.nodes) != 1 else ''}"
+    if graph.clusters:
+        overview += f" in {len(graph.clusters)} group{'s' if len(graph.clusters) != 1 else ''}"
+    overview += f" and {len(edges)} connection{'s' if len(edges) != 1 else ''}."
+    bullets = [f"- **Overview**: {overview}"]
+
+    # Entry points: nodes that only send traffic
+    entry_points = [i for i in range(len(graph.nodes)) if indegree[i] == 0 and adjacency.get(i)]
+    if entry_points:
+        bullets.append(f"- **Entry points**: Traffic enters through {_listing(_node_name(graph, i) for i in entry_points)}.")
+
+    # Main flows: the longest path from each entry point
+    covered = set()
+    for start in entry_points[:3]:
+        path = _longest_path(start, adjacency)
+        if len(path) < 2:
+            continue
+        text = _node_name(graph, path[0])
+        for src, dst in zip(path, path[1:]):
+            label = edges.get((src, dst))
+            text += f" —{label}→ " if label else ' → '
+            text += _node_name(graph, dst)
+            covered.add((src, dst))
+        bullets.append(f"- **Flow**: {text}.")
+    if not edges:
+        bullets.append(f"- **Nodes**: {_listing(_node_name(graph, i) for i in range(len(graph.nodes)))} (no connections drawn).")
+    remaining = [pair for pair in edges if pair not in covered]
+    if remaining:
+        bullets.append(
+            f"- **Other connections**: "
+            f"{_listing(f'{_node_name(graph, s)} → {_node_name(graph, d)}' for s, d in remaining)}."
+        )
+
+    if graph.clusters:
+        groups = []
+        for index in range(len(graph.clusters)):
+            members = [_node_name(graph, i) for i, n in enumerate(graph.nodes) if n['cluster'] == index]
+            groups.append(f"{_cluster_path(graph, index)} ({_listing(members)})" if members else _cluster_path(graph, index))
+        bullets.append(f"- **Groups**: {'; '.join(groups[:MAX_LISTED])}"
+                       + (f" and {len(groups) - MAX_LISTED} more." if len(groups) > MAX_LISTED else '.'))
+
+    data_stores = [i for i, n in enumerate(graph.nodes) if n['category'] in DATA_STORE_CATEGORIES]
+    if data_stores:
+        bullets.append(f"- **Data stores**: {_listing(_node_name(graph, i) for i in data_stores)}.")
+
+    # Component counts per category
+    by_category = {}
+    for node in graph.nodes:
+        services = by_category.setdefault(node['category'], {})
+        services[node['service']] = services.get(node['service'], 0) + 1
+    parts = []
+    for category, services in by_category.items():
+        counted = ', '.join(f"{s} ×{c}" if c > 1 else s for s, c in services.items())
+        parts.append(f"{CATEGORY_TITLES.get(category, category.title())}: {counted}")
+    bullets.append(f"- **Components**: {'; '.join(parts)}.")
+
+    return '\n'.join(bullets[:MAX_BULLETS])
@@ -0,0 +1,178 @@
+# Idempotency keys for /generate.
+# Clients retry when the gateway times out while the first attempt is still running.
+# With an Idempotency-Key header a retry attaches to the execution already running in
+# this process, or gets the stored response of a finished one, instead of starting a
+# second pipeline. Claims and results live in the artifact storage, so retries that land
+# on another instance (e.g. another Lambda container) see them too:
+#   idempotency/<sha256>.json  - claim record: pending, or done with where the response is
+#   <job folder>/response.json - response of a successful generation, next to its artifacts
+import os
+import json
+import time
+import hashlib
+import threading
+import concurrent.futures
+
+# ===================
+# Configuration
+# ===================
+# IDEMPOTENCY_TTL: seconds a key and its stored response are honoured
+# IDEMPOTENCY_PENDING_TIMEOUT: seconds after which an unfinished claim is considered abandoned
+#   (the process died mid-request); the next request with the key runs the pipeline again
+# IDEMPOTENCY_WAIT: seconds a duplicate waits for the execution it attached to before getting a 409
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', str(24 * 3600)))
+IDEMPOTENCY_PENDING_TIMEOUT = int(os.environ.get('IDEMPOTENCY_PENDING_TIMEOUT', '900'))
+IDEMPOTENCY_WAIT = float(os.environ.get('IDEMPOTENCY_WAIT', '25'))
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+RECORD_PREFIX = 'idempotency/'
+
+IN_PROGRESS_MESSAGE = 'A request with this Idempotency-Key is still in progress. Retry later.'
+MISMATCH_MESSAGE = 'This Idempotency-Key was already used with a different request body.'
+
+# Outcomes of IdempotencyStore.begin
+LEAD = 'lead'          # run the request, then call finish()
+ATTACH = 'attach'      # wait on the returned future for the running execution's (payload, status)
+REPLAY = 'replay'      # (payload, status) of a finished execution
+REJECT = 'reject'      # (payload, status) error: in progress elsewhere, or a different body
+
+
+def validate_key(key):
+    """Return an error as (message, status) for an unusable header value, else None"""
+    if not key.strip() or len(key) > MAX_KEY_LENGTH:
+        return f'{IDEMPOTENCY_HEADER} must be 1 to {MAX_KEY_LENGTH} characters.', 400
+    return None
+
+
+def fingerprint(data):
+    """Hash of the request body, to detect a key reused for a different request"""
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def should_store(status):
+    """Server errors and rate limits are transient: a retry with the same key runs again"""
+    return status < 500 and status != 429
+
+
+class IdempotencyStore:
+    def __init__(self, storage, ttl=IDEMPOTENCY_TTL, pending_timeout=IDEMPOTENCY_PENDING_TIMEOUT):
+        self.storage = storage
+        self.ttl = ttl
+        self.pending_timeout = pending_timeout
+        self._inflight = {}  # record key -> (future, fingerprint) of executions running in this process
+        self._lock = threading.Lock()
+
+    def _record_key(self, route, key):
+        return RECORD_PREFIX + hashlib.sha256(f'{route}\n{key}'.encode()).hexdigest() + '.json'
+
+    # --- Claiming a key ---
+    def begin(self, route, key, body_fingerprint):
+        """Claim key for this request. Returns (outcome, value); see LEAD, ATTACH, REPLAY, REJECT."""
+        record_key = self._record_key(route, key)
+        with self._lock:
+            entry = self._inflight.get(record_key)
+            if entry is not None:
+                future, running_fingerprint = entry
+                if running_fingerprint != body_fingerprint:
+                    return REJECT, ({'error': MISMATCH_MESSAGE}, 422)
+                return ATTACH, future
+            # Duplicates arriving while storage is checked attach to this future
+            future = concurrent.futures.Future()
+            future.set_running_or_notify_cancel()
+            self._inflight[record_key] = (future, body_fingerprint)
+
+        try:
+            outcome, value = self._claim(record_key, body_fingerprint)
+        except Exception as e:
+            print(f"Idempotency storage unavailable, running without it: {str(e)}")
+            outcome, value = LEAD, None
+        if outcome != LEAD:
+            self._resolve(record_key, value)
+        return outcome, value
+
+    def _claim(self, record_key, body_fingerprint):
+        for _ in range(2):
+            record = self._read(record_key)
+            if record is None:
+                pending = {'state': 'pending', 'fingerprint': body_fingerprint, 'created': time.time()}
+                if self.storage.put_bytes_if_absent(json.dumps(pending).encode(), record_key):
+                    return LEAD, None
+                continue  # another instance claimed it first: look at its record
+            if record.get('fingerprint') != body_fingerprint:
+                return REJECT, ({'error': MISMATCH_MESSAGE}, 422)
+            if record.get('state') == 'done':
+                response = self._load_response(record)
+                if response is not None:
+                    return REPLAY, response
+                self.storage.delete(record_key)  # response is gone: run again
+                continue
+            return REJECT, ({'error': IN_PROGRESS_MESSAGE}, 409)
+        return REJECT, ({'error': IN_PROGRESS_MESSAGE}, 409)
+
+    def _read(self, record_key):
+        """The claim record, or None if there is none or it expired (expired records are deleted)"""
+        data = self.storage.get_bytes(record_key)
+        if data is None:
+            return None
+        try:
+            record = json.loads(data)
+        except ValueError:
+            record = {}
+        age = time.time() - record.get('created', 0)
+        limit = self.ttl if record.get('state') == 'done' else self.pending_timeout
+        if age > limit:
+            self.storage.delete(record_key)
+            return None
+        return record
+
+    def _load_response(self, record):
+        if 'response' in record:
+            return record['response'], record['status']
+        data = self.storage.get_bytes(record['response_key'])
+        return (json.loads(data), record['status']) if data is not None else None
+
+    # --- Finishing ---
+    def finish(self, route, key, body_fingerprint, payload, status, folder=None):
+        """Store the response of the execution that claimed key and hand it to attached duplicates.
+
+        Responses of successful generations are written to <folder>/response.json next to the
+        artifacts; others (validation errors, failed renders) are kept in the claim record.
+        Transient failures release the key instead.
+        """
+        record_key = self._record_key(route, key)
+        try:
+            if not should_store(status):
+                self.storage.delete(record_key)
+            else:
+                record = {
+                    'state': 'done',
+                    'fingerprint': body_fingerprint,
+                    'created': time.time(),
+                    'status': status,
+                }
+                if folder:
+                    record['response_key'] = f'{folder}/response.json'
+                    self.storage.put_bytes(json.dumps(payload).encode(), record['response_key'])
+                else:
+                    record['response'] = payload
+                self.storage.put_bytes(json.dumps(record).encode(), record_key)
+        except Exception as e:
+            print(f"Failed to store idempotent response: {str(e)}")
+        finally:
+            self._resolve(record_key, (payload, status))
+
+    def _resolve(self, record_key, result):
+        with self._lock:
+            future, _ = self._inflight.pop(record_key, (None, None))
+        if future is not None:
+            future.set_result(result)
+
+
+def wait_attached(future, timeout=IDEMPOTENCY_WAIT):
+    """(payload, status) of the execution a duplicate attached to, or a 409 if it is not done in time"""
+    try:
+        return future.result(timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        return {'error': IN_PROGRESS_MESSAGE}, 409
@@ -14,6 +14,7 @@ resource "aws_lambda_function" "diagram_ai" {
       S3_BUCKET    = var.s3_bucket
       LLM_PROVIDER = "openai" # or set as needed
       OPENAI_API_KEY = var.openai_api_key
+      WARMUP_ON_START = "1"
     }
   }
 }
@@ -47,3 +48,22 @@ resource "aws_iam_role_policy_attachment" "lambda_ecr" {
   role       = aws_iam_role.lambda_exec.name
   policy_arn = "arn:aws:iam::aws:policy/AmazonEC2ContainerRegistryReadOnly"
 }
+
+# Scheduled ping that keeps a warm container primed (see warmup.py)
+resource "aws_cloudwatch_event_rule" "warmup" {
+  name                = "${var.lambda_function_name}-warmup"
+  schedule_expression = var.warmup_schedule
+}
+
+resource "aws_cloudwatch_event_target" "warmup" {
+  rule = aws_cloudwatch_event_rule.warmup.name
+  arn  = aws_lambda_function.diagram_ai.arn
+}
+
+resource "aws_lambda_permission" "warmup" {
+  statement_id  = "AllowWarmupFromEventBridge"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.diagram_ai.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.warmup.arn
+}
@@ -31,6 +31,12 @@ variable "openai_api_key" {
   sensitive   = true  # Mark as sensitive to prevent it from showing in logs
 }
 
+variable "warmup_schedule" {
+  description = "EventBridge schedule for the warm-up ping."
+  type        = string
+  default     = "rate(5 minutes)"
+}
+
 # Cognito variables
 variable "cognito_callback_urls" {
   description = "Callback URLs for the Cognito user pool client"
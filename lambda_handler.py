@@ -1,27 +1,45 @@
-from app import app
+from async_app import app as asgi_app
+from app import workspace, storage
 from mangum import Mangum
-from asgiref.wsgi import WsgiToAsgi
 import json
 import logging
+import tracing
+import warmup
+import deadline
 
 # Set up logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-asgi_app = WsgiToAsgi(app)
+# /generate is served natively on the event loop; other routes fall through to Flask
 mangum_handler = Mangum(asgi_app, lifespan="off")
 
+# Warm during init (boosted CPU, not billed against the first request's latency). Only the
+# local steps: network probes could outlast the init phase and are left to the scheduled ping.
+if warmup.WARMUP_ON_START:
+    warmup.run(workspace, storage, local_only=True)
+
+def is_warmup_event(event):
+    """Scheduled EventBridge pings and direct {"warmup": true} invocations"""
+    return event.get('source') == 'aws.events' or event.get('warmup') is True
+
 def handler(event, context):
-    # Log the entire event for debugging
-    logger.info(f"Lambda event: {json.dumps(event)}")
+    # Dumping the entire event is costly on large bodies: DEBUG level only, and sampled
+    tracing.log_sampled(logger, lambda: f"Lambda event: {json.dumps(event)}")
     
+    if is_warmup_event(event):
+        report = warmup.run(workspace, storage) or warmup.last_report
+        logger.info(f"Warm-up: {json.dumps(report)}")
+        return report
+
     # Print key parts of the event
     if 'requestContext' in event and 'http' in event['requestContext']:
         method = event['requestContext']['http'].get('method', 'UNKNOWN')
         path = event['requestContext']['http'].get('path', 'UNKNOWN')
         logger.info(f"Request: {method} {path}")
     
-    # Forward to Mangum handler
+    # Forward to Mangum handler; requests end before the invocation's time runs out
+    deadline.set_invocation_deadline(context)
     try:
         response = mangum_handler(event, context)
         logger.info(f"Response status: {response.get('statusCode', 'UNKNOWN')}")
@@ -41,3 +59,7 @@ def handler(event, context):
                 "traceback": error_traceback
             })
         }
+    finally:
+        deadline.set_invocation_deadline(None)
+        # Background threads are frozen once the handler returns: export traces now
+        tracing.flush()
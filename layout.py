@@ -0,0 +1,201 @@
+# Layout engine selection and time-bounded Graphviz layout.
+# The parent process picks a plan from the size of the generated graph; render_runner.py
+# applies it inside the render subprocess: layout runs once per attempt under a time
+# budget, falling back to cheaper engines, and every output format is then drawn from
+# the positioned graph with `neato -n2` instead of laying the graph out again per format.
+import os
+import json
+import time
+import subprocess
+
+from graph_explanation import parse_diagram
+
+# ===================
+# Configuration
+# ===================
+# LAYOUT_ENGINE: "auto" (default) picks an engine from the graph size; or force dot, sfdp, neato, fdp, osage
+# LAYOUT_TIME_BUDGET: seconds the first engine gets before falling back
+# LAYOUT_FALLBACK_BUDGET: seconds each fallback engine gets
+LAYOUT_ENGINE = os.environ.get('LAYOUT_ENGINE', 'auto').lower()
+LAYOUT_TIME_BUDGET = float(os.environ.get('LAYOUT_TIME_BUDGET', '30'))
+LAYOUT_FALLBACK_BUDGET = float(os.environ.get('LAYOUT_FALLBACK_BUDGET', '15'))
+LAYOUT_MEDIUM_NODES = int(os.environ.get('LAYOUT_MEDIUM_NODES', '60'))
+LAYOUT_MEDIUM_EDGES = int(os.environ.get('LAYOUT_MEDIUM_EDGES', '120'))
+LAYOUT_MEDIUM_CLUSTERS = int(os.environ.get('LAYOUT_MEDIUM_CLUSTERS', '12'))
+LAYOUT_LARGE_NODES = int(os.environ.get('LAYOUT_LARGE_NODES', '200'))
+LAYOUT_LARGE_EDGES = int(os.environ.get('LAYOUT_LARGE_EDGES', '400'))
+
+LAYOUT_ENGINES = ('dot', 'sfdp', 'neato', 'fdp', 'osage')
+
+# Environment variable carrying the plan to the render subprocess, and the report it writes back
+LAYOUT_PLAN_ENV = 'DIAGRAM_LAYOUT_PLAN'
+LAYOUT_REPORT_FILE = '.layout.json'  # hidden, so it is not uploaded with the artifacts
+
+# Graph attributes per engine. diagrams defaults to splines=ortho, which is by far the
+# slowest part of a large dot layout; the tuned dot profile trades it for regular splines
+# and caps network simplex / mincross iterations.
+TUNED_DOT_ATTRS = {
+    'splines': 'spline',
+    'nslimit': '2',
+    'nslimit1': '2',
+    'mclimit': '0.5',
+    'remincross': 'false',
+}
+FORCE_DIRECTED_ATTRS = {
+    'splines': 'line',
+    'overlap': 'prism',
+    'outputorder': 'edgesfirst',
+}
+ENGINE_ATTRS = {
+    'dot': {},
+    'sfdp': FORCE_DIRECTED_ATTRS,
+    'neato': FORCE_DIRECTED_ATTRS,
+    'fdp': FORCE_DIRECTED_ATTRS,
+    'osage': {'splines': 'line'},
+}
+
+
+def validate_layout(value):
+    """Return (layout, error) for the optional per-request layout field, error as (message, status)"""
+    layout = value or LAYOUT_ENGINE
+    if not isinstance(layout, str) or layout.strip().lower() not in ('auto',) + LAYOUT_ENGINES:
+        return None, (f"layout must be one of: auto, {', '.join(LAYOUT_ENGINES)}.", 400)
+    return layout.strip().lower(), None
+
+
+def classify_size(nodes, edges, clusters):
+    if nodes >= LAYOUT_LARGE_NODES or edges >= LAYOUT_LARGE_EDGES:
+        return 'large'
+    if nodes >= LAYOUT_MEDIUM_NODES or edges >= LAYOUT_MEDIUM_EDGES or clusters >= LAYOUT_MEDIUM_CLUSTERS:
+        return 'medium'
+    return 'small'
+
+
+def plan_layout(code, layout='auto', timeout=60):
+    """Choose layout attempts for the code. Returns a JSON-serialisable plan for render_runner.py."""
+    try:
+        graph = parse_diagram(code)
+        nodes, edges, clusters = len(graph.nodes), len(graph.edges), len(graph.clusters)
+    except SyntaxError:
+        nodes = edges = clusters = 0
+    size = classify_size(nodes, edges, clusters)
+
+    if layout != 'auto':
+        attempts = [(layout, ENGINE_ATTRS[layout])]
+    elif size == 'small':
+        attempts = [('dot', {})]
+    elif size == 'medium' or clusters:
+        # sfdp does not draw clusters, so clustered graphs stay on tuned dot while it fits the budget
+        attempts = [('dot', TUNED_DOT_ATTRS)]
+    else:
+        attempts = [('sfdp', FORCE_DIRECTED_ATTRS)]
+
+    # Cheaper engines to fall back to: sfdp scales to large graphs, osage only packs clusters
+    for engine in ('sfdp', 'osage'):
+        if engine != attempts[0][0]:
+            attempts.append((engine, ENGINE_ATTRS[engine]))
+
+    budgets = [LAYOUT_TIME_BUDGET] + [LAYOUT_FALLBACK_BUDGET] * (len(attempts) - 1)
+    return {
+        'size': size,
+        'nodes': nodes,
+        'edges': edges,
+        'clusters': clusters,
+        # Leave a few seconds of the render timeout for drawing the output formats
+        'deadline': max(1.0, timeout - 5),
+        'attempts': [
+            {'engine': engine, 'graph_attr': attrs, 'budget': budget}
+            for (engine, attrs), budget in zip(attempts, budgets)
+        ],
+    }
+
+
+def layout_env(plan):
+    """Environment for the render subprocess carrying the layout plan"""
+    env = dict(os.environ)
+    env[LAYOUT_PLAN_ENV] = json.dumps(plan)
+    return env
+
+
+def read_layout_report(folder):
+    """Return the report written by render_runner.py, or None if there is none"""
+    try:
+        with open(os.path.join(folder, LAYOUT_REPORT_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def add_layout_timings(timings, report):
+    """Copy the chosen engine and layout time from a layout report into timings"""
+    if report:
+        timings['layout'] = report.get('layout')
+        timings['layout_engine'] = report.get('engine')
+        timings['layout_fallback'] = report.get('fallback', False)
+
+
+# ===================
+# Used inside the render subprocess
+# ===================
+class LayoutTimeout(RuntimeError):
+    """No layout engine finished within its time budget"""
+
+
+def run_layout(digraph, attempts, deadline):
+    """Lay out a graphviz.Digraph, trying each attempt under its budget.
+
+    Returns (positioned_dot_source, report). Raises LayoutTimeout if every engine times out.
+    """
+    base_attrs = dict(digraph.graph_attr)
+    start = time.monotonic()
+    report = {'attempts': []}
+    for index, attempt in enumerate(attempts):
+        remaining = deadline - (time.monotonic() - start)
+        if remaining <= 0:
+            break
+        digraph.graph_attr.clear()
+        digraph.graph_attr.update(base_attrs)
+        digraph.graph_attr.update(attempt['graph_attr'])
+        budget = min(attempt['budget'], remaining)
+        attempt_start = time.monotonic()
+        try:
+            proc = subprocess.run(
+                ['dot', f"-K{attempt['engine']}", '-Tdot'],
+                input=digraph.source.encode(),
+                capture_output=True,
+                timeout=budget,
+                check=True
+            )
+        except subprocess.TimeoutExpired:
+            report['attempts'].append({
+                'engine': attempt['engine'], 'seconds': round(time.monotonic() - attempt_start, 3), 'status': 'timeout'
+            })
+            continue
+        report['attempts'].append({
+            'engine': attempt['engine'], 'seconds': round(time.monotonic() - attempt_start, 3), 'status': 'ok'
+        })
+        report.update({
+            'engine': attempt['engine'],
+            'layout': round(time.monotonic() - start, 3),
+            'fallback': index > 0,
+        })
+        return proc.stdout, report
+    engines = ', '.join(a['engine'] for a in report['attempts']) or 'none'
+    raise LayoutTimeout(f'Layout did not finish within the time budget (tried: {engines})')
+
+
+def render_positioned(positioned, filename, formats, timeout):
+    """Draw each output format from an already positioned graph without laying it out again"""
+    for fmt in formats:
+        subprocess.run(
+            ['dot', '-Kneato', '-n2', f'-T{fmt}', '-o', f'{filename}.{fmt}'],
+            input=positioned,
+            capture_output=True,
+            timeout=timeout,
+            check=True
+        )
+
+
+def write_layout_report(report, folder='.'):
+    with open(os.path.join(folder, LAYOUT_REPORT_FILE), 'w') as f:
+        json.dump(report, f)
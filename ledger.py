@@ -0,0 +1,224 @@
+# Per-request token and latency ledger.
+# Each API request that calls the pipeline appends one JSON line: per-call model and
+# token usage, per-stage timings, cache hits, artifact bytes and the outcome. Files
+# rotate by size; rotated files can be shipped to the artifact storage (S3 in production).
+import os
+import time
+import glob
+import threading
+import contextvars
+
+import jsonlines
+
+# ===================
+# Configuration
+# ===================
+# LEDGER_ENABLED: "1" (default) writes ledger records, "0" disables them
+# LEDGER_MAX_BYTES: size at which the current file is rotated
+# LEDGER_BACKUPS: rotated files kept locally
+# LEDGER_SHIP: "1" uploads rotated files to the artifact storage under ledger/
+LEDGER_ENABLED = os.environ.get('LEDGER_ENABLED', '1') == '1'
+LEDGER_MAX_BYTES = int(os.environ.get('LEDGER_MAX_BYTES', str(10 * 1024 * 1024)))
+LEDGER_BACKUPS = int(os.environ.get('LEDGER_BACKUPS', '5'))
+LEDGER_SHIP = os.environ.get('LEDGER_SHIP', '0') == '1'
+
+PERCENTILES = (50, 90, 99)
+
+_current_record = contextvars.ContextVar('ledger_record', default=None)
+
+
+class Ledger:
+    def __init__(self, directory, max_bytes=LEDGER_MAX_BYTES, backups=LEDGER_BACKUPS, storage=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.storage = storage  # rotated files are shipped here when set
+        self.path = os.path.join(directory, 'ledger.jsonl')
+        self._lock = threading.Lock()
+
+    def append(self, record):
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with jsonlines.open(self.path, mode='a') as writer:
+                writer.write(record)
+            if os.path.getsize(self.path) >= self.max_bytes:
+                self._rotate()
+
+    def _rotate(self):
+        rotated = os.path.join(self.directory, f'ledger-{time.time_ns()}.jsonl')
+        os.replace(self.path, rotated)
+        if self.storage is not None:
+            try:
+                self.storage.put_bytes(_read_bytes(rotated), f'ledger/{os.path.basename(rotated)}')
+            except Exception as e:
+                print(f"Failed to ship ledger file {rotated}: {str(e)}")
+        rotated_files = sorted(glob.glob(os.path.join(self.directory, 'ledger-*.jsonl')))
+        for old in rotated_files[:len(rotated_files) - self.backups]:
+            os.remove(old)
+
+    def files(self):
+        """Rotated files oldest first, then the current file"""
+        files = sorted(glob.glob(os.path.join(self.directory, 'ledger-*.jsonl')))
+        return files + ([self.path] if os.path.exists(self.path) else [])
+
+    def read(self, since=None):
+        """Yield records with ts >= since (all records if since is None)"""
+        with self._lock:
+            files = self.files()
+        for path in files:
+            try:
+                with jsonlines.open(path) as reader:
+                    for record in reader.iter(type=dict, skip_invalid=True):
+                        if since is None or record.get('ts', 0) >= since:
+                            yield record
+            except FileNotFoundError:
+                continue  # rotated away while reading
+
+
+def _read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+# ===================
+# Per-request records
+# ===================
+def start_record(request_id, route):
+    """Start collecting a record for the current request. Returns a token for finish_record."""
+    if not LEDGER_ENABLED:
+        return None
+    record = {
+        'ts': time.time(),
+        'request_id': request_id,
+        'route': route,
+        'provider': None,
+        'llm_calls': [],
+        'timings': {},
+        'artifact_bytes': None,
+        'outcome': None,
+        'status': None,
+    }
+    return _current_record.set(record)
+
+
+def annotate(**fields):
+    """Set fields on the current request's record. Dicts passed here (e.g. timings) may keep changing."""
+    record = _current_record.get()
+    if record is not None:
+        record.update(fields)
+
+
+def record_llm_call(stage, model, usage=None, cache_hit=False, coalesced=False, seconds=None):
+    """Add one LLM call to the current request's record"""
+    record = _current_record.get()
+    if record is None:
+        return
+    details = getattr(usage, 'prompt_tokens_details', None) if usage is not None else None
+    record['llm_calls'].append({
+        'stage': stage,
+        'model': model,
+        'prompt_tokens': getattr(usage, 'prompt_tokens', 0) if usage is not None and not cache_hit else 0,
+        'completion_tokens': getattr(usage, 'completion_tokens', 0) if usage is not None and not cache_hit else 0,
+        'cached_tokens': (getattr(details, 'cached_tokens', 0) or 0) if details is not None and not cache_hit else 0,
+        'cache_hit': cache_hit,
+        'coalesced': coalesced,
+        'seconds': round(seconds, 4) if seconds is not None else None,
+    })
+
+
+def close_record(token, status, error=None):
+    """Close the current request's record without writing it. Returns the record for append_record, or None."""
+    if token is None:
+        return None
+    record = _current_record.get()
+    try:
+        _current_record.reset(token)
+    except ValueError:
+        _current_record.set(None)  # reset from a different context (e.g. Flask teardown)
+    if record is None:
+        return None
+    record['status'] = status
+    record['outcome'] = 'error' if error is not None or status >= 500 else ('rejected' if status >= 400 else 'ok')
+    if error is not None:
+        record['error'] = str(error)
+    record['duration'] = round(time.time() - record['ts'], 4)
+    record['timings'] = {k: (round(v, 4) if isinstance(v, float) else v) for k, v in record['timings'].items()}
+    return record
+
+
+def append_record(ledger, record):
+    """Append a closed record to the ledger (blocking: may rotate and ship the file)"""
+    if record is None:
+        return
+    try:
+        ledger.append(record)
+    except Exception as e:
+        print(f"Failed to write ledger record: {str(e)}")
+
+
+def finish_record(token, ledger, status, error=None):
+    """Close the current request's record and append it to the ledger"""
+    append_record(ledger, close_record(token, status, error=error))
+
+
+# ===================
+# Aggregation
+# ===================
+def percentiles(values, points=PERCENTILES):
+    """Nearest-rank percentiles of values, e.g. {'p50': ..., 'p90': ..., 'p99': ...}"""
+    values = sorted(values)
+    if not values:
+        return {f'p{p}': None for p in points}
+    return {f'p{p}': values[min(len(values) - 1, max(0, -(-p * len(values) // 100) - 1))] for p in points}
+
+
+def _token_totals():
+    return {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cached_tokens': 0, 'cache_hits': 0, 'coalesced': 0}
+
+
+def _add_call(totals, call):
+    totals['calls'] += 1
+    totals['prompt_tokens'] += call.get('prompt_tokens') or 0
+    totals['completion_tokens'] += call.get('completion_tokens') or 0
+    totals['cached_tokens'] += call.get('cached_tokens') or 0
+    totals['cache_hits'] += 1 if call.get('cache_hit') else 0
+    totals['coalesced'] += 1 if call.get('coalesced') else 0
+
+
+def summarize(records):
+    """Totals and latency percentiles overall, per provider, per stage and per route"""
+    records = list(records)
+    summary = {
+        'requests': len(records),
+        'outcomes': {},
+        'tokens': _token_totals(),
+        'latency': percentiles([r['duration'] for r in records if r.get('duration') is not None]),
+        'artifact_bytes': sum(r.get('artifact_bytes') or 0 for r in records),
+        'providers': {},
+        'stages': {},
+        'routes': {},
+    }
+    stage_seconds = {}
+    provider_latency = {}
+    for record in records:
+        summary['outcomes'][record.get('outcome')] = summary['outcomes'].get(record.get('outcome'), 0) + 1
+        summary['routes'][record.get('route')] = summary['routes'].get(record.get('route'), 0) + 1
+        provider = record.get('provider') or 'none'
+        provider_entry = summary['providers'].setdefault(provider, {'requests': 0, 'tokens': _token_totals()})
+        provider_entry['requests'] += 1
+        if record.get('duration') is not None:
+            provider_latency.setdefault(provider, []).append(record['duration'])
+        for call in record.get('llm_calls') or []:
+            _add_call(summary['tokens'], call)
+            _add_call(provider_entry['tokens'], call)
+            stage_entry = summary['stages'].setdefault(call.get('stage') or 'unknown', {'tokens': _token_totals()})
+            _add_call(stage_entry['tokens'], call)
+        for stage, seconds in (record.get('timings') or {}).items():
+            if isinstance(seconds, (int, float)) and not isinstance(seconds, bool):
+                stage_seconds.setdefault(stage, []).append(seconds)
+    for provider, values in provider_latency.items():
+        summary['providers'][provider]['latency'] = percentiles(values)
+    for stage, values in stage_seconds.items():
+        entry = summary['stages'].setdefault(stage, {'tokens': _token_totals()})
+        entry['seconds'] = dict(percentiles(values), total=round(sum(values), 4), count=len(values))
+    return summary
@@ -3,15 +3,25 @@ import os
 import re
 import hashlib
 import json
+import time
+import asyncio
+import threading
+import concurrent.futures
 from functools import lru_cache
 
 # Third-party imports
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, APITimeoutError
+
+# Local imports
+import ledger
+import tracing
+import deadline
+import fake_llm
 
 # Simple in-memory cache for LLM responses
 _cache = {}
 
-def _get_cache_key(model, messages, temperature, max_tokens):
+def _get_cache_key(model, messages, temperature, max_tokens, n=1):
     """Generate a cache key based on the request parameters"""
     key_dict = {
         "model": model,
@@ -19,68 +29,360 @@ def _get_cache_key(model, messages, temperature, max_tokens):
         "temperature": temperature,
         "max_tokens": max_tokens
     }
+    if n != 1:
+        key_dict["n"] = n
     key_str = json.dumps(key_dict, sort_keys=True)
     return hashlib.md5(key_str.encode()).hexdigest()
 
-def openai_chat_with_cache(model, messages, temperature=0, max_tokens=15000, top_p=1, use_cache=True):
-    """Make an OpenAI API call with caching"""
-    # Generate a cache key
-    cache_key = _get_cache_key(model, messages, temperature, max_tokens)
-    
-    # Check if we have a cached response
-    if use_cache and cache_key in _cache:
-        print(f"Cache hit for {model} request")
-        return _cache[cache_key]
-    
-    # No cache hit, make the actual API call
+def _get_api_key():
     api_key = os.environ.get("OPENAI_API_KEY")
     if not api_key or not api_key.startswith("sk-"):
         raise ValueError("OPENAI_API_KEY environment variable is missing or invalid.")
-    
-    client = OpenAI(api_key=api_key)
-    response = client.chat.completions.create(
-        model=model,
-        messages=messages,
-        temperature=temperature,
-        max_tokens=max_tokens,
-        top_p=top_p
-    )
-    
-    # Cache the response
-    if use_cache:
+    return api_key
+
+# One shared OpenAI client: it is thread-safe and keeps a pool of open connections,
+# so requests (and warmup) reuse TLS connections instead of opening one per call
+_client = None
+_client_lock = threading.Lock()
+
+def _get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = OpenAI(api_key=_get_api_key())
+        return _client
+
+def warm_client(timeout=5):
+    """Open a pooled connection to the OpenAI API with a request that costs no tokens"""
+    _get_client().with_options(timeout=timeout, max_retries=0).models.list()
+
+# One AsyncOpenAI client per event loop: its connection pool is bound to the loop it runs on
+_async_clients = {}
+
+def _get_async_client():
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = AsyncOpenAI(api_key=_get_api_key())
+        _async_clients.clear()  # drop clients of loops that are gone
+        _async_clients[loop] = client
+    return client
+
+def _record_usage(response):
+    """Attach token counts from the response to the current trace span"""
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return
+    tracing.set_attribute('llm.prompt_tokens', usage.prompt_tokens)
+    tracing.set_attribute('llm.completion_tokens', usage.completion_tokens)
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached = getattr(details, 'cached_tokens', None) if details else None
+    if cached is not None:
+        tracing.set_attribute('llm.cached_tokens', cached)
+
+# Single-flight: concurrent identical cacheable calls share one upstream request.
+# Futures are concurrent.futures.Future so threads and coroutines can wait on the same call.
+_inflight = {}
+_inflight_lock = threading.Lock()
+_coalesce_stats = {'upstream': 0, 'coalesced': 0}
+
+class _LeaderAbandoned(Exception):
+    """Set on a shared call whose leader was cancelled; waiting callers retry"""
+
+def _join_or_lead(cache_key):
+    """Return (future, is_leader). The leader makes the call; everyone else waits on its future."""
+    with _inflight_lock:
+        future = _inflight.get(cache_key)
+        if future is not None:
+            _coalesce_stats['coalesced'] += 1
+            return future, False
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()  # waiters can't cancel the shared call
+        _inflight[cache_key] = future
+        _coalesce_stats['upstream'] += 1
+        return future, True
+
+def _finish_lead(cache_key, future, response=None, error=None):
+    if error is None:
         _cache[cache_key] = response
+    with _inflight_lock:
+        _inflight.pop(cache_key, None)
+    if error is None:
+        future.set_result(response)
+    else:
+        future.set_exception(error if isinstance(error, Exception) else _LeaderAbandoned())
+
+# Failures that say nothing about the call itself, only that this caller stopped waiting for it
+_ABANDONING_ERRORS = (deadline.DeadlineExceeded, APITimeoutError, asyncio.TimeoutError, concurrent.futures.TimeoutError)
+
+def _release_lead(cache_key, future, response, error):
+    """Hand the leader's outcome to the waiting callers, whichever way its call ended"""
+    if response is not None:
+        _finish_lead(cache_key, future, response)
+    elif isinstance(error, _ABANDONING_ERRORS):
+        # Cut short by the leader's deadline or cancelled: waiters retry within their own
+        _finish_lead(cache_key, future, error=_LeaderAbandoned())
+    else:
+        # API errors (4xx, 429, ...) would fail the waiters' calls too; cancellation becomes _LeaderAbandoned
+        _finish_lead(cache_key, future, error=error)
+
+def coalesce_stats():
+    """Counts of upstream calls and of calls collapsed onto an identical in-flight call"""
+    with _inflight_lock:
+        return dict(_coalesce_stats, in_flight=len(_inflight))
+
+def _current_stage():
+    """Name of the pipeline stage making an LLM call: the span that is current before llm.chat starts"""
+    span = tracing.current_span()
+    return span.name if span is not None else None
+
+def _timeout_option(timeout):
+    """Per-call timeout for the request's deadline. Omitted without one: None would disable the client's default."""
+    return {'timeout': max(timeout, 0.1)} if timeout is not None else {}
+
+def openai_chat_with_cache(model, messages, temperature=0, max_tokens=15000, top_p=1, use_cache=True, n=1):
+    """Make an OpenAI API call with caching and coalescing of identical in-flight calls"""
+    # Generate a cache key
+    cache_key = _get_cache_key(model, messages, temperature, max_tokens, n)
     
+    stage = _current_stage()
+    start = time.time()
+    # The leader's future is released in the finally below, so waiters never outlive a failed lead
+    lead, response, error = None, None, None
+    try:
+        with tracing.span('llm.chat', **{'llm.model': model, 'llm.max_tokens': max_tokens}):
+            # Load tests with FAKE_LLM=1 get canned responses (see fake_llm.py)
+            fake = fake_llm.canned(stage, n)
+            if fake is not None:
+                tracing.set_attribute('llm.fake', True)
+                time.sleep(fake[1])
+                return fake[0]
+
+            # Check if we have a cached response
+            if use_cache and cache_key in _cache:
+                print(f"Cache hit for {model} request")
+                tracing.set_attribute('llm.cache_hit', True)
+                ledger.record_llm_call(stage, model, cache_hit=True, seconds=time.time() - start)
+                return _cache[cache_key]
+
+            # Nothing to wait for once the request's deadline has passed or it finished
+            deadline.check()
+            timeout = deadline.bound(None)
+
+            # Wait on an identical call that is already in flight
+            while use_cache:
+                future, is_leader = _join_or_lead(cache_key)
+                if is_leader:
+                    if cache_key in _cache:  # an identical call finished since the cache check
+                        _finish_lead(cache_key, future, _cache[cache_key])
+                        return _cache[cache_key]
+                    lead = future
+                    break
+                print(f"Coalesced {model} request with an in-flight call")
+                tracing.set_attribute('llm.coalesced', True)
+                try:
+                    response = future.result(timeout=timeout)
+                except _LeaderAbandoned:
+                    continue
+                except concurrent.futures.TimeoutError:
+                    raise deadline.DeadlineExceeded('Request deadline exceeded')
+                ledger.record_llm_call(stage, model, coalesced=True, seconds=time.time() - start)
+                return response
+
+            # No cache hit, make the actual API call
+            response = _get_client().chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                top_p=top_p,
+                n=n,
+                **_timeout_option(timeout)
+            )
+            _record_usage(response)
+            ledger.record_llm_call(stage, model, usage=getattr(response, 'usage', None), seconds=time.time() - start)
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        # Cache the response and release the waiting callers
+        if lead is not None:
+            _release_lead(cache_key, lead, response, error)
+
     return response
-def generate_explanation_openai(prompt):
-    messages = [
-        {"role": "system", "content": "You are a helpful cloud architecture assistant."},
-        {"role": "user", "content": prompt}
-    ]
-    response = openai_chat_with_cache(
+
+async def openai_chat_with_cache_async(model, messages, temperature=0, max_tokens=15000, top_p=1, use_cache=True,
+                                       n=1):
+    """Async variant of openai_chat_with_cache; shares the same response cache and in-flight calls"""
+    cache_key = _get_cache_key(model, messages, temperature, max_tokens, n)
+    stage = _current_stage()
+    start = time.time()
+    lead, response, error = None, None, None
+    try:
+        with tracing.span('llm.chat', **{'llm.model': model, 'llm.max_tokens': max_tokens}):
+            fake = fake_llm.canned(stage, n)
+            if fake is not None:
+                tracing.set_attribute('llm.fake', True)
+                await asyncio.sleep(fake[1])
+                return fake[0]
+
+            if use_cache and cache_key in _cache:
+                print(f"Cache hit for {model} request")
+                tracing.set_attribute('llm.cache_hit', True)
+                ledger.record_llm_call(stage, model, cache_hit=True, seconds=time.time() - start)
+                return _cache[cache_key]
+
+            deadline.check()
+            timeout = deadline.bound(None)
+
+            while use_cache:
+                future, is_leader = _join_or_lead(cache_key)
+                if is_leader:
+                    if cache_key in _cache:  # an identical call finished since the cache check
+                        _finish_lead(cache_key, future, _cache[cache_key])
+                        return _cache[cache_key]
+                    lead = future
+                    break
+                print(f"Coalesced {model} request with an in-flight call")
+                tracing.set_attribute('llm.coalesced', True)
+                try:
+                    response = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout)
+                except _LeaderAbandoned:
+                    continue
+                except asyncio.TimeoutError:
+                    raise deadline.DeadlineExceeded('Request deadline exceeded')
+                ledger.record_llm_call(stage, model, coalesced=True, seconds=time.time() - start)
+                return response
+
+            response = await _get_async_client().chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                top_p=top_p,
+                n=n,
+                **_timeout_option(timeout)
+            )
+            _record_usage(response)
+            ledger.record_llm_call(stage, model, usage=getattr(response, 'usage', None), seconds=time.time() - start)
+    except BaseException as e:
+        # Includes cancellation of the leader: waiters get _LeaderAbandoned and retry
+        error = e
+        raise
+    finally:
+        if lead is not None:
+            _release_lead(cache_key, lead, response, error)
+    return response
+
+# Request parameters per task, shared by the sync and async entry points
+def _explanation_request(prompt):
+    return dict(
         model="gpt-4o",
-        messages=messages,
+        messages=[
+            {"role": "system", "content": "You are a helpful cloud architecture assistant."},
+            {"role": "user", "content": prompt}
+        ],
         temperature=0,
         max_tokens=4000,  # Reduced to be within model limits (gpt-4o supports max 4096 tokens)
         top_p=0.7
     )
-    return response.choices[0].message.content.strip()
 
-def generate_code_openai(description, instructions):
-    messages = [
-        {"role": "system", "content": instructions},
-        {"role": "user", "content": description}
-    ]
-    response = openai_chat_with_cache(
+def _code_request(description, instructions):
+    return dict(
         model="gpt-4o",
-        messages=messages,
+        messages=[
+            {"role": "system", "content": instructions},
+            {"role": "user", "content": description}
+        ],
         temperature=0,
         max_tokens=15024,
         top_p=1,
         use_cache=False  # Disable caching for code generation to ensure freshness
     )
+
+def _code_candidates_request(description, instructions, n, max_tokens, temperature):
+    # One call with n choices: the prompt is billed once and the choices come back together
+    return dict(_code_request(description, instructions), n=n, max_tokens=max_tokens, temperature=temperature)
+
+def _decompose_request(description, instructions):
+    return dict(
+        model="gpt-4o",
+        messages=[
+            {"role": "system", "content": instructions},
+            {"role": "user", "content": description}
+        ],
+        temperature=0,
+        max_tokens=4000,  # A JSON plan: short compared to the code it replaces
+        top_p=1
+    )
+
+def _rewrite_request(user_input, instructions):
+    return dict(
+        model="gpt-4o",
+        messages=[
+            {"role": "system", "content": instructions},
+            {"role": "user", "content": user_input}
+        ],
+        temperature=0,
+        max_tokens=4000,  # Reduced to be within model limits (gpt-4o supports max 4096 tokens)
+        top_p=1
+    )
+
+def _edit_request(code, change_request, instructions):
+    return dict(
+        model="gpt-4o",
+        messages=[
+            {"role": "system", "content": instructions},
+            {"role": "user", "content": f"Current program:\n```python\n{code}\n```\n\nChange request:\n{change_request}"}
+        ],
+        temperature=0,
+        max_tokens=2000,  # Edit blocks only: far fewer output tokens than a full program
+        top_p=1,
+        use_cache=False
+    )
+
+def generate_explanation_openai(prompt):
+    response = openai_chat_with_cache(**_explanation_request(prompt))
+    return response.choices[0].message.content.strip()
+
+async def generate_explanation_openai_async(prompt):
+    response = await openai_chat_with_cache_async(**_explanation_request(prompt))
+    return response.choices[0].message.content.strip()
+
+def generate_code_openai(description, instructions):
+    response = openai_chat_with_cache(**_code_request(description, instructions))
     content = response.choices[0].message.content
     return extract_python_code(content)
 
+async def generate_code_openai_async(description, instructions):
+    response = await openai_chat_with_cache_async(**_code_request(description, instructions))
+    return extract_python_code(response.choices[0].message.content)
+
+def generate_code_candidates_openai(description, instructions, n, max_tokens=8000, temperature=0.7):
+    """Generate n alternative programs for the same description in a single call"""
+    response = openai_chat_with_cache(**_code_candidates_request(description, instructions, n, max_tokens, temperature))
+    return [extract_python_code(choice.message.content or '') for choice in response.choices]
+
+async def generate_code_candidates_openai_async(description, instructions, n, max_tokens=8000, temperature=0.7):
+    response = await openai_chat_with_cache_async(
+        **_code_candidates_request(description, instructions, n, max_tokens, temperature)
+    )
+    return [extract_python_code(choice.message.content or '') for choice in response.choices]
+
+def generate_decomposition_openai(description, instructions):
+    """Ask the model to split a large description into subsystems (a JSON plan)"""
+    response = openai_chat_with_cache(**_decompose_request(description, instructions))
+    return response.choices[0].message.content.strip()
+
+async def generate_decomposition_openai_async(description, instructions):
+    response = await openai_chat_with_cache_async(**_decompose_request(description, instructions))
+    return response.choices[0].message.content.strip()
+
+def generate_edit_openai(code, change_request, instructions):
+    """Ask the model for SEARCH/REPLACE edit blocks against existing diagram code"""
+    response = openai_chat_with_cache(**_edit_request(code, change_request, instructions))
+    return response.choices[0].message.content
+
 def extract_python_code(content):
     # Try to extract code from triple backticks (with or without python)
     match = re.search(r"```python(.*?)```", content, re.DOTALL | re.IGNORECASE)
@@ -111,15 +413,9 @@ def generate_rewrite_openai(user_input, instructions):
     """
     Generate rewritten content using OpenAI's API based on rewrite instructions.
     """
-    messages = [
-        {"role": "system", "content": instructions},
-        {"role": "user", "content": user_input}
-    ]
-    response = openai_chat_with_cache(
-        model="gpt-4o",
-        messages=messages,
-        temperature=0,
-        max_tokens=4000,  # Reduced to be within model limits (gpt-4o supports max 4096 tokens)
-        top_p=1
-    )
+    response = openai_chat_with_cache(**_rewrite_request(user_input, instructions))
+    return response.choices[0].message.content.strip()
+
+async def generate_rewrite_openai_async(user_input, instructions):
+    response = await openai_chat_with_cache_async(**_rewrite_request(user_input, instructions))
     return response.choices[0].message.content.strip()
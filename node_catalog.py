@@ -0,0 +1,236 @@
+# Catalog of the node classes in the installed diagrams package.
+# Built once per process by importing every diagrams.* module (about 0.1s; warm-up builds it
+# off the request path):
+#   modules: 'diagrams.aws.compute' -> {'EC2': {'class': 'EC2', 'icon': 'ec2.png'},
+#                                       'ECR': {'class': 'EC2ContainerRegistry', ...}, ...}
+#   names:   'EC2' -> ['diagrams.aws.compute']
+# Generated programs are checked against it before rendering (a hallucinated class used to
+# surface only as an ImportError from the render subprocess), near misses are fixed
+# (Fargates -> Fargate, S3 imported from compute -> storage), and the exact class names of
+# the modules relevant to a description are added to the generation prompt.
+import os
+import re
+import ast
+import difflib
+import inspect
+import pkgutil
+import importlib
+import threading
+
+# ===================
+# Configuration
+# ===================
+# CATALOG_PROMPT: "1" adds the classes of the modules relevant to the description to the generation prompt
+# CATALOG_PROMPT_MAX_MODULES: most modules listed in the prompt
+CATALOG_PROMPT = os.environ.get('CATALOG_PROMPT', '1') == '1'
+CATALOG_PROMPT_MAX_MODULES = int(os.environ.get('CATALOG_PROMPT_MAX_MODULES', '6'))
+
+# Similarity difflib needs to treat a name as a misspelling of a catalog name
+NAME_CUTOFF = 0.8
+MODULE_CUTOFF = 0.85
+
+UNKNOWN_NODE_MESSAGE = 'The generated code imports diagrams classes that do not exist: {}'
+
+_catalog = None
+_lock = threading.Lock()
+
+
+class Catalog:
+    def __init__(self, modules):
+        self.modules = modules  # module -> {importable name: {'class', 'icon'}}
+        self.names = {}         # name -> modules it can be imported from
+        self._lower = {}        # module -> {lowercase name: name}
+        for module, entries in modules.items():
+            self._lower[module] = {name.lower(): name for name in entries}
+            for name in entries:
+                self.names.setdefault(name, []).append(module)
+
+    def provider_modules(self, provider):
+        prefix = f'diagrams.{provider}.'
+        return [m for m in self.modules if m.startswith(prefix)]
+
+    def resolve(self, module, name):
+        """(module, name) a possibly wrong import most likely meant, or None if nothing is close"""
+        entries = self.modules.get(module, {})
+        if name in entries:
+            return module, name
+        if name.lower() in self._lower.get(module, {}):
+            return module, self._lower[module][name.lower()]
+        siblings = self.provider_modules(_provider(module)) if _provider(module) else []
+        # Right name, wrong module of the same provider
+        for other in siblings:
+            if name in self.modules[other]:
+                return other, name
+        for other in siblings:
+            if name.lower() in self._lower[other]:
+                return other, self._lower[other][name.lower()]
+        match = difflib.get_close_matches(name, list(entries), n=1, cutoff=NAME_CUTOFF)
+        if match:
+            return module, match[0]
+        pool = {n: m for m in siblings for n in self.modules[m]}
+        match = difflib.get_close_matches(name, list(pool), n=1, cutoff=NAME_CUTOFF)
+        if match:
+            return pool[match[0]], match[0]
+        return None
+
+
+def _provider(module):
+    parts = module.split('.')
+    return parts[1] if len(parts) > 2 and parts[0] == 'diagrams' else None
+
+
+def _build():
+    import diagrams
+    modules = {'diagrams': {
+        name: {'class': name, 'icon': None} for name in vars(diagrams) if not name.startswith('_')
+    }}
+    for info in pkgutil.walk_packages(diagrams.__path__, 'diagrams.'):
+        module = importlib.import_module(info.name)
+        entries = {}
+        for name, obj in vars(module).items():
+            if (not name.startswith('_') and inspect.isclass(obj) and issubclass(obj, diagrams.Node)
+                    and obj.__module__ == info.name):
+                entries[name] = {'class': obj.__name__, 'icon': getattr(obj, '_icon', None)}
+        modules[info.name] = entries
+    return Catalog(modules)
+
+
+def get_catalog():
+    """The catalog of the installed diagrams package, built on first use. None if diagrams is missing."""
+    global _catalog
+    with _lock:
+        if _catalog is None:
+            try:
+                _catalog = _build()
+            except ImportError as e:
+                print(f"Node catalog unavailable: {str(e)}")
+                return None
+        return _catalog
+
+
+def _diagram_imports(tree):
+    return [
+        node for node in ast.walk(tree)
+        if isinstance(node, ast.ImportFrom) and node.level == 0 and node.module
+        and node.module.split('.')[0] == 'diagrams'
+    ]
+
+
+# ===================
+# Validation and correction
+# ===================
+def unknown_imports(code):
+    """'module.Name' of every name imported from diagrams that does not exist ([] if all do)"""
+    catalog = get_catalog()
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return []
+    if catalog is None:
+        return []
+    unknown = []
+    for node in _diagram_imports(tree):
+        entries = catalog.modules.get(node.module)
+        for alias in node.names:
+            if alias.name != '*' and (entries is None or alias.name not in entries):
+                unknown.append(f'{node.module}.{alias.name}')
+    return unknown
+
+
+def unknown_node_message(code):
+    """Why code cannot render because of its diagrams imports, or None"""
+    unknown = unknown_imports(code)
+    return UNKNOWN_NODE_MESSAGE.format(', '.join(unknown)) if unknown else None
+
+
+def fix_imports(code):
+    """Point near-miss diagrams imports at the catalog class they most likely meant.
+
+    Only import lines change: a renamed class keeps its original local name through
+    `as`, so the rest of the program is untouched. Returns (code, fixes).
+    """
+    catalog = get_catalog()
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return code, []
+    if catalog is None:
+        return code, []
+    lines = code.splitlines(keepends=True)
+    fixes = []
+    for node in sorted(_diagram_imports(tree), key=lambda n: n.lineno, reverse=True):
+        module = node.module
+        if module not in catalog.modules:
+            match = difflib.get_close_matches(module, list(catalog.modules), n=1, cutoff=MODULE_CUTOFF)
+            module = match[0] if match else module
+        imports = {}  # module -> [(name, local)]
+        changed = module != node.module
+        for alias in node.names:
+            local = alias.asname or alias.name
+            resolved = catalog.resolve(module, alias.name) if alias.name != '*' else None
+            target_module, name = resolved or (module, alias.name)
+            if (target_module, name) != (node.module, alias.name):
+                changed = True
+                fixes.append(f'{node.module}.{alias.name} -> {target_module}.{name}')
+            imports.setdefault(target_module, []).append((name, local))
+        if not changed:
+            continue
+        indent = ' ' * node.col_offset
+        statements = [
+            indent + f'from {target} import ' + ', '.join(n if n == local else f'{n} as {local}' for n, local in names)
+            + '\n'
+            for target, names in imports.items()
+        ]
+        lines[node.lineno - 1:node.end_lineno] = statements
+    return ''.join(lines), list(reversed(fixes))
+
+
+# ===================
+# Prompt slices
+# ===================
+def _words(text):
+    """Lowercase words of text, with CamelCase names split (EC2ContainerRegistry -> ec2, container, registry)"""
+    text = re.sub(r'([a-z0-9])([A-Z])', r'\1 \2', text)
+    return set(re.findall(r'[a-z0-9]+', text.lower()))
+
+
+def relevant_modules(provider, description, max_modules=CATALOG_PROMPT_MAX_MODULES):
+    """The provider's modules whose class names share the most words with the description"""
+    catalog = get_catalog()
+    if catalog is None:
+        return []
+    words = {w for w in _words(description) if len(w) > 1}
+    scores = {}
+    for module in catalog.provider_modules(provider):
+        score = 2 if module.rsplit('.', 1)[1] in words else 0
+        for name in catalog.modules[module]:
+            if name.lower() in words or _words(name) & words:
+                score += 1
+        if score:
+            scores[module] = score
+    return sorted(scores, key=lambda m: (-scores[m], m))[:max_modules]
+
+
+def catalog_prompt(provider, description, max_modules=CATALOG_PROMPT_MAX_MODULES):
+    """Prompt section with the exact importable names of the modules relevant to description ('' if none)"""
+    if not CATALOG_PROMPT:
+        return ''
+    modules = relevant_modules(provider, description, max_modules)
+    if not modules:
+        return ''
+    catalog = get_catalog()
+    lines = [
+        '',
+        '## Available node classes',
+        'Names that can be imported from the modules most relevant to this request. '
+        'Import classes exactly as listed; a name that is not listed does not exist in that module.',
+    ]
+    for module in modules:
+        entries = catalog.modules[module]
+        classes = sorted(name for name, entry in entries.items() if entry['class'] == name)
+        aliases = sorted(f'{name} ({entry["class"]})' for name, entry in entries.items() if entry['class'] != name)
+        line = f'- from {module} import ' + ', '.join(classes)
+        if aliases:
+            line += '; aliases: ' + ', '.join(aliases)
+        lines.append(line)
+    return '\n'.join(lines) + '\n'
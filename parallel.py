@@ -1,64 +1,169 @@
 import os
 import concurrent.futures
-from llm_providers import generate_explanation_openai, generate_rewrite_openai
+import tracing
+import deadline
+import executors
+from graph_explanation import explain_graph
+from llm_providers import (
+    generate_explanation_openai, generate_rewrite_openai,
+    generate_explanation_openai_async, generate_rewrite_openai_async
+)
 
-# Function to prepare the explanation prompt with or without rewriting
-def prepare_explanation_prompt(code, provider):
+# Map providers to rewrite instruction files
+REWRITE_PROVIDER_MAP = {
+    'aws': 'instructions/rewrite/instructions_aws_rewrite.md',
+    'azure': 'instructions/rewrite/instructions_azure_rewrite.md',
+    'gcp': 'instructions/rewrite/instructions_gcp_rewrite.md'
+}
+
+def build_explanation_prompt(code):
     # Original explanation prompt
-    original_explanation_prompt = (
+    return (
         "Given the following diagrams Python code, provide a short, detailed, bullet-point explanation "
         "of the flow and architecture. Be concise but clear. Do not exceed 8 bullet points.\n\n"
         "Code:\n"
         f"{code}"
     )
-    
-    explanation_prompt = original_explanation_prompt
-    
+
+def build_explanation_rewrite(code, provider):
+    """Return (rewrite_prompt, rewrite_instructions) for a provider, or None if not applicable"""
+    if not provider or provider not in ['aws', 'azure', 'gcp']:
+        return None
+    rewrite_instructions_file = REWRITE_PROVIDER_MAP.get(provider)
+
+    # Verify the rewrite instructions file exists
+    if not rewrite_instructions_file or not os.path.exists(rewrite_instructions_file):
+        return None
+
+    # Read the rewrite instructions
+    with open(rewrite_instructions_file, 'r') as f:
+        rewrite_instructions = f.read()
+
+    # Craft a provider-specific explanation prompt
+    rewrite_prompt = (
+        f"I need to explain this {provider.upper()} architecture diagram code in the correct terminology. "
+        f"Please provide a bullet-point explanation using proper {provider.upper()} terminology for this code:\n\n{code}"
+    )
+    return rewrite_prompt, rewrite_instructions
+
+# Function to prepare the explanation prompt with or without rewriting
+def prepare_explanation_prompt(code, provider):
+    explanation_prompt = build_explanation_prompt(code)
+
     # If we have a provider, try to rewrite the explanation prompt with provider-specific terminology
-    if provider and provider in ['aws', 'azure', 'gcp']:
-        try:
-            # Map providers to rewrite instruction files
-            rewrite_provider_map = {
-                'aws': 'instructions/rewrite/instructions_aws_rewrite.md',
-                'azure': 'instructions/rewrite/instructions_azure_rewrite.md',
-                'gcp': 'instructions/rewrite/instructions_gcp_rewrite.md'
-            }
-            
-            rewrite_instructions_file = rewrite_provider_map.get(provider)
-            
-            # Verify the rewrite instructions file exists
-            if rewrite_instructions_file and os.path.exists(rewrite_instructions_file):
-                # Read the rewrite instructions
-                with open(rewrite_instructions_file, 'r') as f:
-                    rewrite_instructions = f.read()
-                
-                # Craft a provider-specific explanation prompt
-                rewrite_prompt = (
-                    f"I need to explain this {provider.upper()} architecture diagram code in the correct terminology. "
-                    f"Please provide a bullet-point explanation using proper {provider.upper()} terminology for this code:\n\n{code}"
-                )
-                
-                # Rewrite the prompt using OpenAI
-                rewritten_prompt = generate_rewrite_openai(rewrite_prompt, rewrite_instructions)
-                
-                # Use the rewritten prompt if successful
-                if rewritten_prompt:
-                    explanation_prompt = rewritten_prompt
-        except Exception as e:
-            # If rewriting fails, continue with the original explanation prompt
-            print(f"Warning: Explanation prompt rewriting failed: {str(e)}. Continuing with original prompt.")
-    
+    try:
+        rewrite = build_explanation_rewrite(code, provider)
+        if rewrite:
+            # Rewrite the prompt using OpenAI
+            rewritten_prompt = generate_rewrite_openai(*rewrite)
+
+            # Use the rewritten prompt if successful
+            if rewritten_prompt:
+                explanation_prompt = rewritten_prompt
+    except Exception as e:
+        # If rewriting fails, continue with the original explanation prompt
+        print(f"Warning: Explanation prompt rewriting failed: {str(e)}. Continuing with original prompt.")
+
     return explanation_prompt
 
-# Function to generate explanation in a separate thread
-def generate_explanation_async(code, provider):
+async def prepare_explanation_prompt_aio(code, provider):
+    """Coroutine version of prepare_explanation_prompt for the async request path"""
+    explanation_prompt = build_explanation_prompt(code)
     try:
+        rewrite = build_explanation_rewrite(code, provider)
+        if rewrite:
+            rewritten_prompt = await generate_rewrite_openai_async(*rewrite)
+            if rewritten_prompt:
+                explanation_prompt = rewritten_prompt
+    except Exception as e:
+        print(f"Warning: Explanation prompt rewriting failed: {str(e)}. Continuing with original prompt.")
+    return explanation_prompt
+
+def generate_explanation(code, provider, store=None):
+    """(explanation, prompt): the LLM explanation of code and the prompt it was asked with. Raises on LLM errors."""
+    with tracing.span('explanation', provider=provider or 'none'):
         # Prepare the explanation prompt (with rewriting if applicable)
         explanation_prompt = prepare_explanation_prompt(code, provider)
-        
+
         # Generate the explanation
         explanation = generate_explanation_openai(explanation_prompt)
-        return explanation
+        if store is not None:
+            store.put(code, provider, explanation)
+        return explanation, explanation_prompt
+
+# Function to generate explanation in a separate thread.
+# With a store (see explanation_store.py) the result is kept for later requests of the same code.
+def generate_explanation_async(code, provider, store=None):
+    try:
+        return generate_explanation(code, provider, store)[0]
+    except Exception as e:
+        print(f"Error generating explanation: {str(e)}")
+        return None
+
+# Coroutine counterpart of generate_explanation_async, run as an asyncio task
+async def generate_explanation_aio(code, provider):
+    try:
+        with tracing.span('explanation', provider=provider or 'none'):
+            explanation_prompt = await prepare_explanation_prompt_aio(code, provider)
+            return await generate_explanation_openai_async(explanation_prompt)
     except Exception as e:
         print(f"Error generating explanation: {str(e)}")
         return None
+
+def submit_explanation(code, provider, mode, store=None):
+    """Submit the LLM explanation for the given explanation mode. Returns a future, or None in graph mode."""
+    if mode == 'graph':
+        return None
+    if mode == 'hybrid':
+        # Hybrid-mode LLM explanations run on the enrichment pool so the request never waits on
+        # them. A late result still lands in the store, so a later /explain of the same code
+        # is instant. Meant to outlive the request, so it is not bound by the request's deadline;
+        # when the pool is saturated the enrichment is dropped and the graph explanation is used.
+        try:
+            return executors.enrichment.submit(
+                tracing.bind(deadline.detached(generate_explanation_async)), code, provider, store
+            )
+        except executors.ExecutorBusy:
+            return None
+    return executors.llm.submit_or_run(tracing.bind(generate_explanation_async), code, provider, store)
+
+def start_explanation(code, provider, mode, store):
+    """(stored explanation, future): the stored explanation of code, else its submitted LLM one.
+    Both are None in graph mode."""
+    if mode == 'graph':
+        return None, None
+    stored = store.get(code, provider)
+    if stored:
+        return stored, None
+    return None, submit_explanation(code, provider, mode, store)
+
+def explain_with_store(code, provider, store, digest=None):
+    """(explanation, source, prompt): the stored explanation of code (prompt None), else a new LLM
+    one that is stored for next time. Raises on LLM errors."""
+    stored = store.get(code, provider, digest)
+    if stored:
+        return stored, 'stored', None
+    explanation, prompt = generate_explanation(code, provider, store)
+    return explanation, 'llm', prompt
+
+def cancel_explanation(future, mode):
+    """Drop a request's LLM explanation that has not started (hybrid ones are meant to outlive it)"""
+    if future is not None and mode != 'hybrid':
+        future.cancel()
+
+def finish_explanation(future, code, provider, mode, timeout=None):
+    """Return (explanation, source). Uses the graph explanation when the LLM one failed, is not ready
+    in hybrid mode, or is not ready within timeout (the time left before the request's deadline)."""
+    explanation = None
+    if future is not None and (mode == 'llm' or future.done()):
+        try:
+            explanation = future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            print("Explanation not ready before the request deadline; using the graph explanation")
+            future.cancel()
+        except Exception as e:
+            print(f"Error getting explanation result: {str(e)}")
+    if explanation:
+        return explanation, 'llm'
+    with tracing.span('explanation.graph'):
+        return explain_graph(code, provider), 'graph'
@@ -0,0 +1,341 @@
+# Shared, framework-independent stages of the /generate pipeline.
+# Used by the synchronous Flask handler in app.py and the native ASGI handler in
+# async_app.py, so both paths sanitize, classify and package results identically.
+import os
+import re
+import subprocess
+
+from layout import plan_layout, layout_env
+import ledger
+import profiling
+from node_catalog import fix_imports
+
+# ===================
+# Instruction files
+# ===================
+# Map providers to rewrite instruction files
+REWRITE_INSTRUCTION_FILES = {
+    'aws': 'instructions/rewrite/instructions_aws_rewrite.md',
+    'azure': 'instructions/rewrite/instructions_azure_rewrite.md',
+    'gcp': 'instructions/rewrite/instructions_gcp_rewrite.md'
+}
+
+# Map providers to instruction files in the /instructions/generate directory
+GENERATE_INSTRUCTION_FILES = {
+    'aws': 'instructions/generate/instructions_aws_simplified.md',
+    'azure': 'instructions/generate/instructions_azure_simplified.md',
+    'gcp': 'instructions/generate/instructions_gcp_simplified.md'
+}
+
+EDIT_INSTRUCTIONS_FILE = 'instructions/edit/instructions_edit.md'
+
+OUTPUT_FORMATS = ["png", "svg", "pdf", "dot", "jpg"]
+
+RENDER_TIMEOUT = 60
+
+# Written to generated_diagram.md when a job ends without any explanation
+NO_EXPLANATION_PLACEHOLDER = "(No explanation generated)"
+
+# Runs generated_diagram.py with the chosen layout plan (see layout.py)
+RENDER_RUNNER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'render_runner.py')
+
+# Job ids are the provider-prefixed workspace/storage folder names, e.g. aws-<uuid4>
+JOB_ID_RE = re.compile(r'^[a-z]+-[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+
+# Explanation modes, selectable per request with "explanation_mode":
+#   llm    - model-written explanation (two LLM calls, awaited after rendering)
+#   graph  - templated from the parsed diagram graph, no LLM calls
+#   hybrid - graph explanation unless the LLM one is already finished when rendering is done
+EXPLANATION_MODES = ('llm', 'graph', 'hybrid')
+DEFAULT_EXPLANATION_MODE = os.environ.get('EXPLANATION_MODE', 'llm').lower()
+
+QUOTA_ERROR_MESSAGE = (
+    'OpenAI API quota exceeded. Please check your plan and billing at https://platform.openai.com/account/usage'
+)
+
+
+def read_rewrite_instructions(provider):
+    """Return the provider's rewrite instructions, or None if there are none"""
+    rewrite_instructions_file = REWRITE_INSTRUCTION_FILES.get(provider)
+    if rewrite_instructions_file and os.path.exists(rewrite_instructions_file):
+        with open(rewrite_instructions_file, 'r') as f:
+            return f.read()
+    return None
+
+
+def is_quota_error(e):
+    return (hasattr(e, 'status_code') and e.status_code == 429) or 'quota' in str(e).lower() or 'rate limit' in str(e).lower()
+
+
+# ===================
+# Request validation
+# ===================
+def validate_generate_request(data):
+    """Validate a /generate body. Returns (description, provider, error) with error as (message, status)."""
+    description = data.get('description') if data else None
+    if not isinstance(description, str) or not description.strip():
+        return None, None, ('Description must be a non-empty string.', 400)
+    if len(description) > 15000:
+        return None, None, ('Description is too long (max 15000 chars).', 400)
+
+    provider = data.get('provider') if data else None
+    provider = provider.strip().lower() if provider else None
+    if not provider:
+        return None, None, ('No cloud provider specified. Please set provider to aws, azure, or gcp.', 400)
+    return description, provider, None
+
+
+def read_explanation_mode(data):
+    """Return (mode, error) for the optional explanation_mode field, error as (message, status)"""
+    mode = (data or {}).get('explanation_mode') or DEFAULT_EXPLANATION_MODE
+    if not isinstance(mode, str) or mode.strip().lower() not in EXPLANATION_MODES:
+        return None, (f"explanation_mode must be one of: {', '.join(EXPLANATION_MODES)}.", 400)
+    return mode.strip().lower(), None
+
+
+# ===================
+# Code handling
+# ===================
+def non_code_response_message(code):
+    """Return a user-facing message if the LLM answered with something other than code"""
+    if code.strip().lower().startswith("sorry") or not ("import" in code or "with Diagram" in code):
+        user_msg = code.strip().splitlines()[0] if code.strip() else "The model could not generate valid code for your request."
+        return f"The model could not generate valid code for your request: {user_msg}"
+    return None
+
+
+def normalize_render_code(code):
+    """The code as it will be rendered, and the import fixes applied: fixed output filename and PNG
+    format, show=False, near-miss node imports fixed. No logging, so it is safe for hashing."""
+    code = re.sub(r'filename\s*=\s*["\']([^"\']+)["\']', 'filename="generated_diagram"', code)
+    code = re.sub(r'outformat\s*=\s*["\']([^"\']+)["\']', 'outformat="png"', code)
+
+    # Always inject show=False into every with Diagram(...) statement
+    def _inject_show_false(match):
+        args = match.group(1)
+        if 'show=' in args:
+            # Replace any show=... with show=False
+            args = re.sub(r'show\s*=\s*\w+', 'show=False', args)
+        else:
+            if args.strip():
+                args = args.strip() + ', show=False'
+            else:
+                args = 'show=False'
+        return f'with Diagram({args})'
+    code = re.sub(r'with Diagram\(([^)]*)\)', _inject_show_false, code)
+
+    # Hallucinated class names (Fargates, S3 imported from compute) would fail the render
+    return fix_imports(code)
+
+
+def sanitize_code(code):
+    """Force a fixed output filename and PNG format, never open a viewer, and fix near-miss node imports"""
+    code, fixes = normalize_render_code(code)
+    if fixes:
+        print(f"Fixed diagrams imports: {'; '.join(fixes)}")
+        ledger.annotate(import_fixes=fixes)
+    return code
+
+
+def save_inputs(folder, original_description, rewritten_description):
+    # Save the original user input
+    with open(os.path.join(folder, 'original_input.txt'), 'w') as f:
+        f.write(original_description or "")
+    # Always save the rewritten description (use original if rewriting failed)
+    with open(os.path.join(folder, 'rewritten_input.txt'), 'w') as f:
+        f.write(rewritten_description or original_description or "")
+
+
+# ===================
+# Rendering results
+# ===================
+def classify_render_failure(stderr):
+    """Return a user-facing message for render failures caused by invalid code, else None"""
+    # If it's a SyntaxError or the code is not valid Python
+    if 'SyntaxError' in stderr or 'invalid syntax' in stderr:
+        return 'Diagram code execution failed due to invalid or non-Python code.'
+    # If it's a TypeError for list >> list
+    if 'TypeError' in stderr and 'unsupported operand type(s) for >>' in stderr:
+        return 'Diagram code execution failed: You cannot use >> between lists of nodes. Connect nodes individually or use a nested loop.'
+    return None
+
+
+def render_command():
+    return ['python3', RENDER_RUNNER, 'generated_diagram.py']
+
+
+def render_setup(folder, timeout=RENDER_TIMEOUT, layout='auto'):
+    """Return (argv, env) for rendering folder's generated_diagram.py with a layout plan for its size"""
+    with open(os.path.join(folder, 'generated_diagram.py'), 'r') as f:
+        plan = plan_layout(f.read(), layout, timeout)
+    env = layout_env(plan)
+    env.update(profiling.render_env(folder))
+    return render_command(), env
+
+
+def render_diagram(folder, timeout=RENDER_TIMEOUT, layout='auto'):
+    """Run generated_diagram.py with folder as its working directory (no process-wide chdir)"""
+    argv, env = render_setup(folder, timeout, layout)
+    return subprocess.run(
+        argv,
+        cwd=folder,
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=timeout
+    )
+
+
+def render_failure_payload(stdout, stderr, folder, code, raw_code_url, sanitized_code_url):
+    """Build the (payload, status) for a failed render, returning a partial image (206) if one was written"""
+    failure_message = classify_render_failure(stderr)
+    if failure_message:
+        return {
+            'error': failure_message,
+            'stderr': stderr,
+            'stdout': stdout,
+            'raw_code_url': raw_code_url,
+            'sanitized_code_url': sanitized_code_url
+        }, 422
+    # Try to return the diagram if it was generated, even if there was an error
+    candidates = infer_image_candidates(code)
+    # Fallback: any .png in the folder
+    candidates += sorted(f for f in os.listdir(folder) if f.endswith('.png'))
+    for candidate in candidates:
+        candidate_path = os.path.join(folder, candidate)
+        if _is_within(folder, candidate_path) and os.path.exists(candidate_path):
+            return {
+                'diagram_path': candidate,
+                'image_url': f'/diagrams/{os.path.basename(folder)}/{candidate.replace(os.sep, "/")}',
+                'error': 'Diagram code execution failed',
+                'stderr': stderr,
+                'stdout': stdout
+            }, 206
+    return {
+        'error': 'Diagram code execution failed',
+        'stderr': stderr,
+        'stdout': stdout,
+        'raw_code_url': raw_code_url,
+        'sanitized_code_url': sanitized_code_url
+    }, 500
+
+
+def _is_within(folder, path):
+    """True if path resolves inside folder (filenames come from generated code)"""
+    folder = os.path.realpath(folder)
+    return os.path.commonpath([folder, os.path.realpath(path)]) == folder
+
+
+def infer_image_candidates(code_content):
+    """Guess the image filenames a script will write, from filename= or the Diagram title"""
+    image_candidates = []
+    m = re.search(r'filename\s*=\s*["\']([^"\']+)["\']', code_content)
+    if m:
+        base = m.group(1)
+        base_png = base if base.endswith('.png') else base + '.png'
+        image_candidates.append(base_png)
+        image_candidates.append(os.path.basename(base_png))
+    else:
+        m2 = re.search(r'with Diagram\((?:["\'])(.*?)(?:["\'])', code_content)
+        if m2:
+            title = m2.group(1)
+            title_clean = title.lower().replace(' ', '_').replace('/', '_')
+            image_candidates.append(title_clean + '.png')
+    return image_candidates
+
+
+def fix_svg_inplace(svg_path):
+    try:
+        # Instead of spawning a Python process, directly perform the necessary fix
+        # This avoids process creation overhead
+        with open(svg_path, 'r') as f:
+            content = f.read()
+
+        # Apply icon fixes (simplified version of what fix_svg_icons.py would do)
+        # This is a basic implementation - adjust based on what fix_svg_icons.py actually does
+        fixed_content = content
+
+        # Common SVG fixes (example)
+        if "<svg " in content and "xmlns=" not in content:
+            fixed_content = content.replace("<svg ", '<svg xmlns="http://www.w3.org/2000/svg" ')
+
+        # Write back only if changes were made
+        if fixed_content != content:
+            with open(svg_path, 'w') as f:
+                f.write(fixed_content)
+    except Exception as e:
+        print(f"Error fixing SVG file: {str(e)}")
+
+
+def collect_output_base_names(folder, code_content):
+    """Find the base names of rendered outputs in folder, fixing SVGs on the way"""
+    base_names = set()
+    try:
+        for candidate in infer_image_candidates(code_content)[-1:]:
+            base_names.add(os.path.splitext(os.path.basename(candidate))[0])
+    except Exception as e:
+        print(f"Could not infer image filename from code: {e}")
+    # Fallback: search for any output file in folder and subfolders
+    for root, dirs, files in os.walk(folder):
+        for fname in files:
+            for ext in OUTPUT_FORMATS:
+                if fname.endswith('.' + ext):
+                    base = os.path.splitext(fname)[0]
+                    base_names.add(base)
+                    # If SVG, fix icons in place
+                    if ext == "svg":
+                        fix_svg_inplace(os.path.join(root, fname))
+    return base_names
+
+
+def save_explanation(folder, explanation):
+    try:
+        md_path = os.path.join(folder, 'generated_diagram.md')
+        with open(md_path, 'w') as f:
+            f.write(explanation or NO_EXPLANATION_PLACEHOLDER)
+    except Exception as e:
+        print(f"Failed to save explanation markdown: {e}")
+
+
+def list_upload_files(folder):
+    """Map filename -> local path for every non-hidden file in folder"""
+    files_to_upload = {}
+    for root, dirs, files in os.walk(folder):
+        for fname in files:
+            if fname.startswith('.'):
+                continue  # skip hidden files like .DS_Store
+            files_to_upload[fname] = os.path.join(root, fname)
+    return files_to_upload
+
+
+def build_generate_response(uploaded_files, base_names, explanation, artifact_sizes, explanation_source=None,
+                            timings=None):
+    """Assemble the /generate success payload from uploaded file URLs"""
+    # Map file extensions to storage URLs for diagram_files
+    urls = {}
+    for base in base_names:
+        for ext in OUTPUT_FORMATS:
+            fname = f"{base}.{ext}"
+            if fname in uploaded_files:
+                urls[ext] = uploaded_files[fname]
+
+    response_data = {
+        'diagram_files': urls,  # storage URLs for images and outputs
+        'raw_code_url': uploaded_files.get('generated_diagram_raw.py'),
+        'sanitized_code_url': uploaded_files.get('generated_diagram.py'),
+        'explanation': explanation,
+        'explanation_md_url': uploaded_files.get('generated_diagram.md'),
+        'explanation_source': explanation_source,  # "llm", "graph" or "stored"
+        'uploaded_files': uploaded_files,  # storage URLs for all files
+        'artifact_sizes': artifact_sizes,  # bytes before/after optimization
+        'timings': timings  # seconds per stage, plus the chosen layout engine
+    }
+
+    # Add input URLs if they exist
+    original_input_url = uploaded_files.get('original_input.txt')
+    rewritten_input_url = uploaded_files.get('rewritten_input.txt')
+    if original_input_url:
+        response_data['original_input_url'] = original_input_url
+    if rewritten_input_url:
+        response_data['rewritten_input_url'] = rewritten_input_url
+    return response_data
@@ -0,0 +1,228 @@
+# Opt-in per-request profiling.
+# A request is profiled when it carries `X-Profile: <PROFILE_TOKEN>`, or when it is picked
+# by PROFILE_SAMPLE_RATE. The handler thread runs under cProfile plus a stack sampler,
+# and the render subprocess (render_runner.py) does the same when PROFILE_DIR_ENV is set.
+# On the ASGI path the handler thread is the event loop, which every concurrent request shares,
+# so that profile is loop-wide: it is stored as loop.* and counts the requests that overlapped it.
+# Profiles are stored next to the request's artifacts:
+#   <job folder>/profile/handler.pstats     - cProfile stats (load with pstats.Stats)
+#   <job folder>/profile/handler.collapsed  - sampled stacks, one "a;b;c count" line each (flamegraph.pl, speedscope)
+#   <job folder>/profile/loop.pstats / .collapsed - the same for the event-loop thread (ASGI)
+#   <job folder>/profile/render-<workspace>.pstats / .collapsed
+# Requests without a job folder (errors) store them under profiles/<trace id>/.
+import os
+import sys
+import hmac
+import time
+import random
+import shutil
+import marshal
+import cProfile
+import tempfile
+import threading
+import contextvars
+
+# ===================
+# Configuration
+# ===================
+# PROFILE_TOKEN: value of the X-Profile header that enables profiling (default: ADMIN_TOKEN; unset: header ignored)
+# PROFILE_SAMPLE_RATE: fraction of POST requests profiled without the header (default 0)
+# PROFILE_SAMPLE_INTERVAL: seconds between stack samples
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN') or os.environ.get('ADMIN_TOKEN')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', '0.005'))
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_DIR_ENV = 'DIAGRAM_PROFILE_DIR'  # where the render subprocess writes its profile
+PROFILE_PREFIX = 'profiles/'
+
+# What the calling thread's profile covers: one request, or the event loop shared by all of them
+HANDLER_SCOPE = 'handler'
+LOOP_SCOPE = 'loop'
+
+_active = contextvars.ContextVar('profiler', default=None)
+_loop_profilers = set()  # loop-wide profiles being recorded
+
+
+def should_profile(header_value):
+    """True if the X-Profile header carries the profile token, or the request is sampled"""
+    if header_value and PROFILE_TOKEN and hmac.compare_digest(header_value, PROFILE_TOKEN):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def _frame_name(code):
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class StackSampler:
+    """Samples one thread's Python stack at a fixed interval and counts identical stacks"""
+
+    def __init__(self, thread_id, interval=PROFILE_SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in sorted(self.counts.items()))
+
+
+class Profiler:
+    """cProfile and a stack sampler for the calling thread"""
+
+    def __init__(self, scope=HANDLER_SCOPE, overlapping=0):
+        self.scope = scope
+        self.overlapping = overlapping  # other requests that ran on the profiled thread (loop scope)
+        self.profile = cProfile.Profile()
+        self.sampler = StackSampler(threading.get_ident())
+        self.profiling = False
+        self.started = None
+        self.seconds = None
+        self.render_dir = None  # created when a render subprocess is profiled
+
+    def start(self):
+        try:
+            self.profile.enable()
+            self.profiling = True
+        except ValueError:
+            # Python 3.12+ allows one cProfile at a time per process; the sampler still runs
+            print("cProfile busy with another request; sampling stacks only")
+        self.sampler.start()
+        self.started = time.monotonic()
+
+    def stop(self):
+        if self.seconds is not None:
+            return
+        self.seconds = time.monotonic() - self.started
+        if self.profiling:
+            self.profile.disable()
+        self.sampler.stop()
+
+    def dumps(self):
+        """Extension -> bytes: 'pstats' (the marshal format pstats.Stats loads) and 'collapsed'"""
+        files = {'collapsed': self.sampler.collapsed().encode()}
+        if self.profiling:
+            self.profile.create_stats()
+            files['pstats'] = marshal.dumps(self.profile.stats)
+        return files
+
+
+def start(scope=HANDLER_SCOPE, overlapping=0):
+    """Profile the rest of the current request. Returns a token for finish().
+
+    With LOOP_SCOPE, overlapping is the number of other requests already in flight on the loop;
+    request_started() counts the ones that start while the profile is recorded.
+    """
+    profiler = Profiler(scope, overlapping)
+    profiler.start()
+    if scope == LOOP_SCOPE:
+        _loop_profilers.add(profiler)
+    return _active.set(profiler)
+
+
+def request_started():
+    """Count a request starting on the event loop against every loop-wide profile being recorded"""
+    for profiler in _loop_profilers:
+        profiler.overlapping += 1
+
+
+def active():
+    return _active.get() is not None
+
+
+def render_env(folder):
+    """Environment for a render subprocess of a profiled request ({} when not profiling)"""
+    profiler = _active.get()
+    if profiler is None:
+        return {}
+    if profiler.render_dir is None:
+        profiler.render_dir = tempfile.mkdtemp(prefix='profile-')
+    return {PROFILE_DIR_ENV: os.path.join(profiler.render_dir, f'render-{os.path.basename(folder)}')}
+
+
+def _profile_files(profiler):
+    files = {f'{profiler.scope}.{ext}': data for ext, data in profiler.dumps().items()}
+    if profiler.render_dir is not None:
+        for name in sorted(os.listdir(profiler.render_dir)):
+            with open(os.path.join(profiler.render_dir, name), 'rb') as f:
+                files[name] = f.read()
+    return files
+
+
+def stop(token):
+    """Stop profiling the current request. Must run on the thread that called start().
+    Returns the stopped profiler for store(), or None."""
+    profiler = _active.get()
+    try:
+        _active.reset(token)
+    except ValueError:
+        _active.set(None)
+    if profiler is not None:
+        profiler.stop()
+        _loop_profilers.discard(profiler)
+    return profiler
+
+
+def store(profiler, storage, folder=None, trace_id=None):
+    """Store a stopped profiler's profiles (blocking I/O). Returns {name: url}, or None if storing failed."""
+    if profiler is None:
+        return None
+    prefix = f'{folder}/profile/' if folder else f'{PROFILE_PREFIX}{trace_id or "unknown"}/'
+    try:
+        urls = {}
+        for name, data in _profile_files(profiler).items():
+            storage.put_bytes(data, prefix + name)
+            urls[name] = storage.url(prefix + name)
+        if profiler.scope == LOOP_SCOPE:
+            print(f"Stored loop-wide profile ({profiler.seconds:.3f}s, {profiler.overlapping} overlapping "
+                  f"requests) under {prefix}")
+        else:
+            print(f"Stored request profile ({profiler.seconds:.3f}s) under {prefix}")
+        return urls
+    except Exception as e:
+        print(f"Failed to store request profile: {str(e)}")
+        return None
+    finally:
+        if profiler.render_dir is not None:
+            shutil.rmtree(profiler.render_dir, ignore_errors=True)
+
+
+def finish(token, storage, folder=None, trace_id=None):
+    """Stop profiling and store the profiles. Returns {name: url}, or None if storing failed."""
+    return store(stop(token), storage, folder, trace_id)
+
+
+def profile_render(main, *args):
+    """Used by render_runner.py: run main(*args), profiled into <PROFILE_DIR_ENV>.pstats/.collapsed if set"""
+    base = os.environ.get(PROFILE_DIR_ENV)
+    if not base:
+        return main(*args)
+    profiler = Profiler()
+    profiler.start()
+    try:
+        return main(*args)
+    finally:
+        profiler.stop()
+        for ext, data in profiler.dumps().items():
+            with open(f'{base}.{ext}', 'wb') as f:
+                f.write(data)
@@ -0,0 +1,53 @@
+# Runs generated_diagram.py with the layout plan chosen by the API.
+# Usage (cwd = the request workspace): python3 render_runner.py generated_diagram.py
+# The plan arrives in DIAGRAM_LAYOUT_PLAN; without it the script runs unchanged.
+import os
+import sys
+import json
+import time
+import runpy
+import subprocess
+
+import diagrams
+
+from layout import LAYOUT_PLAN_ENV, run_layout, render_positioned, write_layout_report
+from profiling import profile_render
+
+
+def install_layout(plan):
+    """Replace Diagram.render with a time-bounded layout followed by per-format drawing"""
+    def render(self):
+        formats = self.outformat if isinstance(self.outformat, list) else [self.outformat]
+        start = time.monotonic()
+        self.dot.save()  # Diagram.__exit__ removes the source file after rendering
+        positioned, report = run_layout(self.dot, plan['attempts'], plan['deadline'])
+        render_start = time.monotonic()
+        render_positioned(positioned, self.filename, formats, max(1.0, plan['deadline'] - (render_start - start)))
+        report.update({
+            'render': round(time.monotonic() - render_start, 3),
+            'size': plan.get('size'),
+            'nodes': plan.get('nodes'),
+            'edges': plan.get('edges'),
+        })
+        write_layout_report(report)
+
+    diagrams.Diagram.render = render
+
+
+def main(script):
+    plan = os.environ.get(LAYOUT_PLAN_ENV)
+    if plan:
+        install_layout(json.loads(plan))
+    # Behave like `python3 generated_diagram.py`: the script's directory comes first on sys.path
+    sys.path[0] = os.path.dirname(os.path.abspath(script))
+    sys.argv = [script]
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except subprocess.CalledProcessError as e:
+        sys.stderr.write((e.stderr or b'').decode(errors='replace'))
+        raise
+
+
+if __name__ == '__main__':
+    # Profiled into DIAGRAM_PROFILE_DIR when the request that started this render is profiled
+    profile_render(main, sys.argv[1])
@@ -0,0 +1,317 @@
+# Replays stored production inputs against a deployment, for capacity planning.
+# Every job folder keeps original_input.txt (and rewritten_input.txt, generated_diagram_raw.py,
+# generated_diagram.md), so the artifact storage is a corpus of real descriptions per provider.
+# Requests arrive open-loop (Poisson arrivals at a fixed rate, whether or not earlier ones
+# finished), so latencies include queueing once the target falls behind.
+#
+#   python replay.py --source s3://my-bucket --target https://api.example.com --rates 0.5,1,2 --duration 60
+#   python replay.py --source ./artifacts --target http://localhost:5000 --fake-llm --mix aws=2,gcp=1
+#
+# --fake-llm sends each job's stored model output along with the request; a target running
+# with FAKE_LLM=1 answers its LLM calls with it (see fake_llm.py), so the run measures
+# rendering, storage and the server without spending tokens.
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import concurrent.futures
+
+import requests
+
+from ledger import percentiles
+from storage import S3Storage, LocalStorage
+
+PROVIDERS = ('aws', 'azure', 'gcp')
+
+# Stored files of a job used by the replay
+INPUT_FILE = 'original_input.txt'
+REWRITTEN_FILE = 'rewritten_input.txt'
+RAW_CODE_FILE = 'generated_diagram_raw.py'
+EXPLANATION_FILE = 'generated_diagram.md'
+
+
+# ===================
+# Corpus
+# ===================
+def open_source(source):
+    """(storage, prefix) for s3://bucket[/prefix] or a local artifact directory"""
+    if source.startswith('s3://'):
+        bucket, _, prefix = source[len('s3://'):].partition('/')
+        return S3Storage(bucket), prefix
+    return LocalStorage(source), ''
+
+
+def _read_text(storage, key):
+    data = storage.get_bytes(key)
+    return data.decode(errors='replace') if data is not None else None
+
+
+def harvest(storage, prefix='', providers=PROVIDERS, limit=None, fake_llm=False):
+    """Stored inputs of past jobs: [{'job', 'provider', 'description', 'rewritten', 'code', 'explanation'}].
+
+    With fake_llm only jobs that kept their generated code are used.
+    """
+    jobs = sorted(
+        key[:-len(INPUT_FILE) - 1] for key in storage.list_keys(prefix) if key.endswith('/' + INPUT_FILE)
+    )
+    corpus = []
+    for job in jobs:
+        provider = job.rsplit('/', 1)[-1].split('-', 1)[0]
+        if provider not in providers:
+            continue
+        item = {
+            'job': job,
+            'provider': provider,
+            'description': _read_text(storage, f'{job}/{INPUT_FILE}'),
+            'rewritten': None,
+            'code': None,
+            'explanation': None,
+        }
+        if not item['description'] or not item['description'].strip():
+            continue
+        if fake_llm:
+            item['code'] = _read_text(storage, f'{job}/{RAW_CODE_FILE}')
+            if not item['code']:
+                continue
+            item['rewritten'] = _read_text(storage, f'{job}/{REWRITTEN_FILE}')
+            item['explanation'] = _read_text(storage, f'{job}/{EXPLANATION_FILE}')
+        corpus.append(item)
+        if limit and len(corpus) >= limit:
+            break
+    return corpus
+
+
+def parse_mix(text):
+    """'aws=2,gcp=1' -> {'aws': 2.0, 'gcp': 1.0}; raises ValueError on unknown providers or weights"""
+    mix = {}
+    for part in filter(None, (p.strip() for p in text.split(','))):
+        provider, _, weight = part.partition('=')
+        provider = provider.strip().lower()
+        if provider not in PROVIDERS:
+            raise ValueError(f'unknown provider in mix: {provider}')
+        mix[provider] = float(weight) if weight else 1.0
+        if mix[provider] < 0:
+            raise ValueError(f'negative weight for {provider}')
+    return mix
+
+
+class Corpus:
+    """Picks stored inputs according to a provider mix"""
+
+    def __init__(self, items, mix=None):
+        self.by_provider = {}
+        for item in items:
+            self.by_provider.setdefault(item['provider'], []).append(item)
+        mix = mix or {p: 1.0 for p in self.by_provider}
+        self.weights = {p: w for p, w in mix.items() if w > 0 and p in self.by_provider}
+        if not self.weights:
+            raise ValueError('no stored inputs for the requested provider mix')
+
+    def pick(self, rng):
+        providers = list(self.weights)
+        provider = rng.choices(providers, weights=[self.weights[p] for p in providers])[0]
+        return rng.choice(self.by_provider[provider])
+
+
+def build_request(item, explanation_mode=None, fake_llm=False, fake_delay=0.0):
+    """/generate body for a stored input"""
+    body = {'description': item['description'], 'provider': item['provider']}
+    if explanation_mode:
+        body['explanation_mode'] = explanation_mode
+    if fake_llm:
+        body['fake_llm'] = {
+            'rewrite': item['rewritten'] or item['description'],
+            'code': item['code'],
+            'explanation': item['explanation'],
+            'delay': fake_delay,
+        }
+    return body
+
+
+# ===================
+# Requests
+# ===================
+def error_class(status, payload=None, exc=None):
+    """Coarse class of a failed request, e.g. 'timeout', '504', '422 invalid code'"""
+    if exc is not None:
+        if isinstance(exc, requests.Timeout):
+            return 'timeout'
+        if isinstance(exc, requests.ConnectionError):
+            return 'connection'
+        return type(exc).__name__
+    message = (payload or {}).get('error') if isinstance(payload, dict) else None
+    if not message:
+        return str(status)
+    words = ''.join(c if c.isalpha() or c == ' ' else ' ' for c in message.lower()).split()
+    return f"{status} {' '.join(words[:4])}"
+
+
+_sessions = threading.local()
+
+
+def send_generate(target, body, timeout):
+    """POST /generate. Returns {'status', 'timings', 'error'} (error None on success)."""
+    session = getattr(_sessions, 'session', None)
+    if session is None:
+        session = _sessions.session = requests.Session()  # keep-alive per worker thread
+    try:
+        resp = session.post(f"{target.rstrip('/')}/generate", json=body, timeout=timeout)
+    except requests.RequestException as e:
+        return {'status': None, 'timings': {}, 'error': error_class(None, exc=e)}
+    try:
+        payload = resp.json()
+    except ValueError:
+        payload = None
+    timings = payload.get('timings') if isinstance(payload, dict) else None
+    return {
+        'status': resp.status_code,
+        'timings': timings or {},
+        'error': None if resp.status_code == 200 else error_class(resp.status_code, payload),
+    }
+
+
+# ===================
+# Load
+# ===================
+def run_step(corpus, target, rate, duration, concurrency, rng, send=send_generate, timeout=120, **request_options):
+    """Offer `rate` requests/s for `duration` seconds with Poisson arrivals, at most `concurrency` in flight.
+
+    Latency is measured from each request's scheduled arrival, so time spent waiting for a
+    free worker counts (no coordinated omission). Returns the step's summary.
+    """
+    arrivals = []
+    at = rng.expovariate(rate)
+    while at < duration:
+        arrivals.append(at)
+        at += rng.expovariate(rate)
+
+    results = []
+    lock = threading.Lock()
+
+    def worker(scheduled, item):
+        started = time.monotonic()
+        result = send(target, build_request(item, **request_options), timeout)
+        finished = time.monotonic()
+        result.update(provider=item['provider'], queue=started - scheduled, latency=finished - scheduled)
+        with lock:
+            results.append(result)
+
+    step_start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='replay') as pool:
+        for at in arrivals:
+            scheduled = step_start + at
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(worker, scheduled, corpus.pick(rng))
+    elapsed = time.monotonic() - step_start
+    return summarize_step(results, rate, duration, elapsed)
+
+
+def summarize_step(results, rate, duration, elapsed):
+    ok = [r for r in results if r['error'] is None]
+    errors = {}
+    for r in results:
+        if r['error'] is not None:
+            errors[r['error']] = errors.get(r['error'], 0) + 1
+    stages = {}
+    for r in ok:
+        for stage, seconds in r['timings'].items():
+            if isinstance(seconds, (int, float)) and not isinstance(seconds, bool):
+                stages.setdefault(stage, []).append(seconds)
+    return {
+        'offered_rate': rate,
+        'duration': duration,
+        'requests': len(results),
+        'ok': len(ok),
+        'error_rate': round(1 - len(ok) / len(results), 4) if results else 0.0,
+        'throughput': round(len(ok) / elapsed, 3) if elapsed > 0 else 0.0,
+        'latency': percentiles([r['latency'] for r in results]),
+        'queue': percentiles([r['queue'] for r in results]),
+        'stages': {stage: percentiles(values) for stage, values in sorted(stages.items())},
+        'providers': {p: sum(1 for r in results if r['provider'] == p)
+                      for p in sorted({r['provider'] for r in results})},
+        'errors': dict(sorted(errors.items(), key=lambda e: -e[1])),
+    }
+
+
+def throughput_ceiling(steps, max_error_rate=0.01, min_ratio=0.9):
+    """Highest throughput of a step the target kept up with: error rate within max_error_rate
+    and at least min_ratio of the offered rate completed"""
+    sustained = [
+        s for s in steps
+        if s['requests'] and s['error_rate'] <= max_error_rate and s['throughput'] >= min_ratio * s['offered_rate']
+    ]
+    return max((s['throughput'] for s in sustained), default=None)
+
+
+# ===================
+# Report
+# ===================
+def _fmt(p):
+    return ' '.join(f"{k}={v:.2f}s" for k, v in p.items() if v is not None) or '-'
+
+
+def print_report(report, out=sys.stdout):
+    for step in report['steps']:
+        print(f"\n== {step['offered_rate']} req/s for {step['duration']}s: {step['requests']} requests, "
+              f"{step['ok']} ok, throughput {step['throughput']} req/s, error rate {step['error_rate']:.2%}", file=out)
+        print(f"  latency  {_fmt(step['latency'])}", file=out)
+        print(f"  queue    {_fmt(step['queue'])}", file=out)
+        for stage, p in step['stages'].items():
+            print(f"  {stage:<24} {_fmt(p)}", file=out)
+        for error, count in step['errors'].items():
+            print(f"  error {error}: {count}", file=out)
+    ceiling = report['throughput_ceiling']
+    print(f"\nThroughput ceiling: {f'{ceiling} req/s' if ceiling is not None else 'not reached at any step'}",
+          file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay stored /generate inputs against a deployment.')
+    parser.add_argument('--source', required=True, help='s3://bucket[/prefix] or a local artifact directory')
+    parser.add_argument('--target', required=True, help='base URL of the deployment, e.g. http://localhost:5000')
+    parser.add_argument('--rates', default='1', help='offered request rates per step, req/s (comma separated)')
+    parser.add_argument('--duration', type=float, default=60, help='seconds per step')
+    parser.add_argument('--concurrency', type=int, default=32, help='maximum requests in flight')
+    parser.add_argument('--mix', default='', help='provider weights, e.g. aws=2,azure=1,gcp=1 (default: even)')
+    parser.add_argument('--limit', type=int, default=None, help='maximum stored inputs to load')
+    parser.add_argument('--explanation-mode', choices=('llm', 'graph', 'hybrid'), default=None)
+    parser.add_argument('--fake-llm', action='store_true', help='send stored model output (target needs FAKE_LLM=1)')
+    parser.add_argument('--fake-delay', type=float, default=0.0, help='seconds each faked LLM call takes')
+    parser.add_argument('--timeout', type=float, default=120, help='client timeout per request, seconds')
+    parser.add_argument('--max-error-rate', type=float, default=0.01, help='error rate a sustained step may have')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', dest='json_path', default=None, help='also write the report as JSON')
+    args = parser.parse_args(argv)
+
+    rates = [float(r) for r in args.rates.split(',') if r.strip()]
+    storage, prefix = open_source(args.source)
+    items = harvest(storage, prefix, limit=args.limit, fake_llm=args.fake_llm)
+    corpus = Corpus(items, parse_mix(args.mix))
+    print(f"Loaded {len(items)} stored inputs: "
+          + ', '.join(f'{p}={len(v)}' for p, v in sorted(corpus.by_provider.items())))
+
+    rng = random.Random(args.seed)
+    steps = [
+        run_step(corpus, args.target, rate, args.duration, args.concurrency, rng, timeout=args.timeout,
+                 explanation_mode=args.explanation_mode, fake_llm=args.fake_llm, fake_delay=args.fake_delay)
+        for rate in rates
+    ]
+    report = {
+        'target': args.target,
+        'fake_llm': args.fake_llm,
+        'steps': steps,
+        'throughput_ceiling': throughput_ceiling(steps, args.max_error_rate),
+    }
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,7 @@
 #!/bin/sh
-# Start the Flask app
+# Start the API. SERVER=asgi serves the async app with uvicorn, so one worker
+# can hold many concurrent /generate requests; the default runs the Flask app.
+if [ "$SERVER" = "asgi" ]; then
+    exec uvicorn async_app:app --host 0.0.0.0 --port 5050
+fi
 exec python3 app.py
@@ -0,0 +1,309 @@
+import os
+import shutil
+import threading
+
+from workspace import _dir_size
+from pipeline import JOB_ID_RE
+from explanation_store import EXPLANATION_PREFIX
+
+# ===================
+# Configuration
+# ===================
+# STORAGE_BACKEND: "s3" (default), "local" or "memory"
+# S3_BUCKET: bucket used by the s3 backend (required for it only)
+# ARTIFACT_ROOT: directory used by the local backend
+# ARTIFACT_URL_PREFIX: URL prefix under which local/memory artifacts are served
+# ARTIFACT_LOCAL_QUOTA_BYTES: bytes the local backend keeps; the least recently written
+#   job folders and stored explanations are evicted beyond it
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 's3').lower()
+ARTIFACT_URL_PREFIX = os.environ.get('ARTIFACT_URL_PREFIX', '/artifacts')
+ARTIFACT_LOCAL_QUOTA_BYTES = int(os.environ.get('ARTIFACT_LOCAL_QUOTA_BYTES', str(1024 * 1024 * 1024)))
+
+# Record prefixes the quota may evict key by key: caches that are rebuilt on a miss. The other
+# records (idempotency/ claims of running requests, ledger/, profiles/) are never evicted.
+EVICTABLE_RECORD_PREFIXES = (EXPLANATION_PREFIX,)
+
+
+class ArtifactStorage:
+    """Interface for where generated artifacts are stored and how clients reach them.
+
+    Keys are `<folder>/<filename>` strings, e.g. `aws-<uuid>/generated_diagram.png`.
+    """
+    name = 'base'
+
+    def put_file(self, local_path, key):
+        """Store a local file under key. The local file may be consumed (moved)."""
+        raise NotImplementedError
+
+    def put_bytes(self, data, key):
+        raise NotImplementedError
+
+    def put_bytes_if_absent(self, data, key):
+        """Store data under key only if nothing is stored there. Returns False if the key exists."""
+        raise NotImplementedError
+
+    def get_bytes(self, key):
+        """Return the stored content, or None if the key does not exist"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Remove key; missing keys are ignored"""
+        raise NotImplementedError
+
+    def url(self, key, expires_in=3600):
+        """Return a URL the client can fetch the artifact from, or None on failure"""
+        raise NotImplementedError
+
+    def list_keys(self, prefix=''):
+        raise NotImplementedError
+
+    def local_path(self, key):
+        """Filesystem path of the artifact for zero-copy serving, if the backend has one"""
+        return None
+
+    def warm(self):
+        """Open connections ahead of the first request. Returns True if there was anything to warm."""
+        return False
+
+
+class S3Storage(ArtifactStorage):
+    name = 's3'
+
+    def __init__(self, bucket, client=None):
+        import boto3
+        self.bucket = bucket
+        self.client = client or boto3.client("s3")
+
+    def put_file(self, local_path, key):
+        self.client.upload_file(local_path, self.bucket, key)
+
+    def warm(self):
+        # Resolves credentials and opens a pooled TLS connection to the bucket's endpoint
+        self.client.head_bucket(Bucket=self.bucket)
+        return True
+
+    def put_bytes(self, data, key):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+
+    def put_bytes_if_absent(self, data, key):
+        from botocore.exceptions import ClientError
+        try:
+            # S3 conditional write: fails with 412 if the key exists, 409 if a concurrent write won
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=data, IfNoneMatch='*')
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                return False
+            raise
+        return True
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def get_bytes(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return None
+            raise
+
+    def url(self, key, expires_in=3600):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.generate_presigned_url(
+                'get_object',
+                Params={'Bucket': self.bucket, 'Key': key},
+                ExpiresIn=expires_in
+            )
+        except ClientError as e:
+            print(f"Failed to generate presigned URL for {key}: {e}")
+            return None
+
+    def list_keys(self, prefix=''):
+        keys = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        return keys
+
+
+class LocalStorage(ArtifactStorage):
+    """Artifacts on the local filesystem, moved (not copied) into place and served by the app.
+
+    Kept within quota_bytes: once a write exceeds it, whole job folders and single keys under
+    EVICTABLE_RECORD_PREFIXES are removed least recently written first.
+    """
+    name = 'local'
+
+    def __init__(self, root, url_prefix=ARTIFACT_URL_PREFIX, quota_bytes=ARTIFACT_LOCAL_QUOTA_BYTES):
+        self.root = os.path.abspath(root)
+        self.url_prefix = url_prefix.rstrip('/')
+        self.quota_bytes = quota_bytes
+        os.makedirs(self.root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._used = _dir_size(self.root)
+
+    def _size(self, path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def _eviction_candidates(self, key):
+        """(mtime, path, name) of everything the quota may remove, except key and its job folder"""
+        keep_folder, keep_path = key.split('/', 1)[0], self.local_path(key)
+        candidates = []
+        for entry in os.scandir(self.root):
+            if entry.is_dir() and JOB_ID_RE.match(entry.name) and entry.name != keep_folder:
+                paths = [(entry.path, entry.name)]
+            elif entry.is_dir() and entry.name + '/' in EVICTABLE_RECORD_PREFIXES:
+                paths = [
+                    (os.path.join(root, fname), os.path.relpath(os.path.join(root, fname), self.root))
+                    for root, dirs, files in os.walk(entry.path) for fname in files
+                ]
+            else:
+                continue
+            for path, name in paths:
+                if path == keep_path:
+                    continue
+                try:
+                    candidates.append((os.stat(path).st_mtime, path, name))
+                except OSError:
+                    pass  # removed concurrently
+        return sorted(candidates, key=lambda c: c[0])
+
+    def _account(self, delta, key):
+        """Add delta bytes written under key, evicting job folders and cached records beyond the quota"""
+        with self._lock:
+            self._used += delta
+            if self._used <= self.quota_bytes:
+                return
+            for _, path, name in self._eviction_candidates(key):
+                if self._used <= self.quota_bytes:
+                    break
+                if os.path.isdir(path):
+                    size = _dir_size(path)
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    size = self._size(path)
+                    try:
+                        os.remove(path)
+                        os.rmdir(os.path.dirname(path))  # the key's folder, once it is empty
+                    except OSError:
+                        pass
+                self._used -= size
+                print(f"Evicted stored artifacts {name} ({size} bytes) to stay within the storage quota")
+
+    def local_path(self, key):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            return None  # key escapes the storage root
+        return path
+
+    def put_file(self, local_path, key):
+        dest = self.local_path(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        delta = self._size(local_path) - self._size(dest)
+        # A rename on the same filesystem; shutil.move only copies across devices
+        shutil.move(local_path, dest)
+        self._account(delta, key)
+
+    def put_bytes(self, data, key):
+        dest = self.local_path(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        delta = len(data) - self._size(dest)
+        with open(dest, 'wb') as f:
+            f.write(data)
+        self._account(delta, key)
+
+    def put_bytes_if_absent(self, data, key):
+        dest = self.local_path(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        try:
+            with open(dest, 'xb') as f:
+                f.write(data)
+        except FileExistsError:
+            return False
+        self._account(len(data), key)
+        return True
+
+    def delete(self, key):
+        path = self.local_path(key)
+        if path and os.path.isfile(path):
+            size = self._size(path)
+            os.remove(path)
+            self._account(-size, key)
+
+    def get_bytes(self, key):
+        path = self.local_path(key)
+        if not path or not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def url(self, key, expires_in=3600):
+        return f"{self.url_prefix}/{key}"
+
+    def list_keys(self, prefix=''):
+        keys = []
+        for root, dirs, files in os.walk(self.root):
+            for fname in files:
+                key = os.path.relpath(os.path.join(root, fname), self.root).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+
+class MemoryStorage(ArtifactStorage):
+    """Process-local artifact store for tests and benchmarks; needs no network or disk"""
+    name = 'memory'
+
+    def __init__(self, url_prefix=ARTIFACT_URL_PREFIX):
+        self.url_prefix = url_prefix.rstrip('/')
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def put_file(self, local_path, key):
+        with open(local_path, 'rb') as f:
+            self.put_bytes(f.read(), key)
+
+    def put_bytes(self, data, key):
+        with self._lock:
+            self._objects[key] = bytes(data)
+
+    def put_bytes_if_absent(self, data, key):
+        with self._lock:
+            if key in self._objects:
+                return False
+            self._objects[key] = bytes(data)
+            return True
+
+    def get_bytes(self, key):
+        with self._lock:
+            return self._objects.get(key)
+
+    def delete(self, key):
+        with self._lock:
+            self._objects.pop(key, None)
+
+    def url(self, key, expires_in=3600):
+        return f"{self.url_prefix}/{key}"
+
+    def list_keys(self, prefix=''):
+        with self._lock:
+            return sorted(k for k in self._objects if k.startswith(prefix))
+
+
+def create_storage(backend=STORAGE_BACKEND, local_root=None):
+    """Build the storage backend selected by STORAGE_BACKEND"""
+    if backend == 's3':
+        bucket = os.environ.get('S3_BUCKET')
+        if not bucket:
+            raise RuntimeError("S3_BUCKET environment variable is not set")
+        return S3Storage(bucket)
+    if backend == 'local':
+        return LocalStorage(os.environ.get('ARTIFACT_ROOT') or local_root or 'artifacts')
+    if backend == 'memory':
+        return MemoryStorage()
+    raise RuntimeError(f"Unknown STORAGE_BACKEND: {backend}. Use s3, local or memory.")
@@ -1,7 +1,7 @@
 import os
 import tempfile
 import pytest
-from app import app, UPLOAD_FOLDER
+from app import app, UPLOAD_FOLDER, storage
 
 @pytest.fixture
 def client():
@@ -34,6 +34,224 @@ def test_diagram_file_serving(client):
     assert resp.data == b'1234'
     os.remove(test_file)
 
+def test_diagram_file_etag_and_conditional_get(client):
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    test_file = os.path.join(UPLOAD_FOLDER, 'etag.png')
+    with open(test_file, 'wb') as f:
+        f.write(b'png-bytes')
+    resp = client.get('/diagrams/etag.png')
+    etag = resp.headers.get('ETag')
+    assert resp.status_code == 200
+    assert resp.headers['Content-Type'] == 'image/png'
+    assert etag
+    resp = client.get('/diagrams/etag.png', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    os.remove(test_file)
+
+def test_diagram_file_range_request(client):
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    test_file = os.path.join(UPLOAD_FOLDER, 'range.pdf')
+    with open(test_file, 'wb') as f:
+        f.write(b'0123456789')
+    resp = client.get('/diagrams/range.pdf', headers={'Range': 'bytes=2-5'})
+    assert resp.status_code == 206
+    assert resp.data == b'2345'
+    os.remove(test_file)
+
+def test_diagram_file_gzip(client):
+    import gzip
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    test_file = os.path.join(UPLOAD_FOLDER, 'zip.svg')
+    with open(test_file, 'w') as f:
+        f.write('<svg></svg>' * 100)
+    resp = client.get('/diagrams/zip.svg', headers={'Accept-Encoding': 'gzip'})
+    assert resp.status_code == 200
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(resp.data) == b'<svg></svg>' * 100
+    os.remove(test_file)
+
+def test_large_text_artifact_is_compressed_from_disk(client, monkeypatch, tmp_path):
+    import gzip
+    import artifact_serving
+    monkeypatch.setattr(artifact_serving, 'ARTIFACT_CACHE_FILE_BYTES', 100)
+    monkeypatch.setattr(artifact_serving, 'ARTIFACT_ENCODED_DIR', str(tmp_path / 'encoded'))
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    test_file = os.path.join(UPLOAD_FOLDER, 'large.svg')
+    with open(test_file, 'w') as f:
+        f.write('<svg></svg>' * 1000)
+    for _ in range(2):  # compressed on the first request, reused on the second
+        resp = client.get('/diagrams/large.svg', headers={'Accept-Encoding': 'gzip'})
+        assert resp.status_code == 200
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert int(resp.headers['Content-Length']) == len(resp.data) < 11000
+        assert gzip.decompress(resp.data) == b'<svg></svg>' * 1000
+    assert len(os.listdir(tmp_path / 'encoded')) == 1
+    resp = client.get('/diagrams/large.svg', headers={'Accept-Encoding': 'gzip', 'If-None-Match': resp.headers['ETag']})
+    assert resp.status_code == 304
+    os.remove(test_file)
+
+def test_diagram_file_path_traversal(client):
+    resp = client.get('/diagrams/../app.py')
+    assert resp.status_code == 404
+
+JOB = 'aws-00000000-0000-4000-8000-000000000000'
+
+def test_stored_artifact_serving(client):
+    storage.put_bytes(b'- explanation', f'{JOB}/generated_diagram.md')
+    resp = client.get(f'/artifacts/{JOB}/generated_diagram.md')
+    assert resp.status_code == 200
+    assert resp.data == b'- explanation'
+    assert client.get(f'/artifacts/{JOB}/missing.md').status_code == 404
+    # The memory backend gets the same ETag and Range handling as files on disk
+    etag = resp.headers['ETag']
+    assert client.get(f'/artifacts/{JOB}/generated_diagram.md', headers={'If-None-Match': etag}).status_code == 304
+    resp = client.get(f'/artifacts/{JOB}/generated_diagram.md', headers={'Range': 'bytes=2-12'})
+    assert resp.status_code == 206 and resp.data == b'explanation'
+    # Records outside job folders stay private
+    storage.put_bytes(b'{}', 'ledger/ledger-1.jsonl')
+    assert client.get('/artifacts/ledger/ledger-1.jsonl').status_code == 404
+
+def test_health_reports_workspace_usage(client):
+    resp = client.get('/health')
+    assert resp.status_code == 200
+    usage = resp.get_json()['workspace']
+    assert 'used_bytes' in usage
+    assert 'quota_bytes' in usage
+
+def test_trace_id_is_propagated(client):
+    resp = client.get('/health', headers={'X-Trace-Id': 'd' * 32})
+    assert resp.headers['X-Trace-Id'] == 'd' * 32
+
+def test_edit_reuses_explanation_for_cosmetic_change(client, monkeypatch):
+    import subprocess
+    import app as app_module
+    job_id = 'aws-12345678-1234-1234-1234-123456789abc'
+    storage.put_bytes(b'from diagrams import Diagram\nwith Diagram("Old", show=False):\n    pass\n',
+                      f'{job_id}/generated_diagram.py')
+    storage.put_bytes(b'- stored explanation', f'{job_id}/generated_diagram.md')
+    storage.put_bytes(b'original', f'{job_id}/original_input.txt')
+
+    def mock_edit(code, change_request, instructions):
+        return '<<<<<<< SEARCH\nwith Diagram("Old", show=False):\n=======\nwith Diagram("New", show=False):\n>>>>>>> REPLACE'
+
+    def mock_render(folder, timeout=60, layout="auto"):
+        with open(os.path.join(folder, 'generated_diagram.png'), 'wb') as f:
+            f.write(b'png')
+        return subprocess.CompletedProcess([], 0, '', '')
+
+    monkeypatch.setattr(app_module, 'generate_edit_openai', mock_edit)
+    monkeypatch.setattr(app_module, 'render_diagram', mock_render)
+    resp = client.post(f'/generate/{job_id}/edit', json={'change': 'Rename the diagram to New'})
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert data['cosmetic'] is True
+    assert data['explanation'] == '- stored explanation'
+    assert data['parent_id'] == job_id
+    new_id = data['uploaded_files']['s3_folder']
+    assert b'"New"' in storage.get_bytes(f'{new_id}/generated_diagram.py')
+    assert storage.get_bytes(f'{new_id}/original_input.txt') == b'original'
+
+def test_generate_reports_layout_timings(client, monkeypatch):
+    import subprocess
+    import app as app_module
+    from layout import write_layout_report
+
+    def fake_run(argv, cwd=None, env=None, **kwargs):
+        assert 'DIAGRAM_LAYOUT_PLAN' in env
+        with open(os.path.join(cwd, 'generated_diagram.png'), 'wb') as f:
+            f.write(b'png')
+        write_layout_report({'engine': 'dot', 'layout': 0.25, 'fallback': False}, cwd)
+        return subprocess.CompletedProcess(argv, 0, '', '')
+
+    def no_chdir(path):
+        raise AssertionError('rendering must not change the process working directory')
+
+    monkeypatch.setattr(app_module, 'generate_rewrite_openai', lambda text, instructions: text)
+    monkeypatch.setattr(app_module, 'generate_code_openai', lambda description, instructions:
+                        'from diagrams import Diagram\nfrom diagrams.aws.compute import EC2\n'
+                        'with Diagram("Test", show=False):\n    EC2("web")')
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(os, 'chdir', no_chdir)
+    resp = client.post('/generate', json={
+        'description': 'web app', 'provider': 'aws', 'explanation_mode': 'graph', 'layout': 'auto'
+    })
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert data['timings']['layout_engine'] == 'dot'
+    assert data['timings']['layout'] == 0.25
+    assert data['explanation_source'] == 'graph'
+    assert '.layout.json' not in data['uploaded_files']
+
+def test_generate_idempotency_key_replays_response(client, monkeypatch):
+    import app as app_module
+    calls = []
+
+    def fake_generate():
+        calls.append(1)
+        return app_module.jsonify({'diagram_files': {}, 'uploaded_files': {'s3_folder': 'aws-idem'}})
+
+    monkeypatch.setattr(app_module, '_generate_diagram', fake_generate)
+    body = {'description': 'web app', 'provider': 'aws'}
+    first = client.post('/generate', json=body, headers={'Idempotency-Key': 'retry-1'})
+    second = client.post('/generate', json=body, headers={'Idempotency-Key': 'retry-1'})
+    assert first.status_code == second.status_code == 200
+    assert second.get_json() == first.get_json()
+    assert second.headers['Idempotent-Replayed'] == 'true'
+    assert len(calls) == 1
+    assert storage.get_bytes('aws-idem/response.json') is not None
+    other = client.post('/generate', json={'description': 'other', 'provider': 'aws'},
+                        headers={'Idempotency-Key': 'retry-1'})
+    assert other.status_code == 422
+
+def test_render_failure_payload_stays_in_workspace(tmp_path):
+    from pipeline import render_failure_payload
+    (tmp_path / 'partial.png').write_bytes(b'png')
+    code = 'with Diagram("x", filename="../../etc/passwd"):\n    pass'
+    payload, status = render_failure_payload('', 'boom', str(tmp_path), code, None, None)
+    assert status == 206
+    assert payload['diagram_path'] == 'partial.png'
+
+def test_generate_rejects_invalid_candidates(client):
+    resp = client.post('/generate', json={'description': 'web app', 'provider': 'aws', 'candidates': 99})
+    assert resp.status_code == 400
+    assert 'candidates' in resp.get_json()['error']
+
+def test_generate_rejects_unknown_layout(client):
+    resp = client.post('/generate', json={'description': 'web app', 'provider': 'aws', 'layout': 'circo'})
+    assert resp.status_code == 400
+
+def test_admin_ledger_summary(client, monkeypatch):
+    import app as app_module
+    monkeypatch.setattr(app_module, 'ADMIN_TOKEN', 'secret')
+    code = 'from diagrams import Diagram\nfrom diagrams.aws.compute import EC2\nwith Diagram("X", show=False):\n    EC2("web")\n'
+    client.post('/explain', json={'code': code, 'explanation_mode': 'graph'})
+    assert client.get('/admin/ledger').status_code == 401
+    resp = client.get('/admin/ledger?window=60', headers={'Authorization': 'Bearer secret'})
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert data['routes']['/explain'] >= 1
+    assert data['outcomes']['ok'] >= 1
+
+def test_warmup_requires_admin_token(client):
+    assert client.post('/warmup').status_code == 401
+
+def test_edit_unknown_job(client):
+    resp = client.post('/generate/aws-00000000-0000-0000-0000-000000000000/edit', json={'change': 'x'})
+    assert resp.status_code == 404
+
+def test_explain_graph_mode_skips_llm(client, monkeypatch):
+    import app as app_module
+    def fail(*args, **kwargs):
+        raise AssertionError('LLM should not be called in graph mode')
+    monkeypatch.setattr(app_module, 'generate_explanation_openai', fail)
+    monkeypatch.setattr(app_module, 'generate_rewrite_openai', fail)
+    code = 'from diagrams import Diagram\nfrom diagrams.aws.compute import EC2\nwith Diagram("X", show=False):\n    EC2("web")\n'
+    resp = client.post('/explain', json={'code': code, 'provider': 'aws', 'explanation_mode': 'graph'})
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert data['explanation_source'] == 'graph'
+    assert 'web (EC2)' in data['explanation']
+
 def test_rewrite_missing_fields(client):
     resp = client.post('/rewrite', json={})
     assert resp.status_code == 400
@@ -107,3 +325,138 @@ def test_explain_with_provider(client, monkeypatch):
     assert 'rewritten_prompt' in data
     assert 'provider' in data
     assert data['provider'] == 'aws'
+
+def test_explain_stores_and_reuses_llm_explanation(client, monkeypatch):
+    import uuid
+    import parallel
+    calls = []
+
+    def fake_explanation(prompt):
+        calls.append(prompt)
+        return '- single explanation'
+
+    monkeypatch.setattr(parallel, 'generate_explanation_openai', fake_explanation)
+    code = f'from diagrams import Diagram\nwith Diagram("{uuid.uuid4().hex}"):\n    pass\n'
+    first = client.post('/explain', json={'code': code}).get_json()
+    second = client.post('/explain', json={'code': '# same\n' + code}).get_json()
+    assert (first['explanation_source'], second['explanation_source']) == ('llm', 'stored')
+    assert second['explanation'] == '- single explanation' and len(calls) == 1
+
+    def failing_explanation(prompt):
+        raise RuntimeError('upstream unavailable')
+
+    monkeypatch.setattr(parallel, 'generate_explanation_openai', failing_explanation)
+    resp = client.post('/explain', json={'code': code.replace('pass', 'pass  # changed') + 'x = 1\n'})
+    assert resp.status_code == 500
+    assert 'upstream unavailable' in resp.get_json()['error']
+
+def test_explain_batch_dedupes_and_reuses_stored(client, monkeypatch):
+    import parallel
+    import app as app_module
+    calls = []
+    def fake_explanation(prompt):
+        calls.append(prompt)
+        return '- explanation'
+    monkeypatch.setattr(parallel, 'generate_explanation_openai', fake_explanation)
+    code = 'from diagrams import Diagram\nfrom diagrams.gcp.compute import GCE\nwith Diagram("Batch"):\n    GCE("vm")\n'
+    app_module.explanation_store.put(code, None, '- stored explanation')
+    other = code.replace('"vm"', '"worker"')
+    resp = client.post('/explain', json={'items': [
+        {'code': code}, {'code': '# same\n' + code}, {'code': other}, {'code': other}, {'nothing': True}
+    ]})
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert data['unique'] == 2 and len(calls) == 1
+    sources = [item.get('explanation_source') for item in data['explanations']]
+    assert sources == ['stored', 'stored', 'llm', 'llm', None]
+    assert 'error' in data['explanations'][4]
+    assert client.post('/explain', json={'items': []}).status_code == 400
+
+def test_cosmetic_edit_ignores_placeholder_explanation(client, monkeypatch):
+    import types
+    import parallel
+    import app as app_module
+    from pipeline import NO_EXPLANATION_PLACEHOLDER
+    job = 'aws-00000000-0000-4000-8000-000000000001'
+    code = 'from diagrams import Diagram\nfrom diagrams.aws.compute import EC2\nwith Diagram("Edit", show=False):\n    web = EC2("web")\n'
+    storage.put_bytes(code.encode(), f'{job}/generated_diagram.py')
+    storage.put_bytes(NO_EXPLANATION_PLACEHOLDER.encode(), f'{job}/generated_diagram.md')
+
+    def fake_render(folder, timeout=60, layout='auto'):
+        with open(os.path.join(folder, 'generated_diagram.png'), 'wb') as f:
+            f.write(b'png')
+        return types.SimpleNamespace(returncode=0, stdout='', stderr='')
+
+    monkeypatch.setattr(app_module, 'generate_edit_openai', lambda *args: (
+        '<<<<<<< SEARCH\n    web = EC2("web")\n=======\n    web = EC2("frontend")\n>>>>>>> REPLACE\n'
+    ))
+    monkeypatch.setattr(app_module, 'render_diagram', fake_render)
+    monkeypatch.setattr(parallel, 'generate_rewrite_openai', lambda *args: None)
+    monkeypatch.setattr(parallel, 'generate_explanation_openai', lambda prompt: '- new explanation')
+    resp = client.post(f'/generate/{job}/edit', json={'change': 'rename web to frontend'})
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert data['cosmetic'] is True
+    assert data['explanation_source'] == 'llm'
+    assert '- new explanation' in data['explanation']
+
+
+def test_generate_explains_rendered_code_with_llm(client, monkeypatch):
+    import types
+    import uuid
+    import parallel
+    import app as app_module
+    label = f'Generate {uuid.uuid4().hex}'  # fresh code, so no stored explanation is reused
+    code = f'from diagrams import Diagram\nfrom diagrams.aws.compute import EC2\nwith Diagram("{label}", show=False):\n    web = EC2("web")\n'
+    prompts = []
+
+    def fake_render(folder, timeout=60, layout='auto'):
+        with open(os.path.join(folder, 'generated_diagram.png'), 'wb') as f:
+            f.write(b'png')
+        return types.SimpleNamespace(returncode=0, stdout='', stderr='')
+
+    def fake_explanation(prompt):
+        prompts.append(prompt)
+        return '- EC2 instance "web"'
+
+    monkeypatch.setattr(app_module, 'generate_rewrite_openai', lambda *args: 'one EC2 instance')
+    monkeypatch.setattr(app_module, 'generate_code_openai', lambda *args: code)
+    monkeypatch.setattr(app_module, 'render_diagram', fake_render)
+    monkeypatch.setattr(parallel, 'generate_rewrite_openai', lambda *args: None)
+    monkeypatch.setattr(parallel, 'generate_explanation_openai', fake_explanation)
+    resp = client.post('/generate', json={
+        'description': 'one EC2 instance', 'provider': 'aws', 'explanation_mode': 'llm'
+    })
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert data['explanation_source'] == 'llm'
+    assert data['explanation'] == '- EC2 instance "web"'
+    assert len(prompts) == 1 and label in prompts[0]
+    # The explanation is stored, so the same code is not explained twice
+    assert app_module.explanation_store.get(code, 'aws') == '- EC2 instance "web"'
+
+
+def test_cosmetic_edit_rebuilds_graph_explanation(client, monkeypatch):
+    import types
+    import app as app_module
+    from graph_explanation import explain_graph
+    job = 'aws-00000000-0000-4000-8000-000000000002'
+    code = 'from diagrams import Diagram\nfrom diagrams.aws.compute import EC2\nwith Diagram("Edit", show=False):\n    web = EC2("web")\n'
+    storage.put_bytes(code.encode(), f'{job}/generated_diagram.py')
+    storage.put_bytes(explain_graph(code, 'aws').encode(), f'{job}/generated_diagram.md')
+
+    def fake_render(folder, timeout=60, layout='auto'):
+        with open(os.path.join(folder, 'generated_diagram.png'), 'wb') as f:
+            f.write(b'png')
+        return types.SimpleNamespace(returncode=0, stdout='', stderr='')
+
+    monkeypatch.setattr(app_module, 'generate_edit_openai', lambda *args: (
+        '<<<<<<< SEARCH\n    web = EC2("web")\n=======\n    web = EC2("frontend")\n>>>>>>> REPLACE\n'
+    ))
+    monkeypatch.setattr(app_module, 'render_diagram', fake_render)
+    resp = client.post(f'/generate/{job}/edit', json={'change': 'rename web to frontend', 'explanation_mode': 'graph'})
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert data['cosmetic'] is True
+    assert data['explanation_source'] == 'graph'
+    assert 'frontend' in data['explanation'] and 'web (EC2)' not in data['explanation']
@@ -0,0 +1,64 @@
+import zlib
+from artifact_optimizer import (
+    PNG_SIGNATURE, _iter_png_chunks, _png_chunk, minify_svg, optimize_artifacts, recompress_png
+)
+
+SAMPLE_SVG = '''<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<svg width="200.00pt" height="100.50pt" viewBox="0.00 0.00 200.00 100.50">
+<!-- web -->
+<g id="node1" class="node">
+<title>web v1.20</title>
+<polygon fill="none" points="10.123456,20.000000 30.500000,40.250000"/>
+<text x="12.3400" y="5.000">Web 1.50</text>
+</g>
+<defs><linearGradient id="g1"><stop offset="0"/></linearGradient></defs>
+<defs><linearGradient id="g2"><stop offset="0"/></linearGradient></defs>
+<rect fill="url(#g2)"/>
+</svg>
+'''
+
+
+def _make_png(raw, idat_parts=3):
+    ihdr = _png_chunk(b'IHDR', b'\x00\x00\x00\x04\x00\x00\x00\x04\x08\x00\x00\x00\x00')
+    compressed = zlib.compress(raw, 1)
+    step = len(compressed) // idat_parts + 1
+    idats = b''.join(_png_chunk(b'IDAT', compressed[i:i + step]) for i in range(0, len(compressed), step))
+    text = _png_chunk(b'tEXt', b'Software\x00graphviz' * 20)
+    return PNG_SIGNATURE + ihdr + text + idats + _png_chunk(b'IEND', b'')
+
+
+def test_minify_svg_strips_comments_and_whitespace():
+    out = minify_svg(SAMPLE_SVG)
+    assert '<!--' not in out
+    assert '>\n<' not in out
+    assert 'points="10.12,20 30.5,40.25"' in out
+    assert 'x="12.34" y="5"' in out
+    # Labels are never rounded
+    assert 'web v1.20' in out
+    assert 'Web 1.50' in out
+
+
+def test_minify_svg_dedupes_defs():
+    out = minify_svg(SAMPLE_SVG)
+    assert 'id="g2"' not in out
+    assert 'url(#g1)' in out
+
+
+def test_recompress_png_is_lossless():
+    raw = bytes([0, 1, 2, 3, 4] * 4) * 50
+    data = _make_png(raw)
+    result = recompress_png(data)
+    assert len(result) < len(data)
+    chunks = list(_iter_png_chunks(result))
+    assert [c[0] for c in chunks] == [b'IHDR', b'IDAT', b'IEND']
+    assert zlib.decompress(chunks[1][1]) == raw
+
+
+def test_optimize_artifacts_reports_sizes(tmp_path):
+    (tmp_path / 'd.svg').write_text(SAMPLE_SVG)
+    (tmp_path / 'd.png').write_bytes(_make_png(bytes(400)))
+    (tmp_path / 'd.dot').write_text('digraph {}')
+    sizes = optimize_artifacts(str(tmp_path), svg=True, png='lossless')
+    assert set(sizes) == {'d.svg', 'd.png'}
+    for entry in sizes.values():
+        assert entry['after'] < entry['before']
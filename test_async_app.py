@@ -0,0 +1,243 @@
+import json
+import os
+import time
+import asyncio
+import async_app
+from app import storage
+
+
+def _call(method, path, body=b'', headers=None):
+    """Drive the ASGI app once and return (status, json body)"""
+    scope = {
+        'type': 'http', 'method': method, 'path': path, 'raw_path': path.encode(),
+        'query_string': b'', 'headers': headers or [], 'http_version': '1.1',
+        'scheme': 'http', 'server': ('test', 80), 'client': ('test', 1), 'root_path': ''
+    }
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(async_app.app(scope, receive, send))
+    status = sent[0]['status']
+    payload = b''.join(m.get('body', b'') for m in sent[1:])
+    return status, json.loads(payload)
+
+
+def test_async_generate_validation():
+    status, payload = _call('POST', '/generate', json.dumps({'description': ''}).encode())
+    assert status == 400
+    assert payload['error'] == 'Description must be a non-empty string.'
+
+
+def test_async_generate_pipeline(monkeypatch):
+    async def fake_rewrite(user_input, instructions):
+        return 'Rewritten: ' + user_input
+
+    async def fake_code(description, instructions):
+        return "from diagrams import Diagram\nwith Diagram('Test'):\n    pass"
+
+    async def fake_explanation(code, provider):
+        return '- explanation'
+
+    async def fake_render(folder, timeout=60, layout="auto"):
+        with open(os.path.join(folder, 'generated_diagram.png'), 'wb') as f:
+            f.write(b'png')
+        return 0, '', ''
+
+    monkeypatch.setattr(async_app, 'generate_rewrite_openai_async', fake_rewrite)
+    monkeypatch.setattr(async_app, 'generate_code_openai_async', fake_code)
+    monkeypatch.setattr(async_app, 'generate_explanation_aio', fake_explanation)
+    monkeypatch.setattr(async_app, 'run_render', fake_render)
+
+    status, payload = _call('POST', '/generate', json.dumps({'description': 'web app', 'provider': 'aws'}).encode())
+    assert status == 200
+    assert payload['explanation'] == '- explanation'
+    assert 'png' in payload['diagram_files']
+    folder = payload['uploaded_files']['s3_folder']
+    assert storage.get_bytes(f'{folder}/rewritten_input.txt') == b'Rewritten: web app'
+
+
+def test_async_app_falls_through_to_flask():
+    body = json.dumps({'user_input': ''}).encode()
+    status, payload = _call('POST', '/rewrite', body, headers=[
+        (b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())
+    ])
+    assert status == 400
+    assert 'user_input is required' in payload['error']
+
+
+def test_async_generate_graph_explanation_mode(monkeypatch):
+    async def fake_code(description, instructions):
+        return "from diagrams import Diagram\nfrom diagrams.aws.compute import EC2\nwith Diagram('Test'):\n    EC2('web')"
+
+    async def fail_explanation(code, provider):
+        raise AssertionError('LLM explanation should not run in graph mode')
+
+    async def fake_render(folder, timeout=60, layout="auto"):
+        with open(os.path.join(folder, 'generated_diagram.png'), 'wb') as f:
+            f.write(b'png')
+        return 0, '', ''
+
+    async def fake_rewrite(user_input, instructions):
+        return user_input
+
+    monkeypatch.setattr(async_app, 'generate_rewrite_openai_async', fake_rewrite)
+    monkeypatch.setattr(async_app, 'generate_code_openai_async', fake_code)
+    monkeypatch.setattr(async_app, 'generate_explanation_aio', fail_explanation)
+    monkeypatch.setattr(async_app, 'run_render', fake_render)
+
+    body = json.dumps({'description': 'web app', 'provider': 'aws', 'explanation_mode': 'graph'}).encode()
+    status, payload = _call('POST', '/generate', body)
+    assert status == 200
+    assert payload['explanation_source'] == 'graph'
+    assert 'web (EC2)' in payload['explanation']
+
+
+def test_async_generate_candidates_first_clean_render_wins(monkeypatch):
+    async def fake_candidates(description, instructions, n, max_tokens, temperature):
+        return [
+            "from diagrams import Diagram\nwith Diagram('broken'):\n    pass",
+            "Sorry, I can't.",
+            "from diagrams import Diagram\nwith Diagram('good'):\n    pass",
+        ]
+
+    async def fake_render(folder, timeout=60, layout="auto"):
+        with open(os.path.join(folder, 'generated_diagram.py')) as f:
+            if "'broken'" in f.read():
+                return 1, '', 'Traceback: boom'
+        with open(os.path.join(folder, 'generated_diagram.png'), 'wb') as f:
+            f.write(b'png')
+        return 0, '', ''
+
+    async def fake_rewrite(user_input, instructions):
+        return user_input
+
+    monkeypatch.setattr(async_app, 'generate_rewrite_openai_async', fake_rewrite)
+    monkeypatch.setattr(async_app, 'generate_code_candidates_openai_async', fake_candidates)
+    monkeypatch.setattr(async_app, 'run_render', fake_render)
+
+    body = json.dumps({'description': 'web app', 'provider': 'aws', 'candidates': 3,
+                       'explanation_mode': 'graph'}).encode()
+    status, payload = _call('POST', '/generate', body)
+    assert status == 200
+    assert [c['status'] for c in payload['candidates']] == ['failed', 'rejected', 'won']
+    folder = payload['uploaded_files']['s3_folder']
+    assert b"'good'" in storage.get_bytes(f'{folder}/generated_diagram.py')
+
+
+def test_async_generate_decompose_falls_back_on_bad_plan(monkeypatch):
+    import decompose
+
+    async def bad_plan(description, instructions):
+        return 'Sorry, not a plan'
+
+    async def fake_code(description, instructions):
+        return "from diagrams import Diagram\nwith Diagram('whole'):\n    pass"
+
+    async def fake_render(folder, timeout=60, layout="auto"):
+        with open(os.path.join(folder, 'generated_diagram.png'), 'wb') as f:
+            f.write(b'png')
+        return 0, '', ''
+
+    async def fake_rewrite(user_input, instructions):
+        return user_input
+
+    monkeypatch.setattr(decompose, 'generate_decomposition_openai_async', bad_plan)
+    monkeypatch.setattr(async_app, 'generate_rewrite_openai_async', fake_rewrite)
+    monkeypatch.setattr(async_app, 'generate_code_openai_async', fake_code)
+    monkeypatch.setattr(async_app, 'run_render', fake_render)
+
+    body = json.dumps({'description': 'web app', 'provider': 'aws', 'decompose': 'always',
+                       'explanation_mode': 'graph'}).encode()
+    status, payload = _call('POST', '/generate', body)
+    assert status == 200
+    assert 'decomposition' not in payload
+
+
+def test_async_generate_keeps_the_loop_free_during_blocking_stages(monkeypatch):
+    real_allocate = async_app.workspace.allocate
+
+    def slow_allocate(prefix):
+        time.sleep(0.2)  # e.g. a sweep of a crowded workspace root
+        return real_allocate(prefix)
+
+    async def fake_code(description, instructions):
+        return "from diagrams import Diagram\nwith Diagram('Test'):\n    pass"
+
+    async def fake_render(folder, timeout=60, layout="auto"):
+        with open(os.path.join(folder, 'generated_diagram.png'), 'wb') as f:
+            f.write(b'png')
+        return 0, '', ''
+
+    monkeypatch.setattr(async_app.workspace, 'allocate', slow_allocate)
+    monkeypatch.setattr(async_app, 'read_rewrite_instructions', lambda provider: None)
+    monkeypatch.setattr(async_app, 'generate_code_openai_async', fake_code)
+    monkeypatch.setattr(async_app, 'run_render', fake_render)
+
+    async def main():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        payload, status = await async_app.generate_diagram_aio(
+            {'description': 'web app', 'provider': 'aws', 'explanation_mode': 'graph'}
+        )
+        task.cancel()
+        return status, ticks
+
+    status, ticks = asyncio.run(main())
+    assert status == 200
+    assert ticks >= 10  # other coroutines kept running while the workspace was allocated
+
+
+def test_async_profile_is_labelled_loop_wide(monkeypatch):
+    import profiling
+    monkeypatch.setattr(profiling, 'PROFILE_TOKEN', 'secret')
+    started = asyncio.Event()
+
+    async def slow_rewrite(user_input, instructions):
+        started.set()
+        await asyncio.sleep(0.05)
+        raise RuntimeError('rewrite unavailable')
+
+    async def no_code(description, instructions):
+        raise RuntimeError('codegen unavailable')
+
+    monkeypatch.setattr(async_app, 'generate_rewrite_openai_async', slow_rewrite)
+    monkeypatch.setattr(async_app, 'generate_code_openai_async', no_code)
+
+    async def request(headers):
+        scope = {'type': 'http', 'method': 'POST', 'path': '/generate', 'headers': headers}
+        messages = [{'type': 'http.request', 'body': json.dumps({'provider': 'aws', 'description': 'x'}).encode()}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        await async_app.app(scope, receive, send)
+        return json.loads(sent[1]['body'])
+
+    async def main():
+        profiled = asyncio.create_task(request([(b'x-profile', b'secret')]))
+        await started.wait()
+        await request([])  # runs on the loop while the profile is recorded
+        return await profiled
+
+    payload = asyncio.run(main())
+    assert payload['profile_scope'] == 'loop'
+    assert payload['profile_overlapping_requests'] == 1
+    assert 'loop.collapsed' in payload['profile']
+    assert not profiling._loop_profilers
@@ -0,0 +1,116 @@
+import os
+import sys
+import time
+import candidates
+from workspace import WorkspaceManager
+
+DIAGRAM = "from diagrams import Diagram\nwith Diagram('{}'):\n    pass"
+
+
+# Broken renders leave their pid here; the winning render waits until that process is gone
+# (exited and reaped), so the broken candidate is always reported failed, never cancelled
+BROKEN_SCRIPT = """
+import os, sys
+sys.stderr.write("SyntaxError: invalid syntax")
+marker = os.environ["BROKEN_MARKER"]
+with open(marker + ".tmp", "w") as f:
+    f.write(str(os.getpid()))
+os.replace(marker + ".tmp", marker)
+sys.exit(1)
+"""
+OK_SCRIPT = """
+import os, time
+marker = os.environ["BROKEN_MARKER"]
+give_up = time.time() + 10
+while time.time() < give_up:
+    try:
+        with open(marker) as f:
+            os.kill(int(f.read()), 0)
+    except FileNotFoundError:
+        pass
+    except ProcessLookupError:
+        break
+    time.sleep(0.01)
+"""
+
+
+def _render_setup(folder, timeout=60, layout='auto'):
+    """Render stand-in: the Diagram title picks how the render behaves"""
+    with open(os.path.join(folder, 'generated_diagram.py')) as f:
+        code = f.read()
+    if "'slow'" in code:
+        script = 'import time; time.sleep(30)'
+    elif "'broken'" in code:
+        script = BROKEN_SCRIPT
+    else:
+        script = OK_SCRIPT
+    env = dict(os.environ, BROKEN_MARKER=os.path.join(os.path.dirname(folder), 'broken.pid'))
+    return [sys.executable, '-c', script], env
+
+
+def test_read_candidates_validates_and_fits_token_budget(monkeypatch):
+    monkeypatch.setattr(candidates, 'CANDIDATE_TOKEN_BUDGET', 16000)
+    monkeypatch.setattr(candidates, 'CANDIDATE_MAX_TOKENS', 8000)
+    assert candidates.read_candidates({}) == (1, None)
+    assert candidates.read_candidates({'candidates': 2}) == (2, None)
+    message, status = candidates.read_candidates({'candidates': 4})[1]
+    assert status == 400 and 'from 1 to 2' in message
+    monkeypatch.setattr(candidates, 'CODEGEN_CANDIDATES', 4)
+    assert candidates.read_candidates({}) == (2, None)
+    assert candidates.read_candidates({'candidates': 0})[1][1] == 400
+    assert candidates.read_candidates({'candidates': True})[1][1] == 400
+    assert candidates.read_candidates({'candidates': '3'})[1][1] == 400
+
+
+def test_common_code_is_known_before_the_race_only_for_one_program():
+    same = [candidates.Candidate(i, DIAGRAM.format('ok')) for i in range(2)]
+    rejected = candidates.Candidate(2, 'Sorry, I cannot help with that.')
+    for c in same:
+        c.folder = 'workspace'
+    assert candidates.common_code(same + [rejected]) == same[0].code
+    other = candidates.Candidate(3, DIAGRAM.format('other'))
+    other.folder = 'workspace'
+    assert candidates.common_code(same + [other]) is None
+
+
+def test_candidates_rejected_before_rendering():
+    assert candidates.Candidate(0, 'Sorry, I cannot help with that.').status == 'rejected'
+    assert candidates.Candidate(1, 'from diagrams import Diagram\nwith Diagram(:').error == candidates.INVALID_CODE_MESSAGE
+    assert candidates.Candidate(2, DIAGRAM.format('ok')).error is None
+
+
+def test_first_clean_render_wins_and_slow_renders_are_killed(monkeypatch, tmp_path):
+    monkeypatch.setattr(candidates, 'render_setup', _render_setup)
+    workspace = WorkspaceManager(str(tmp_path), retain=False)
+    codes = [DIAGRAM.format('slow'), 'no code here', DIAGRAM.format('broken'), DIAGRAM.format('ok')]
+    prepared = candidates.prepare_candidates(workspace, 'aws', codes, 'web app', None)
+
+    start = time.time()
+    winner = candidates.render_first_success(prepared, timeout=60)
+    assert time.time() - start < 10
+    assert winner.index == 3
+    assert [c['status'] for c in candidates.candidate_summary(prepared)] == ['cancelled', 'rejected', 'failed', 'won']
+
+    released = candidates.discard_candidates(workspace, prepared, keep=winner)
+    assert len(released) == 2
+    assert not any(os.path.exists(folder) for folder in released)
+    assert os.path.exists(os.path.join(winner.folder, 'generated_diagram_raw.py'))
+
+
+def test_failure_of_first_rendered_candidate_is_reported(monkeypatch, tmp_path):
+    monkeypatch.setattr(candidates, 'render_setup', _render_setup)
+    workspace = WorkspaceManager(str(tmp_path), retain=False)
+    prepared = candidates.prepare_candidates(
+        workspace, 'aws', ['Sorry, no.', DIAGRAM.format('broken'), DIAGRAM.format('broken')], 'web app', None
+    )
+    assert candidates.render_first_success(prepared, timeout=60) is None
+    assert candidates.reported_failure(prepared) is prepared[1]
+    payload, status = candidates.candidate_failure_payload(prepared, None, None)
+    assert status == 422
+    assert [c['status'] for c in payload['candidates']] == ['rejected', 'failed', 'failed']
+
+    only_rejected = candidates.prepare_candidates(workspace, 'aws', ['Sorry, no.', 'nothing'], 'web app', None)
+    assert candidates.render_first_success(only_rejected) is None
+    payload, status = candidates.candidate_failure_payload(only_rejected, None, None)
+    assert status == 422
+    assert payload['error'].startswith('The model could not generate valid code')
@@ -0,0 +1,125 @@
+import time
+import asyncio
+import subprocess
+import concurrent.futures
+import pytest
+import deadline
+import parallel
+
+CODE = ('from diagrams import Diagram\nfrom diagrams.aws.compute import EC2\n'
+        'with Diagram("Test", show=False):\n    EC2("web")')
+
+
+def test_deadline_bounds_and_checks():
+    token = deadline.start(10)
+    try:
+        assert 9 < deadline.remaining() <= 10
+        assert deadline.bound(60) <= 10
+        assert deadline.bound(5) == 5
+        assert deadline.bound(60, reserve=deadline.DEADLINE_RESERVE) <= 10 - deadline.DEADLINE_RESERVE
+        assert deadline.allows(1)
+        assert not deadline.allows(20)
+        deadline.check()
+    finally:
+        deadline.finish(token)
+    assert deadline.remaining() is None
+    assert deadline.bound(60) == 60
+
+
+def test_cancelled_scope_stops_dependent_work():
+    token = deadline.start()
+    deadline.cancel()
+    with pytest.raises(deadline.DeadlineExceeded):
+        deadline.check()
+    # Work meant to outlive the request is not bound by it
+    assert deadline.detached(deadline.remaining)() is None
+    deadline.detached(deadline.check)()
+    deadline.finish(token)
+
+
+def test_header_and_invocation_deadline():
+    class Context:
+        def get_remaining_time_in_millis(self):
+            return 5000
+
+    assert deadline.parse_header('2.5') == 2.5
+    assert deadline.parse_header('soon') is None
+    assert deadline.parse_header('-1') is None
+    deadline.set_invocation_deadline(Context())
+    try:
+        token = deadline.start(60)
+        assert deadline.remaining() <= 5 - deadline.DEADLINE_MARGIN
+        deadline.finish(token)
+    finally:
+        deadline.set_invocation_deadline(None)
+
+
+def test_stage_timeout_raises_when_too_little_is_left():
+    token = deadline.start(deadline.DEADLINE_RESERVE + 0.5)
+    try:
+        with pytest.raises(deadline.DeadlineExceeded):
+            deadline.stage_timeout(60)
+        assert deadline.stage_timeout(60, minimum=0.1) <= 0.5
+        assert deadline.is_exceeded(deadline.DeadlineExceeded())
+        assert not deadline.is_exceeded()
+    finally:
+        deadline.finish(token)
+
+
+def test_finish_explanation_falls_back_to_graph_at_deadline():
+    future = concurrent.futures.Future()
+    start = time.time()
+    explanation, source = parallel.finish_explanation(future, CODE, 'aws', 'llm', timeout=0.1)
+    assert time.time() - start < 1
+    assert source == 'graph'
+    assert explanation
+
+
+def test_error_path_does_not_wait_for_explanation(monkeypatch):
+    import app as app_module
+
+    def slow_explanation(prompt):
+        time.sleep(3)
+        return 'late'
+
+    def failing_run(argv, cwd=None, env=None, **kwargs):
+        return subprocess.CompletedProcess(argv, 1, '', 'SyntaxError: invalid syntax')
+
+    monkeypatch.setattr(app_module, 'generate_rewrite_openai', lambda text, instructions: text)
+    monkeypatch.setattr(app_module, 'generate_code_openai', lambda description, instructions: CODE)
+    monkeypatch.setattr(parallel, 'generate_explanation_openai', slow_explanation)
+    monkeypatch.setattr(subprocess, 'run', failing_run)
+    start = time.time()
+    with app_module.app.test_client() as client:
+        resp = client.post('/generate', json={'description': 'web app', 'provider': 'aws', 'explanation_mode': 'llm'})
+    assert resp.status_code == 422
+    assert time.time() - start < 2
+
+
+def test_short_request_timeout_returns_504(monkeypatch):
+    import app as app_module
+
+    def no_render(*args, **kwargs):
+        raise AssertionError('no time left to render')
+
+    monkeypatch.setattr(app_module, 'generate_rewrite_openai', lambda text, instructions: text)
+    monkeypatch.setattr(app_module, 'generate_code_openai', lambda description, instructions: CODE)
+    monkeypatch.setattr(subprocess, 'run', no_render)
+    with app_module.app.test_client() as client:
+        resp = client.post('/generate', headers={deadline.DEADLINE_HEADER: '0.5'},
+                           json={'description': 'web app', 'provider': 'aws', 'explanation_mode': 'graph'})
+    assert resp.status_code == 504
+    assert resp.get_json()['error'] == deadline.DEADLINE_MESSAGE
+
+
+def test_async_upload_stops_at_timeout(monkeypatch):
+    import async_app
+
+    def slow_upload(local_path, folder, filename):
+        time.sleep(0.5 if filename == 'slow.png' else 0)
+        return f'{folder}/{filename}'
+
+    monkeypatch.setattr(async_app, 'upload_artifact', slow_upload)
+    monkeypatch.setattr(async_app, 'artifact_url', lambda key: f'https://example.test/{key}')
+    uploaded = asyncio.run(async_app.upload_all({'fast.png': 'a', 'slow.png': 'b'}, 'aws-job', timeout=0.2))
+    assert uploaded == {'fast.png': 'https://example.test/aws-job/fast.png'}
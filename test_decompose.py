@@ -0,0 +1,83 @@
+import json
+import threading
+import pytest
+import decompose
+
+PLAN = {
+    'title': 'Shop',
+    'subsystems': [
+        {'name': 'Frontend', 'description': 'CDN in front of the web tier', 'nodes': ['CDN', 'Web']},
+        {'name': 'Data', 'description': 'Orders database', 'nodes': ['Orders DB']},
+    ],
+    'connections': [
+        {'from': 'web', 'to': 'Orders  DB', 'label': 'SQL'},
+        {'from': 'Web', 'to': 'Billing'},
+    ],
+}
+
+FRONTEND = '''from diagrams import Diagram, Cluster
+from diagrams.aws.compute import EC2
+from diagrams.aws.network import CloudFront
+with Diagram("Frontend", outformat=["png", "svg"]):
+    cdn = CloudFront("CDN")
+    web = EC2("Web")
+    cdn >> web
+'''
+
+DATA = '''from diagrams import Diagram
+from diagrams.aws.database import RDS as EC2
+with Diagram("Data"):
+    web = EC2("Orders DB")
+'''
+
+
+def test_decompose_mode_and_threshold(monkeypatch):
+    assert decompose.read_decompose_mode({'decompose': 'AUTO'}) == ('auto', None)
+    assert decompose.read_decompose_mode({'decompose': 'sometimes'})[1][1] == 400
+    monkeypatch.setattr(decompose, 'DECOMPOSE_MIN_CHARS', 100)
+    assert decompose.should_decompose('auto', 'x' * 100)
+    assert not decompose.should_decompose('auto', 'x' * 99)
+    assert not decompose.should_decompose('off', 'x' * 1000)
+    assert decompose.should_decompose('always', 'x')
+
+
+def test_parse_plan_validates():
+    plan = decompose.parse_plan('```json\n' + json.dumps(PLAN) + '\n```')
+    assert [s['name'] for s in plan['subsystems']] == ['Frontend', 'Data']
+    assert plan['connections'][1]['label'] is None
+    with pytest.raises(decompose.DecompositionError):
+        decompose.parse_plan('{"subsystems": []}')
+    with pytest.raises(decompose.DecompositionError):
+        decompose.parse_plan('not json')
+
+
+def test_merge_clusters_subsystems_and_resolves_edges_by_label():
+    code, report = decompose.merge_subsystems(decompose.parse_plan(json.dumps(PLAN)), [FRONTEND, DATA])
+    compile(code, 'generated_diagram.py', 'exec')
+    assert "with Cluster('Frontend'):" in code and "with Cluster('Data'):" in code
+    # Clashing variable and class names from different subsystems are kept apart
+    assert "s1_web = EC2_1('Orders DB')" in code
+    assert 'from diagrams.aws.database import RDS as EC2_1' in code
+    assert "s0_web >> Edge(label='SQL') >> s1_web" in code
+    assert code.count('with Diagram(') == 1
+    assert report == {'subsystems': ['Frontend', 'Data'], 'connections': 1,
+                      'unresolved_connections': ['Web -> Billing']}
+
+
+def test_merge_rejects_program_without_diagram():
+    with pytest.raises(decompose.DecompositionError):
+        decompose.merge_subsystems(decompose.parse_plan(json.dumps(PLAN)), [FRONTEND, 'x = 1'])
+
+
+def test_generate_decomposed_runs_subsystems_in_parallel(monkeypatch):
+    barrier = threading.Barrier(2, timeout=5)
+
+    def fake_code(description, instructions):
+        barrier.wait()  # both subsystems must be in flight at once
+        return FRONTEND if 'Frontend' in description else DATA
+
+    monkeypatch.setattr(decompose, 'generate_decomposition_openai', lambda description, instructions: json.dumps(PLAN))
+    monkeypatch.setattr(decompose, 'generate_code_openai', fake_code)
+    code, report = decompose.generate_decomposed('a large description', 'instructions')
+    assert report['connections'] == 1
+    assert "with Cluster('Data'):" in code
@@ -0,0 +1,34 @@
+import pytest
+from diagram_edit import EditError, apply_edit_blocks, is_cosmetic_change, parse_edit_blocks
+
+CODE = '''from diagrams import Diagram
+from diagrams.aws.compute import EC2
+with Diagram("Web", show=False):
+    web = EC2("web")
+'''
+
+
+def test_parse_and_apply_edit_blocks():
+    patch = (
+        '<<<<<<< SEARCH\n    web = EC2("web")\n=======\n    web = EC2("frontend")\n>>>>>>> REPLACE\n'
+    )
+    blocks = parse_edit_blocks(patch)
+    assert blocks == [('    web = EC2("web")', '    web = EC2("frontend")')]
+    assert 'EC2("frontend")' in apply_edit_blocks(CODE, blocks)
+
+
+def test_apply_edit_blocks_rejects_unknown_search():
+    with pytest.raises(EditError):
+        apply_edit_blocks(CODE, [('    db = RDS("db")', '')])
+
+
+def test_apply_edit_blocks_tolerates_trailing_whitespace():
+    patched = apply_edit_blocks(CODE, [('    web = EC2("web")   ', '    web = EC2("api")')])
+    assert 'EC2("api")' in patched
+
+
+def test_cosmetic_change_detection():
+    relabelled = CODE.replace('EC2("web")', 'EC2("frontend")')
+    assert is_cosmetic_change(CODE, relabelled)
+    added = CODE + '    db = EC2("db")\n    web >> db\n'
+    assert not is_cosmetic_change(CODE, added)
@@ -0,0 +1,66 @@
+import threading
+import pytest
+import executors
+
+
+def test_queue_is_bounded_and_overflow_runs_inline():
+    pool = executors.BoundedExecutor('test', max_workers=1, max_queue=1)
+    release = threading.Event()
+    running = pool.submit(release.wait, 5)
+    queued = pool.submit(lambda: 'queued')
+    with pytest.raises(executors.ExecutorBusy):
+        pool.submit(lambda: 'rejected')
+    # Back-pressure: the caller runs the task itself instead of queueing it
+    inline = pool.submit_or_run(threading.current_thread)
+    assert inline.done() and inline.result() is threading.current_thread()
+
+    stats = pool.stats()
+    assert (stats['active'], stats['queued'], stats['rejected'], stats['inline']) == (1, 1, 2, 1)
+    release.set()
+    assert running.result(timeout=5) and queued.result(timeout=5) == 'queued'
+    stats = pool.stats()
+    assert (stats['active'], stats['queued'], stats['completed']) == (0, 0, 2)
+    assert stats['wait']['p50'] is not None
+
+
+def test_cancelled_task_frees_its_slot():
+    pool = executors.BoundedExecutor('test', max_workers=1, max_queue=1)
+    release = threading.Event()
+    running = pool.submit(release.wait, 5)
+    queued = pool.submit(lambda: 'never')
+    assert queued.cancel()
+    assert pool.submit(lambda: 'accepted').cancel()
+    release.set()
+    running.result(timeout=5)
+    stats = pool.stats()
+    assert (stats['cancelled'], stats['queued'], stats['rejected']) == (2, 0, 0)
+    assert set(executors.stats()) == {'llm', 'enrichment', 'upload', 'render'}
+
+
+def test_run_async_waits_for_a_slot_off_the_event_loop():
+    import asyncio
+    import time
+    pool = executors.BoundedExecutor('test-async', max_workers=1, max_queue=0)
+
+    async def scenario():
+        loop_thread = threading.current_thread()
+        ticks = []
+
+        async def ticker():
+            while len(ticks) < 5:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        def work(i):
+            time.sleep(0.02)
+            return i, threading.current_thread() is not loop_thread
+
+        results = await asyncio.gather(ticker(), *(pool.run_async(work, i) for i in range(3)))
+        return ticks, results[1:]
+
+    ticks, results = asyncio.run(scenario())
+    assert results == [(0, True), (1, True), (2, True)]
+    assert len(ticks) == 5  # the loop kept running while tasks waited for the single slot
+    stats = pool.stats()
+    assert stats['completed'] == 3 and stats['inline'] == 0 and stats['rejected'] == 0
+    assert stats['wait']['p99'] >= 0.02  # waiting for the slot counts as queue wait
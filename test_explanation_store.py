@@ -0,0 +1,42 @@
+import parallel
+import pipeline
+from storage import MemoryStorage
+from explanation_store import ExplanationStore, code_hash
+
+CODE = 'from diagrams import Diagram\nfrom diagrams.aws.compute import EC2\nwith Diagram("Web"):\n    EC2("web")\n'
+
+
+def test_hash_ignores_comments_whitespace_and_output_settings():
+    reformatted = (
+        '# generated\nfrom diagrams import Diagram\n\nfrom diagrams.aws.compute import EC2  # compute\n'
+        'with Diagram( "Web", show=True ):\n    EC2( "web" )\n'
+    )
+    assert code_hash(reformatted) == code_hash(CODE)
+    assert code_hash(CODE.replace('"web"', '"api"')) != code_hash(CODE)
+    # Code that does not tokenize still gets a key
+    assert code_hash('with Diagram(') == code_hash('with   Diagram(')
+
+
+def test_hash_fixes_imports_without_logging_or_ledger_notes(monkeypatch, capsys):
+    notes = []
+    monkeypatch.setattr(pipeline.ledger, 'annotate', lambda **fields: notes.append(fields))
+    misspelled = CODE.replace('import EC2', 'import Ec2 as EC2')
+    assert code_hash(misspelled) == code_hash(CODE)
+    assert notes == [] and capsys.readouterr().out == ''
+
+
+def test_stored_explanation_is_reused(monkeypatch):
+    calls = []
+
+    def fake_explanation(prompt):
+        calls.append(prompt)
+        return '- explanation'
+
+    monkeypatch.setattr(parallel, 'generate_explanation_openai', fake_explanation)
+    store = ExplanationStore(MemoryStorage())
+    assert store.get(CODE, 'aws') is None
+    assert parallel.explain_with_store(CODE, None, store)[:2] == ('- explanation', 'llm')
+    assert parallel.explain_with_store('# same\n' + CODE, None, store) == ('- explanation', 'stored', None)
+    assert len(calls) == 1
+    # Explanations are per provider
+    assert store.get(CODE, 'aws') is None
@@ -0,0 +1,42 @@
+from graph_explanation import explain_graph, parse_diagram
+
+CODE = '''from diagrams import Diagram, Cluster, Edge
+from diagrams.aws.network import Route53, ELB
+from diagrams.aws.compute import EC2
+from diagrams.aws.database import RDS
+with Diagram("Web Service", show=False):
+    dns = Route53("dns")
+    lb = ELB("lb")
+    with Cluster("Web tier"):
+        web = [EC2("web1"), EC2("web2")]
+    db = RDS("orders")
+    dns >> lb
+    for w in web:
+        lb >> w
+        w >> Edge(label="reads") >> db
+'''
+
+
+def test_parse_diagram_recovers_nodes_clusters_and_edges():
+    graph = parse_diagram(CODE)
+    assert graph.title == 'Web Service'
+    assert [n['label'] for n in graph.nodes] == ['dns', 'lb', 'web1', 'web2', 'orders']
+    assert graph.clusters == [{'name': 'Web tier', 'parent': None}]
+    assert graph.nodes[2]['cluster'] == 0
+    assert (0, 1, None) in graph.edges
+    assert (2, 4, 'reads') in graph.edges and (3, 4, 'reads') in graph.edges
+
+
+def test_explain_graph_bullets():
+    explanation = explain_graph(CODE, 'aws')
+    lines = explanation.splitlines()
+    assert all(line.startswith('- ') for line in lines)
+    assert 'AWS architecture with 5 components in 1 group and 5 connections' in lines[0]
+    assert 'Traffic enters through dns' in explanation
+    assert '—reads→ orders (RDS)' in explanation
+    assert 'Data stores' in explanation
+
+
+def test_explain_graph_without_nodes():
+    assert explain_graph('print("hi")') is None
+    assert explain_graph('not python (') is None
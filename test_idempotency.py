@@ -0,0 +1,52 @@
+import json
+import threading
+import concurrent.futures
+from idempotency import (
+    IdempotencyStore, LEAD, ATTACH, REPLAY, REJECT, IN_PROGRESS_MESSAGE, fingerprint, wait_attached
+)
+from storage import MemoryStorage
+
+BODY = fingerprint({'description': 'web app', 'provider': 'aws'})
+
+
+def test_finished_response_is_replayed_from_the_job_folder():
+    storage = MemoryStorage()
+    store = IdempotencyStore(storage)
+    assert store.begin('/generate', 'k1', BODY) == (LEAD, None)
+    store.finish('/generate', 'k1', BODY, {'diagram_files': {}}, 200, folder='aws-1')
+    assert json.loads(storage.get_bytes('aws-1/response.json')) == {'diagram_files': {}}
+    # Another instance sharing the storage replays it too
+    assert IdempotencyStore(storage).begin('/generate', 'k1', BODY) == (REPLAY, ({'diagram_files': {}}, 200))
+
+
+def test_duplicate_attaches_to_running_execution():
+    store = IdempotencyStore(MemoryStorage())
+    assert store.begin('/generate', 'k1', BODY)[0] == LEAD
+    outcome, future = store.begin('/generate', 'k1', BODY)
+    assert outcome == ATTACH
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(wait_attached(future, timeout=5)))
+    waiter.start()
+    store.finish('/generate', 'k1', BODY, {'error': 'bad'}, 422)
+    waiter.join()
+    assert results == [({'error': 'bad'}, 422)]
+    assert wait_attached(concurrent.futures.Future(), timeout=0.01) == ({'error': IN_PROGRESS_MESSAGE}, 409)
+
+
+def test_key_reuse_conflicts():
+    storage = MemoryStorage()
+    store = IdempotencyStore(storage)
+    store.begin('/generate', 'k1', BODY)
+    assert store.begin('/generate', 'k1', fingerprint({'description': 'other'}))[1][1] == 422
+    # Still running on another instance: nothing to attach to here
+    assert IdempotencyStore(storage).begin('/generate', 'k1', BODY) == (REJECT, ({'error': IN_PROGRESS_MESSAGE}, 409))
+
+
+def test_transient_failures_and_abandoned_claims_run_again():
+    storage = MemoryStorage()
+    store = IdempotencyStore(storage)
+    store.begin('/generate', 'k1', BODY)
+    store.finish('/generate', 'k1', BODY, {'error': 'OpenAI API error'}, 500)
+    assert store.begin('/generate', 'k1', BODY)[0] == LEAD
+    # That claim is still pending; once older than pending_timeout it counts as abandoned
+    assert IdempotencyStore(storage, pending_timeout=-1).begin('/generate', 'k1', BODY)[0] == LEAD
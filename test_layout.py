@@ -0,0 +1,74 @@
+import subprocess
+import graphviz
+import pytest
+import layout
+
+
+def _code(nodes, clusters=0):
+    lines = ['from diagrams import Diagram, Cluster', 'from diagrams.aws.compute import EC2',
+             'with Diagram("Big", show=False):']
+    for c in range(clusters):
+        lines.append(f'    with Cluster("c{c}"):')
+        lines.append(f'        EC2("in-{c}")')
+    lines += [f'    n{i} = EC2("n{i}")' for i in range(nodes)]
+    lines += [f'    n{i} >> n{i + 1}' for i in range(nodes - 1)]
+    return '\n'.join(lines) + '\n'
+
+
+def test_plan_layout_by_size():
+    assert layout.plan_layout(_code(5))['attempts'][0] == {'engine': 'dot', 'graph_attr': {}, 'budget': layout.LAYOUT_TIME_BUDGET}
+    medium = layout.plan_layout(_code(80))
+    assert medium['size'] == 'medium'
+    assert medium['attempts'][0]['graph_attr'] == layout.TUNED_DOT_ATTRS
+    large = layout.plan_layout(_code(250))
+    assert [a['engine'] for a in large['attempts']] == ['sfdp', 'osage']
+    # sfdp drops clusters, so clustered large graphs stay on tuned dot first
+    clustered = layout.plan_layout(_code(250, clusters=2))
+    assert [a['engine'] for a in clustered['attempts']] == ['dot', 'sfdp', 'osage']
+
+
+def test_plan_layout_explicit_engine_and_validation():
+    plan = layout.plan_layout(_code(5), 'neato', timeout=60)
+    assert [a['engine'] for a in plan['attempts']] == ['neato', 'sfdp', 'osage']
+    assert plan['deadline'] == 55
+    assert layout.validate_layout('SFDP') == ('sfdp', None)
+    assert layout.validate_layout('circo')[1][1] == 400
+
+
+def test_run_layout_falls_back_on_timeout(monkeypatch):
+    calls = []
+
+    def fake_run(argv, input, capture_output, timeout, check):
+        calls.append((argv[1], timeout))
+        if argv[1] == '-Kdot':
+            raise subprocess.TimeoutExpired(argv, timeout)
+        return subprocess.CompletedProcess(argv, 0, b'positioned', b'')
+
+    monkeypatch.setattr(layout.subprocess, 'run', fake_run)
+    digraph = graphviz.Digraph('g')
+    digraph.graph_attr['splines'] = 'ortho'
+    attempts = layout.plan_layout(_code(80, clusters=1))['attempts']
+    positioned, report = layout.run_layout(digraph, attempts, deadline=50)
+    assert positioned == b'positioned'
+    assert report['engine'] == 'sfdp' and report['fallback'] is True
+    assert [a['status'] for a in report['attempts']] == ['timeout', 'ok']
+    assert calls[0] == ('-Kdot', layout.LAYOUT_TIME_BUDGET)
+    # Fallback attributes replace the previous attempt's tuning
+    assert digraph.graph_attr['splines'] == 'line'
+
+
+def test_run_layout_raises_when_every_engine_times_out(monkeypatch):
+    def fake_run(argv, input, capture_output, timeout, check):
+        raise subprocess.TimeoutExpired(argv, timeout)
+
+    monkeypatch.setattr(layout.subprocess, 'run', fake_run)
+    with pytest.raises(layout.LayoutTimeout):
+        layout.run_layout(graphviz.Digraph('g'), layout.plan_layout(_code(5))['attempts'], deadline=50)
+
+
+def test_layout_report_into_timings(tmp_path):
+    layout.write_layout_report({'engine': 'sfdp', 'layout': 1.5, 'fallback': True}, str(tmp_path))
+    timings = {}
+    layout.add_layout_timings(timings, layout.read_layout_report(str(tmp_path)))
+    assert timings == {'layout': 1.5, 'layout_engine': 'sfdp', 'layout_fallback': True}
+    assert layout.read_layout_report(str(tmp_path / 'missing')) is None
@@ -0,0 +1,58 @@
+import types
+import ledger
+from storage import MemoryStorage
+
+
+def _usage(prompt, completion, cached=0):
+    return types.SimpleNamespace(
+        prompt_tokens=prompt, completion_tokens=completion,
+        prompt_tokens_details=types.SimpleNamespace(cached_tokens=cached)
+    )
+
+
+def test_record_lifecycle(tmp_path):
+    request_ledger = ledger.Ledger(str(tmp_path))
+    token = ledger.start_record('trace-1', '/generate')
+    timings = {}
+    ledger.annotate(provider='aws', timings=timings)
+    ledger.record_llm_call('codegen', 'gpt-4o', usage=_usage(1000, 200, 800), seconds=1.5)
+    ledger.record_llm_call('explanation', 'gpt-4o', usage=_usage(300, 50), cache_hit=True)
+    timings['diagram_execution'] = 2.25  # later updates to annotated dicts are kept
+    ledger.finish_record(token, request_ledger, 200)
+
+    [record] = list(request_ledger.read())
+    assert record['request_id'] == 'trace-1' and record['outcome'] == 'ok'
+    assert record['timings'] == {'diagram_execution': 2.25}
+    assert record['llm_calls'][0]['cached_tokens'] == 800
+    assert record['llm_calls'][1]['prompt_tokens'] == 0  # cache hits cost no tokens
+    # Calls outside of a record are ignored
+    ledger.record_llm_call('codegen', 'gpt-4o', usage=_usage(1, 1))
+
+
+def test_rotation_ships_and_prunes(tmp_path):
+    storage = MemoryStorage()
+    request_ledger = ledger.Ledger(str(tmp_path), max_bytes=1, backups=2, storage=storage)
+    for i in range(4):
+        request_ledger.append({'ts': i, 'request_id': str(i)})
+    assert len(request_ledger.files()) == 2
+    assert len(storage.list_keys('ledger/')) == 4
+    assert [r['request_id'] for r in request_ledger.read(since=2)] == ['2', '3']
+
+
+def test_summarize_totals_and_percentiles():
+    records = [
+        {'ts': 0, 'route': '/generate', 'provider': 'aws', 'outcome': 'ok', 'duration': float(d),
+         'timings': {'llm': d / 2, 'layout_engine': 'dot'},
+         'llm_calls': [{'stage': 'codegen', 'prompt_tokens': 100, 'completion_tokens': 10, 'cached_tokens': 0}]}
+        for d in range(1, 11)
+    ]
+    records.append({'ts': 0, 'route': '/explain', 'provider': None, 'outcome': 'error', 'duration': 0.5,
+                    'timings': {}, 'llm_calls': []})
+    summary = ledger.summarize(records)
+    assert summary['requests'] == 11
+    assert summary['outcomes'] == {'ok': 10, 'error': 1}
+    assert summary['tokens']['prompt_tokens'] == 1000
+    assert summary['providers']['aws']['latency'] == {'p50': 5.0, 'p90': 9.0, 'p99': 10.0}
+    assert summary['stages']['codegen']['tokens']['calls'] == 10
+    assert summary['stages']['llm']['seconds']['total'] == 27.5
+    assert 'layout_engine' not in summary['stages']
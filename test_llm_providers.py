@@ -0,0 +1,170 @@
+import asyncio
+import threading
+import time
+import deadline
+import llm_providers
+
+
+class _FakeCompletions:
+    def __init__(self, release):
+        self.calls = 0
+        self.release = release
+
+    def create(self, **kwargs):
+        self.calls += 1
+        self.release.wait(5)
+        return {'content': kwargs['messages'][-1]['content']}
+
+
+def test_identical_inflight_calls_are_coalesced(monkeypatch):
+    release = threading.Event()
+    completions = _FakeCompletions(release)
+
+    class FakeOpenAI:
+        def __init__(self, api_key):
+            self.chat = type('Chat', (), {'completions': completions})()
+
+    monkeypatch.setenv('OPENAI_API_KEY', 'sk-test')
+    monkeypatch.setattr(llm_providers, 'OpenAI', FakeOpenAI)
+    monkeypatch.setattr(llm_providers, '_client', None)
+    monkeypatch.setattr(llm_providers, '_cache', {})
+    before = llm_providers.coalesce_stats()['coalesced']
+
+    messages = [{'role': 'user', 'content': 'coalesce me'}]
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(llm_providers.openai_chat_with_cache('gpt-4o', messages)))
+        for _ in range(5)
+    ]
+    for t in threads:
+        t.start()
+    give_up = time.time() + 5
+    while llm_providers.coalesce_stats()['coalesced'] - before < 4 and time.time() < give_up:
+        time.sleep(0.01)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert completions.calls == 1
+    assert len(results) == 5 and all(r is results[0] for r in results)
+    assert llm_providers.coalesce_stats()['in_flight'] == 0
+
+
+def test_leader_failure_after_the_call_still_releases_waiters(monkeypatch):
+    release = threading.Event()
+    completions = _FakeCompletions(release)
+
+    class FakeOpenAI:
+        def __init__(self, api_key):
+            self.chat = type('Chat', (), {'completions': completions})()
+
+    def broken_usage(response):
+        raise RuntimeError('usage bookkeeping failed')
+
+    monkeypatch.setenv('OPENAI_API_KEY', 'sk-test')
+    monkeypatch.setattr(llm_providers, 'OpenAI', FakeOpenAI)
+    monkeypatch.setattr(llm_providers, '_client', None)
+    monkeypatch.setattr(llm_providers, '_cache', {})
+    monkeypatch.setattr(llm_providers, '_record_usage', broken_usage)
+    before = llm_providers.coalesce_stats()['coalesced']
+
+    messages = [{'role': 'user', 'content': 'fail after the call'}]
+    results, errors = [], []
+
+    def call():
+        try:
+            results.append(llm_providers.openai_chat_with_cache('gpt-4o', messages))
+        except RuntimeError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call, daemon=True) for _ in range(3)]
+    for t in threads:
+        t.start()
+    give_up = time.time() + 5
+    while llm_providers.coalesce_stats()['coalesced'] - before < 2 and time.time() < give_up:
+        time.sleep(0.01)
+    release.set()
+    for t in threads:
+        t.join(5)
+
+    assert not any(t.is_alive() for t in threads)
+    assert completions.calls == 1
+    assert len(errors) == 1 and len(results) == 2
+    assert llm_providers.coalesce_stats()['in_flight'] == 0
+
+
+def test_api_error_of_leader_with_deadline_reaches_waiters(monkeypatch):
+    release = threading.Event()
+    calls = []
+
+    class RateLimited(Exception):
+        pass
+
+    class FailingCompletions:
+        def create(self, **kwargs):
+            calls.append(kwargs)
+            release.wait(5)
+            raise RateLimited('429 Too Many Requests')
+
+    class FakeOpenAI:
+        def __init__(self, api_key):
+            self.chat = type('Chat', (), {'completions': FailingCompletions()})()
+
+    monkeypatch.setenv('OPENAI_API_KEY', 'sk-test')
+    monkeypatch.setattr(llm_providers, 'OpenAI', FakeOpenAI)
+    monkeypatch.setattr(llm_providers, '_client', None)
+    monkeypatch.setattr(llm_providers, '_cache', {})
+    before = llm_providers.coalesce_stats()['coalesced']
+
+    messages = [{'role': 'user', 'content': 'rate limited'}]
+    errors = []
+
+    def call():
+        token = deadline.start(30)
+        try:
+            llm_providers.openai_chat_with_cache('gpt-4o', messages)
+        except RateLimited as e:
+            errors.append(e)
+        finally:
+            deadline.finish(token)
+
+    threads = [threading.Thread(target=call, daemon=True) for _ in range(3)]
+    for t in threads:
+        t.start()
+    give_up = time.time() + 5
+    while llm_providers.coalesce_stats()['coalesced'] - before < 2 and time.time() < give_up:
+        time.sleep(0.01)
+    release.set()
+    for t in threads:
+        t.join(5)
+
+    assert len(calls) == 1
+    assert len(errors) == 3
+
+
+def test_async_waiter_retries_when_leader_is_cancelled(monkeypatch):
+    calls = []
+
+    class FakeAsyncCompletions:
+        async def create(self, **kwargs):
+            calls.append(kwargs)
+            await asyncio.sleep(0.05)
+            return 'response'
+
+    class FakeClient:
+        chat = type('Chat', (), {'completions': FakeAsyncCompletions()})()
+
+    monkeypatch.setattr(llm_providers, '_get_async_client', lambda: FakeClient())
+    monkeypatch.setattr(llm_providers, '_cache', {})
+    messages = [{'role': 'user', 'content': 'cancel me'}]
+
+    async def scenario():
+        leader = asyncio.create_task(llm_providers.openai_chat_with_cache_async('gpt-4o', messages))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(llm_providers.openai_chat_with_cache_async('gpt-4o', messages))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await waiter
+
+    assert asyncio.run(scenario()) == 'response'
+    assert len(calls) == 2
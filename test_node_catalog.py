@@ -0,0 +1,45 @@
+import node_catalog
+from pipeline import sanitize_code
+
+CODE = '''from diagrams import Diagram
+from diagrams.aws.compute import Fargates, EC2, S3 as Bucket
+from diagrams.aws.networking import ELB
+with Diagram("Web"):
+    ELB("lb") >> Fargates("app") >> EC2("worker") >> Bucket("assets")
+'''
+
+
+def test_unknown_imports_are_reported():
+    assert node_catalog.unknown_imports('from diagrams.aws.compute import EC2, ECS') == []
+    assert node_catalog.unknown_imports(CODE) == [
+        'diagrams.aws.compute.Fargates', 'diagrams.aws.compute.S3', 'diagrams.aws.networking.ELB',
+    ]
+    assert 'diagrams.gcp.compute.Teleporter' in node_catalog.unknown_node_message(
+        'from diagrams.gcp.compute import Teleporter'
+    )
+
+
+def test_near_misses_are_fixed_on_import_lines_only():
+    code, fixes = node_catalog.fix_imports(CODE)
+    assert node_catalog.unknown_imports(code) == []
+    assert 'from diagrams.aws.compute import Fargate as Fargates, EC2\n' in code
+    assert 'from diagrams.aws.storage import S3 as Bucket\n' in code
+    assert 'from diagrams.aws.network import ELB\n' in code
+    # The program body keeps its local names
+    assert code.endswith('ELB("lb") >> Fargates("app") >> EC2("worker") >> Bucket("assets")\n')
+    assert 'diagrams.aws.compute.S3 -> diagrams.aws.storage.S3' in fixes
+    # Nothing close enough stays unknown for validation to reject
+    code, fixes = node_catalog.fix_imports('from diagrams.aws.compute import Teleporter')
+    assert fixes == [] and node_catalog.unknown_imports(code) == ['diagrams.aws.compute.Teleporter']
+    assert sanitize_code('from diagrams.aws.compute import Fargates').startswith(
+        'from diagrams.aws.compute import Fargate as Fargates'
+    )
+
+
+def test_prompt_lists_relevant_modules():
+    prompt = node_catalog.catalog_prompt('aws', 'An RDS database behind an application load balancer', max_modules=2)
+    assert '- from diagrams.aws.database import ' in prompt
+    assert '- from diagrams.aws.network import ' in prompt
+    assert 'ALB (ElbApplicationLoadBalancer)' in prompt
+    assert prompt.count('- from ') == 2
+    assert node_catalog.catalog_prompt('aws', 'zzz') == ''
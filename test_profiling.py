@@ -0,0 +1,57 @@
+import time
+import pstats
+import profiling
+from storage import MemoryStorage
+
+
+def _busy(seconds):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        sum(range(1000))
+
+
+def test_should_profile_requires_token_or_sampling(monkeypatch):
+    monkeypatch.setattr(profiling, 'PROFILE_TOKEN', 'secret')
+    monkeypatch.setattr(profiling, 'PROFILE_SAMPLE_RATE', 0)
+    assert profiling.should_profile('secret')
+    assert not profiling.should_profile('guess')
+    assert not profiling.should_profile(None)
+    monkeypatch.setattr(profiling, 'PROFILE_TOKEN', None)
+    assert not profiling.should_profile('secret')
+    monkeypatch.setattr(profiling, 'PROFILE_SAMPLE_RATE', 1)
+    assert profiling.should_profile(None)
+
+
+def test_profiles_are_stored_next_to_artifacts(tmp_path, monkeypatch):
+    storage = MemoryStorage()
+    assert profiling.render_env('/tmp/workspaces/aws-job') == {}
+    token = profiling.start()
+    _busy(0.1)
+    # What render_runner.py does in the render subprocess
+    for name, value in profiling.render_env('/tmp/workspaces/aws-job').items():
+        monkeypatch.setenv(name, value)
+    profiling.profile_render(_busy, 0.05)
+    urls = profiling.finish(token, storage, folder='aws-job')
+    assert set(urls) >= {'handler.collapsed', 'render-aws-job.collapsed'}
+    assert not profiling.active()
+
+    collapsed = storage.get_bytes('aws-job/profile/handler.collapsed').decode()
+    assert '_busy (test_profiling.py' in collapsed
+    assert all(line.rsplit(' ', 1)[1].isdigit() for line in collapsed.splitlines())
+    if 'handler.pstats' in urls:
+        path = tmp_path / 'handler.pstats'
+        path.write_bytes(storage.get_bytes('aws-job/profile/handler.pstats'))
+        assert any(func[2] == '_busy' for func in pstats.Stats(str(path)).stats)
+
+
+def test_profiled_request_returns_profile_location(monkeypatch):
+    import app as app_module
+    monkeypatch.setattr(profiling, 'PROFILE_TOKEN', 'secret')
+    with app_module.app.test_client() as client:
+        resp = client.post('/generate', headers={profiling.PROFILE_HEADER: 'secret'}, json={'provider': 'aws'})
+        assert resp.status_code == 400
+        trace_id = resp.headers['X-Trace-Id']
+        assert f'profiles/{trace_id}/handler.collapsed' in resp.get_json()['profile']['handler.collapsed']
+
+        resp = client.post('/generate', json={'provider': 'aws'})
+        assert 'profile' not in resp.get_json()
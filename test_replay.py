@@ -0,0 +1,86 @@
+import time
+import random
+import pytest
+import replay
+import fake_llm
+import tracing
+from storage import MemoryStorage
+from llm_providers import generate_code_openai, generate_rewrite_openai
+
+CODE = 'from diagrams import Diagram\nwith Diagram("Web"):\n    pass'
+
+
+def _store_job(storage, job, description, code=None):
+    storage.put_bytes(description.encode(), f'{job}/original_input.txt')
+    if code:
+        storage.put_bytes(code.encode(), f'{job}/generated_diagram_raw.py')
+        storage.put_bytes(b'rewritten ' + description.encode(), f'{job}/rewritten_input.txt')
+
+
+def test_harvest_reads_stored_inputs_per_provider():
+    storage = MemoryStorage()
+    _store_job(storage, 'aws-1', 'web app', CODE)
+    _store_job(storage, 'gcp-2', 'data pipeline')
+    _store_job(storage, 'unknown-3', 'something')
+    storage.put_bytes(b'{}', 'idempotency/abc.json')
+
+    items = replay.harvest(storage)
+    assert sorted((i['provider'], i['description']) for i in items) == [('aws', 'web app'), ('gcp', 'data pipeline')]
+    # Fake-LLM replays need the stored code
+    fake_items = replay.harvest(storage, fake_llm=True)
+    assert [i['job'] for i in fake_items] == ['aws-1']
+    body = replay.build_request(fake_items[0], fake_llm=True)
+    assert body['fake_llm']['code'] == CODE
+    assert body['fake_llm']['rewrite'] == 'rewritten web app'
+
+
+def test_provider_mix():
+    items = [{'provider': 'aws'}, {'provider': 'gcp'}]
+    assert replay.parse_mix('aws=3, gcp') == {'aws': 3.0, 'gcp': 1.0}
+    with pytest.raises(ValueError):
+        replay.parse_mix('ibm=1')
+    corpus = replay.Corpus(items, {'aws': 1, 'gcp': 0})
+    rng = random.Random(1)
+    assert {corpus.pick(rng)['provider'] for _ in range(20)} == {'aws'}
+    with pytest.raises(ValueError):
+        replay.Corpus(items, {'azure': 1})
+
+
+def test_open_loop_step_counts_queueing_and_errors():
+    corpus = replay.Corpus([{'provider': 'aws', 'description': 'web app'}])
+
+    calls = []
+
+    def send(target, body, timeout):
+        calls.append(body)
+        time.sleep(0.05)
+        if len(calls) % 2:
+            return {'status': 504, 'timings': {}, 'error': replay.error_class(504, {'error': 'Deadline reached.'})}
+        return {'status': 200, 'timings': {'llm': 0.01, 'total': 0.05}, 'error': None}
+
+    step = replay.run_step(corpus, 'http://target', rate=60, duration=0.25, concurrency=1,
+                           rng=random.Random(7), send=send)
+    assert step['requests'] > 5
+    # One worker serves 20 req/s: later arrivals wait, and the wait counts towards latency
+    assert step['queue']['p90'] > 0.05
+    assert step['latency']['p50'] >= 0.05
+    assert set(step['errors']) <= {'504 deadline reached'}
+    assert 'llm' in step['stages']
+    assert replay.throughput_ceiling([step]) is None
+    assert replay.throughput_ceiling([dict(step, error_rate=0, throughput=95)]) == 95
+
+
+def test_fake_llm_answers_with_canned_text(monkeypatch):
+    monkeypatch.setattr(fake_llm, 'FAKE_LLM', True)
+    token = fake_llm.activate({'fake_llm': {'code': f'```python\n{CODE}\n```', 'rewrite': 'rewritten'}})
+    span, span_token = tracing.start_root_span('http.request')
+    try:
+        with tracing.span('codegen'):
+            assert generate_code_openai('web app', 'instructions') == CODE
+        with tracing.span('rewrite'):
+            assert generate_rewrite_openai('web app', 'instructions') == 'rewritten'
+    finally:
+        tracing.end_root_span(span, span_token)
+        fake_llm.deactivate(token)
+    monkeypatch.setattr(fake_llm, 'FAKE_LLM', False)
+    assert fake_llm.activate({'fake_llm': {'code': CODE}}) is None
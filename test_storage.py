@@ -0,0 +1,81 @@
+import os
+from storage import LocalStorage, MemoryStorage, create_storage
+
+
+def test_local_storage_moves_files(tmp_path):
+    store = LocalStorage(str(tmp_path / 'artifacts'))
+    src = tmp_path / 'generated_diagram.png'
+    src.write_bytes(b'png')
+    store.put_file(str(src), 'aws-1/generated_diagram.png')
+    assert not src.exists()
+    assert store.get_bytes('aws-1/generated_diagram.png') == b'png'
+    assert store.url('aws-1/generated_diagram.png') == '/artifacts/aws-1/generated_diagram.png'
+    assert store.list_keys('aws-1/') == ['aws-1/generated_diagram.png']
+
+
+def test_local_storage_rejects_escaping_keys(tmp_path):
+    store = LocalStorage(str(tmp_path / 'artifacts'))
+    assert store.local_path('../outside.txt') is None
+    assert store.get_bytes('../outside.txt') is None
+
+
+def test_memory_storage_roundtrip(tmp_path):
+    store = MemoryStorage()
+    src = tmp_path / 'generated_diagram.md'
+    src.write_text('- explanation')
+    store.put_file(str(src), 'gcp-1/generated_diagram.md')
+    store.put_bytes(b'{}', 'gcp-1/response.json')
+    assert store.get_bytes('gcp-1/generated_diagram.md') == b'- explanation'
+    assert store.get_bytes('missing') is None
+    assert store.list_keys('gcp-1/') == ['gcp-1/generated_diagram.md', 'gcp-1/response.json']
+    assert store.local_path('gcp-1/response.json') is None
+
+
+def test_create_storage_requires_bucket_for_s3(monkeypatch):
+    monkeypatch.delenv('S3_BUCKET', raising=False)
+    try:
+        create_storage('s3')
+    except RuntimeError as e:
+        assert 'S3_BUCKET' in str(e)
+    else:
+        assert False, 'expected RuntimeError'
+
+
+def test_put_bytes_if_absent_and_delete(tmp_path):
+    for store in (LocalStorage(str(tmp_path / 'artifacts')), MemoryStorage()):
+        assert store.put_bytes_if_absent(b'first', 'idempotency/k.json')
+        assert not store.put_bytes_if_absent(b'second', 'idempotency/k.json')
+        assert store.get_bytes('idempotency/k.json') == b'first'
+        store.delete('idempotency/k.json')
+        store.delete('idempotency/k.json')
+        assert store.get_bytes('idempotency/k.json') is None
+
+
+JOB = 'aws-00000000-0000-4000-8000-00000000000{}'
+
+
+def test_local_storage_evicts_oldest_folders_beyond_quota(tmp_path):
+    store = LocalStorage(str(tmp_path / 'artifacts'), quota_bytes=250)
+    store.put_bytes(b'a' * 100, f'{JOB.format(1)}/generated_diagram.png')
+    os.utime(os.path.join(store.root, JOB.format(1)), (1, 1))
+    store.put_bytes(b'b' * 100, f'{JOB.format(2)}/generated_diagram.png')
+    store.put_bytes(b'b' * 40, f'{JOB.format(2)}/generated_diagram.png')  # overwrite frees 60 bytes
+    store.put_bytes(b'c' * 100, f'{JOB.format(3)}/generated_diagram.png')
+    assert len(store.list_keys()) == 3
+    store.put_bytes(b'd' * 100, f'{JOB.format(4)}/generated_diagram.png')
+    assert store.get_bytes(f'{JOB.format(1)}/generated_diagram.png') is None
+    assert store.get_bytes(f'{JOB.format(4)}/generated_diagram.png') == b'd' * 100
+    assert store.list_keys(JOB.format(2)) == [f'{JOB.format(2)}/generated_diagram.png']
+
+
+def test_local_storage_quota_keeps_records_and_evicts_explanations_per_key(tmp_path):
+    store = LocalStorage(str(tmp_path / 'artifacts'), quota_bytes=250)
+    assert store.put_bytes_if_absent(b'i' * 60, 'idempotency/k.json')
+    store.put_bytes(b'e' * 60, 'explanations/old/aws.md')
+    os.utime(os.path.join(store.root, 'explanations', 'old', 'aws.md'), (1, 1))
+    store.put_bytes(b'e' * 60, 'explanations/new/aws.md')
+    store.put_bytes(b'j' * 100, f'{JOB.format(1)}/generated_diagram.png')
+    assert store.get_bytes('idempotency/k.json') == b'i' * 60
+    assert store.get_bytes('explanations/old/aws.md') is None
+    assert not os.path.exists(os.path.join(store.root, 'explanations', 'old'))
+    assert store.get_bytes('explanations/new/aws.md') == b'e' * 60
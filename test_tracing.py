@@ -0,0 +1,51 @@
+import json
+import tracing
+
+
+def test_traceparent_is_propagated():
+    headers = {'traceparent': '00-' + 'a' * 32 + '-' + 'b' * 16 + '-01'}
+    trace_id, parent_id, sampled = tracing.parse_trace_headers(headers)
+    assert trace_id == 'a' * 32
+    assert parent_id == 'b' * 16
+    assert sampled
+
+
+def test_spans_nest_and_export(tmp_path, monkeypatch):
+    trace_file = tmp_path / 'traces.jsonl'
+    monkeypatch.setattr(tracing, 'TRACE_EXPORTER', 'file')
+    monkeypatch.setattr(tracing, 'TRACE_FILE', str(trace_file))
+    root, token = tracing.start_root_span('http.request', {'X-Trace-Id': 'c' * 32})
+    with tracing.span('codegen', provider='aws') as stage:
+        tracing.set_attribute('llm.prompt_tokens', 12)
+        with tracing.span('llm.chat'):
+            pass
+    tracing.end_root_span(root, token)
+    tracing.flush()
+
+    payload = json.loads(trace_file.read_text().splitlines()[-1])
+    spans = {s['name']: s for s in payload['resourceSpans'][0]['scopeSpans'][0]['spans']}
+    assert set(spans) == {'http.request', 'codegen', 'llm.chat'}
+    assert all(s['traceId'] == 'c' * 32 for s in spans.values())
+    assert spans['codegen']['parentSpanId'] == root.span_id
+    assert spans['llm.chat']['parentSpanId'] == stage.span_id
+    attrs = {a['key']: a['value'] for a in spans['codegen']['attributes']}
+    assert attrs['llm.prompt_tokens'] == {'intValue': '12'}
+
+
+def test_malformed_trace_ids_are_replaced():
+    for headers in (
+        {'traceparent': '00-' + 'A' * 32 + '-' + 'b' * 16 + '-01'},
+        {'traceparent': '00-' + 'a' * 32 + '-' + '<script>' * 2 + '-01'},
+        {'traceparent': '00-' + '0' * 32 + '-' + 'b' * 16 + '-01'},
+        {'X-Trace-Id': 'z' * 32},
+        {'X-Trace-Id': 'c' * 31 + '\n'},
+    ):
+        trace_id, parent_id, _ = tracing.parse_trace_headers(headers)
+        assert parent_id is None
+        assert trace_id not in ('A' * 32, 'a' * 32, '0' * 32, 'z' * 32)
+        assert len(trace_id) == 32 and int(trace_id, 16) >= 0
+
+
+def test_span_outside_trace_is_noop():
+    with tracing.span('orphan') as s:
+        assert s is None
@@ -0,0 +1,66 @@
+import os
+import subprocess
+import warmup
+from storage import MemoryStorage
+from workspace import WorkspaceManager
+
+
+def test_warmup_reports_each_step(tmp_path, monkeypatch):
+    rendered = []
+
+    def fake_render(folder, timeout=60, layout='auto'):
+        with open(os.path.join(folder, 'generated_diagram.py')) as f:
+            rendered.append(f.read())
+        return subprocess.CompletedProcess([], 0, '', '')
+
+    monkeypatch.setattr(warmup, 'render_diagram', fake_render)
+    monkeypatch.delenv('OPENAI_API_KEY', raising=False)
+    workspace = WorkspaceManager(str(tmp_path), retain=True)
+
+    report = warmup.run(workspace, MemoryStorage(), providers=['aws', 'gcp', 'unknown'])
+    assert report['steps']['render.aws']['status'] == 'ok'
+    assert report['steps']['imports.gcp']['status'] == 'ok'
+    assert report['steps']['storage']['status'] == 'skipped'
+    assert report['steps']['openai']['status'] == 'skipped'
+    assert 'render.unknown' not in report['steps']
+    assert 'from diagrams.aws.compute import EC2' in rendered[0]
+    assert os.listdir(str(tmp_path)) == []  # warm-up workspaces are never retained
+    assert warmup.last_report is report
+
+
+def test_local_only_warmup_renders_once_without_network(tmp_path, monkeypatch):
+    class NoNetworkStorage(MemoryStorage):
+        def warm(self):
+            raise AssertionError('storage must not be warmed during init')
+
+    def no_openai():
+        raise AssertionError('OpenAI must not be warmed during init')
+
+    monkeypatch.setattr(warmup, 'render_diagram',
+                        lambda folder, timeout=60, layout='auto': subprocess.CompletedProcess([], 0, '', ''))
+    monkeypatch.setattr(warmup, '_warm_openai', no_openai)
+    report = warmup.run(WorkspaceManager(str(tmp_path)), NoNetworkStorage(), providers=['aws', 'gcp'], local_only=True)
+    assert [name for name in report['steps'] if name.startswith('render.')] == ['render.aws']
+    assert 'storage' not in report['steps'] and 'openai' not in report['steps']
+    assert report['steps']['imports.gcp']['status'] == 'ok'
+
+
+def test_read_providers_accepts_only_known_names():
+    assert warmup.read_providers({}) == (None, None)
+    assert warmup.read_providers({'providers': ['aws', 'gcp']}) == (['aws', 'gcp'], None)
+    for bad in ('aws', [], ['aws', 'oracle'], [1], {'aws': True}):
+        assert warmup.read_providers({'providers': bad})[1][1] == 400
+
+
+def test_warmup_render_failure_is_reported(tmp_path, monkeypatch):
+    monkeypatch.setattr(warmup, 'render_diagram',
+                        lambda folder, timeout=60, layout='auto': subprocess.CompletedProcess([], 1, '', 'dot: not found'))
+    report = warmup.run(WorkspaceManager(str(tmp_path)), MemoryStorage(), providers=['aws'])
+    assert report['steps']['render.aws'] == {'status': 'error', 'error': 'dot: not found',
+                                             'seconds': report['steps']['render.aws']['seconds']}
+    assert 'render.aws' not in report['warmed']
+
+
+def test_warmup_skips_when_already_running(tmp_path):
+    with warmup._lock:
+        assert warmup.run(WorkspaceManager(str(tmp_path)), MemoryStorage()) is None
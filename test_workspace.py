@@ -0,0 +1,51 @@
+import os
+import time
+from workspace import WorkspaceManager
+
+
+def _fill(path, name, size):
+    with open(os.path.join(path, name), 'wb') as f:
+        f.write(b'x' * size)
+
+
+def test_allocate_and_release_deletes(tmp_path):
+    manager = WorkspaceManager(str(tmp_path), retain=False)
+    name, path = manager.allocate('aws')
+    assert name.startswith('aws-')
+    assert os.path.isdir(path)
+    assert manager.usage()['active_workspaces'] == 1
+    manager.release(path)
+    assert not os.path.exists(path)
+    assert manager.usage()['active_workspaces'] == 0
+
+
+def test_quota_evicts_least_recently_used(tmp_path):
+    manager = WorkspaceManager(str(tmp_path), quota_bytes=250, retain=True, sweep_interval=3600)
+    paths = []
+    for _ in range(3):
+        _, path = manager.allocate('gcp')
+        _fill(path, 'diagram.png', 100)
+        manager.release(path)
+        paths.append(path)
+        time.sleep(0.01)
+    # The first workspace is accessed again, so the second is now least recently used
+    manager.touch(os.path.join(paths[0], 'diagram.png'))
+    usage = manager.sweep()
+    assert usage <= 250
+    assert os.path.exists(paths[0])
+    assert not os.path.exists(paths[1])
+    assert os.path.exists(paths[2])
+    stats = manager.usage()
+    assert stats['used_bytes'] == usage and stats['retained_workspaces'] == 2
+    assert 'root' not in stats
+
+
+def test_active_workspaces_are_never_evicted(tmp_path):
+    manager = WorkspaceManager(str(tmp_path), quota_bytes=10, max_age=0, retain=True)
+    _, path = manager.allocate('azure')
+    _fill(path, 'diagram.svg', 100)
+    manager.sweep()
+    assert os.path.exists(path)
+    manager.release(path)
+    manager.sweep()
+    assert not os.path.exists(path)
@@ -0,0 +1,250 @@
+import os
+import re
+import json
+import time
+import queue
+import random
+import logging
+import secrets
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# ===================
+# Configuration
+# ===================
+# TRACE_EXPORTER: "off" (default), "file" (OTLP/JSON lines in TRACE_FILE) or "otlp" (HTTP collector)
+# TRACE_SAMPLE_RATE: fraction of new traces that are exported (incoming sampled flags are honoured)
+# LOG_SAMPLE_RATE: fraction of requests whose verbose debug logs are emitted
+TRACE_EXPORTER = os.environ.get('TRACE_EXPORTER', 'off').lower()
+# The working directory is read-only on Lambda; /tmp is the only writable path there
+TRACE_FILE = os.environ.get('TRACE_FILE') or (
+    '/tmp/traces.jsonl' if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') else 'traces.jsonl'
+)
+TRACE_OTLP_ENDPOINT = os.environ.get('TRACE_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '1.0'))
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '0.01'))
+SERVICE_NAME = os.environ.get('TRACE_SERVICE_NAME', 'diagram-ai')
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id=None, sampled=True, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+        self._root = self
+        self._children = []  # finished descendants, exported with the root span
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def add_to_attribute(self, key, value):
+        """Accumulate a numeric attribute, e.g. token counts over several LLM calls"""
+        self.attributes[key] = self.attributes.get(key, 0) + value
+
+    @property
+    def duration(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+    def to_otlp(self):
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': 1,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns or time.time_ns()),
+            'attributes': [_otlp_attribute(k, v) for k, v in self.attributes.items()],
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 1},
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+
+def _otlp_attribute(key, value):
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    if isinstance(value, float):
+        return {'key': key, 'value': {'doubleValue': value}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+
+# ===================
+# Trace context
+# ===================
+_TRACE_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+_SPAN_ID_RE = re.compile(r'^[0-9a-f]{16}$')
+
+
+def _valid_id(value, pattern):
+    # All-zero ids are invalid in W3C trace context
+    return bool(pattern.match(value)) and value.strip('0') != ''
+
+
+def parse_trace_headers(headers):
+    """Return (trace_id, parent_span_id, sampled) from W3C traceparent or X-Trace-Id headers.
+
+    Ids are echoed in responses and exported, so anything but lowercase hex of the right
+    length is ignored and a fresh trace id is minted instead.
+    """
+    traceparent = headers.get('traceparent') or headers.get('Traceparent')
+    if traceparent:
+        parts = traceparent.strip().split('-')
+        if len(parts) == 4 and _valid_id(parts[1], _TRACE_ID_RE) and _valid_id(parts[2], _SPAN_ID_RE):
+            return parts[1], parts[2], parts[3] == '01'
+    trace_id = (headers.get('X-Trace-Id') or headers.get('x-trace-id') or '').strip()
+    if _valid_id(trace_id, _TRACE_ID_RE):
+        return trace_id, None, random.random() < TRACE_SAMPLE_RATE
+    return secrets.token_hex(16), None, random.random() < TRACE_SAMPLE_RATE
+
+
+def current_span():
+    return _current_span.get()
+
+
+def current_trace_id():
+    span = _current_span.get()
+    return span.trace_id if span else None
+
+
+def set_attribute(key, value):
+    span = _current_span.get()
+    if span is not None:
+        span.set_attribute(key, value)
+
+
+def add_to_attribute(key, value):
+    span = _current_span.get()
+    if span is not None:
+        span.add_to_attribute(key, value)
+
+
+def start_root_span(name, headers=None, **attributes):
+    """Start a request's root span and make it current. Returns (span, token) for end_root_span."""
+    trace_id, parent_id, sampled = parse_trace_headers(headers or {})
+    span = Span(name, trace_id, parent_id=parent_id, sampled=sampled, attributes=attributes)
+    return span, _current_span.set(span)
+
+
+def end_root_span(span, token, error=None):
+    span.end_ns = time.time_ns()
+    if error is not None:
+        span.error = str(error)
+    try:
+        _current_span.reset(token)
+    except ValueError:
+        _current_span.set(None)  # reset from a different context (e.g. Flask teardown)
+    if span.sampled:
+        _exporter.submit([span] + span._children)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Time a stage as a child of the current span. A no-op outside of a trace."""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, parent.trace_id, parent_id=parent.span_id, sampled=parent.sampled, attributes=attributes)
+    child._root = parent._root
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        child.end_ns = time.time_ns()
+        _current_span.reset(token)
+        child._root._children.append(child)
+
+
+def bind(fn):
+    """Run fn with the caller's trace context, e.g. when submitting it to a thread pool.
+
+    Each call to bind copies the context, so bind once per submission.
+    """
+    ctx = contextvars.copy_context()
+    return lambda *args, **kwargs: ctx.run(fn, *args, **kwargs)
+
+
+# ===================
+# Export
+# ===================
+class _Exporter:
+    """Exports finished traces from a background thread so requests never wait on I/O"""
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=1000)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, spans):
+        if TRACE_EXPORTER not in ('file', 'otlp'):
+            return
+        try:
+            self._queue.put_nowait(spans)
+        except queue.Full:
+            return  # drop traces rather than block requests
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='trace-exporter', daemon=True)
+                self._thread.start()
+
+    def flush(self):
+        """Block until queued traces are written (Lambda freezes background threads after return)"""
+        if self._thread is not None:
+            self._queue.join()
+
+    def _run(self):
+        while True:
+            spans = self._queue.get()
+            try:
+                self._export(spans)
+            except Exception as e:
+                print(f"Trace export failed: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+    def _export(self, spans):
+        payload = {'resourceSpans': [{
+            'resource': {'attributes': [_otlp_attribute('service.name', SERVICE_NAME)]},
+            'scopeSpans': [{'scope': {'name': SERVICE_NAME}, 'spans': [s.to_otlp() for s in spans]}]
+        }]}
+        if TRACE_EXPORTER == 'file':
+            with open(TRACE_FILE, 'a') as f:
+                f.write(json.dumps(payload) + '\n')
+        else:
+            import requests
+            requests.post(TRACE_OTLP_ENDPOINT, json=payload, timeout=2)
+
+
+_exporter = _Exporter()
+
+
+def flush():
+    _exporter.flush()
+
+
+# ===================
+# Sampled logging
+# ===================
+def log_sampled(logger, build_message, level=logging.DEBUG, rate=None):
+    """Log an expensive message only if the level is enabled and this call is sampled.
+
+    build_message is only called when the message will actually be emitted.
+    """
+    rate = LOG_SAMPLE_RATE if rate is None else rate
+    if logger.isEnabledFor(level) and random.random() < rate:
+        logger.log(level, build_message())
@@ -0,0 +1,137 @@
+# Warm-up routine for new containers and processes.
+# The first render after a deploy or scale-out pays for fontconfig cache building,
+# Graphviz plugin loading, importing the diagrams provider modules and the first S3
+# and OpenAI connections. run() does all of that up front with a tiny diagram per
+# provider, builds the node-class catalog, and reports how long each step took.
+import os
+import time
+import pkgutil
+import importlib
+import threading
+
+import llm_providers
+import node_catalog
+from pipeline import render_diagram
+
+# ===================
+# Configuration
+# ===================
+# WARMUP_ON_START: "1" runs the warm-up in a background thread when the app starts (on Lambda,
+#   only its local steps run during init; see run(local_only=True))
+# WARMUP_PROVIDERS: comma-separated providers whose tiny diagram is rendered
+WARMUP_ON_START = os.environ.get('WARMUP_ON_START', '0') == '1'
+WARMUP_PROVIDERS = [p.strip() for p in os.environ.get('WARMUP_PROVIDERS', 'aws,azure,gcp').split(',') if p.strip()]
+WARMUP_RENDER_TIMEOUT = 30
+
+# Two nodes and an edge per provider: enough to load the provider's icons, fonts and layout plugins
+WARMUP_DIAGRAMS = {
+    'aws': ('diagrams.aws.compute', 'EC2', 'diagrams.aws.database', 'RDS'),
+    'azure': ('diagrams.azure.compute', 'VM', 'diagrams.azure.database', 'SQLDatabases'),
+    'gcp': ('diagrams.gcp.compute', 'GCE', 'diagrams.gcp.database', 'SQL'),
+}
+
+_lock = threading.Lock()
+last_report = None
+
+
+def warmup_code(provider):
+    compute_module, compute, database_module, database = WARMUP_DIAGRAMS[provider]
+    return (
+        'from diagrams import Diagram\n'
+        f'from {compute_module} import {compute}\n'
+        f'from {database_module} import {database}\n'
+        'with Diagram("warmup", show=False, filename="generated_diagram", outformat=["png", "svg"]):\n'
+        f'    {compute}("app") >> {database}("db")\n'
+    )
+
+
+def import_provider_modules(provider):
+    """Import every diagrams.<provider>.* module (used for import validation and service names)"""
+    package = importlib.import_module(f'diagrams.{provider}')
+    count = 0
+    for module in pkgutil.iter_modules(package.__path__):
+        importlib.import_module(f'diagrams.{provider}.{module.name}')
+        count += 1
+    return count
+
+
+def _step(steps, name, fn):
+    start = time.time()
+    try:
+        result = fn()
+        steps[name] = {'status': 'ok' if result is not False else 'skipped'}
+    except Exception as e:
+        steps[name] = {'status': 'error', 'error': str(e)}
+    steps[name]['seconds'] = round(time.time() - start, 4)
+
+
+def _render(workspace, provider):
+    name, folder = workspace.allocate(f'warmup-{provider}')
+    try:
+        with open(os.path.join(folder, 'generated_diagram.py'), 'w') as f:
+            f.write(warmup_code(provider))
+        proc = render_diagram(folder, WARMUP_RENDER_TIMEOUT)
+        if proc.returncode != 0:
+            raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else 'render failed')
+    finally:
+        workspace.release(folder, retain=False)
+
+
+def _warm_openai():
+    try:
+        llm_providers._get_api_key()
+    except ValueError:
+        return False  # no key configured: nothing to connect to
+    llm_providers.warm_client()
+
+
+def read_providers(data):
+    """Return (providers, error) for the optional providers field of /warmup, error as (message, status)"""
+    providers = (data or {}).get('providers')
+    if providers is None:
+        return None, None
+    if (not isinstance(providers, list) or not providers
+            or not all(isinstance(p, str) and p in WARMUP_DIAGRAMS for p in providers)):
+        return None, (f"providers must be a non-empty list of: {', '.join(WARMUP_DIAGRAMS)}.", 400)
+    return providers, None
+
+
+def run(workspace, storage, providers=None, local_only=False):
+    """Warm this process. Returns a report of each step's status and duration, or None if one is already running.
+
+    local_only keeps to what cannot stall on the network or take long: provider imports, the
+    catalog and a single render. Lambda's init phase runs this; its ~10s limit would turn a
+    slow S3 or OpenAI endpoint into a failed cold start. The scheduled ping does the rest.
+    """
+    global last_report
+    if not _lock.acquire(blocking=False):
+        return None
+    try:
+        start = time.time()
+        steps = {}
+        providers = [p for p in (providers or WARMUP_PROVIDERS) if p in WARMUP_DIAGRAMS]
+        for provider in providers:
+            _step(steps, f'imports.{provider}', lambda: import_provider_modules(provider))
+        for provider in (providers[:1] if local_only else providers):
+            _step(steps, f'render.{provider}', lambda: _render(workspace, provider))
+        _step(steps, 'catalog', lambda: node_catalog.get_catalog() is not None)
+        if not local_only:
+            _step(steps, 'storage', storage.warm)
+            _step(steps, 'openai', _warm_openai)
+        last_report = {
+            'warmed': [name for name, step in steps.items() if step['status'] == 'ok'],
+            'steps': steps,
+            'total': round(time.time() - start, 4),
+            'finished_at': time.time(),
+        }
+        print(f"Warm-up finished in {last_report['total']}s: {', '.join(last_report['warmed']) or 'nothing'}")
+        return last_report
+    finally:
+        _lock.release()
+
+
+def start_background(workspace, storage):
+    """Run the warm-up in a daemon thread so startup is not delayed"""
+    thread = threading.Thread(target=run, args=(workspace, storage), name='warmup', daemon=True)
+    thread.start()
+    return thread
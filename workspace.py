@@ -0,0 +1,176 @@
+import os
+import time
+import uuid
+import shutil
+import threading
+
+# ===================
+# Configuration
+# ===================
+# Lambda containers are reused while warm and /tmp persists between invocations,
+# so the quota must stay well below the 512 MB ephemeral storage limit.
+IS_LAMBDA = os.environ.get('AWS_LAMBDA_FUNCTION_NAME') is not None
+WORKSPACE_QUOTA_BYTES = int(os.environ.get(
+    'WORKSPACE_QUOTA_BYTES', str((256 if IS_LAMBDA else 1024) * 1024 * 1024)
+))
+# Retained workspaces older than this many seconds are removed by the sweeper
+WORKSPACE_MAX_AGE = int(os.environ.get('WORKSPACE_MAX_AGE', '3600'))
+WORKSPACE_SWEEP_INTERVAL = int(os.environ.get('WORKSPACE_SWEEP_INTERVAL', '60'))
+# Keep artifacts on disk after upload so /diagrams/<filename> can serve them.
+# On Lambda everything is already in S3, so delete them by default.
+WORKSPACE_RETAIN = os.environ.get('WORKSPACE_RETAIN', '0' if IS_LAMBDA else '1') == '1'
+
+
+def _dir_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for fname in files:
+            try:
+                total += os.path.getsize(os.path.join(root, fname))
+            except OSError:
+                pass  # file removed while walking
+    return total
+
+
+class WorkspaceManager:
+    """Allocates per-request directories under a root and keeps the root within a byte quota.
+
+    Active workspaces are never touched. Released workspaces are either deleted
+    immediately or retained, in which case they are evicted least-recently-used
+    first when the quota is exceeded and removed once older than max_age.
+    """
+
+    def __init__(self, root, quota_bytes=WORKSPACE_QUOTA_BYTES, max_age=WORKSPACE_MAX_AGE,
+                 sweep_interval=WORKSPACE_SWEEP_INTERVAL, retain=WORKSPACE_RETAIN):
+        self.root = os.path.abspath(root)
+        self.quota_bytes = quota_bytes
+        self.max_age = max_age
+        self.sweep_interval = sweep_interval
+        self.retain = retain
+        self._active = set()
+        self._last_used = {}  # workspace name -> last access time
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+        self._evicted = 0
+        self._used_bytes = 0  # measured by the last sweep
+        self._sweeper = None
+        self._stop = threading.Event()
+
+    # --- Lifecycle of a single workspace ---
+    def allocate(self, prefix):
+        """Create a new `<prefix>-<uuid>` workspace. Returns (name, path)."""
+        self.maybe_sweep()
+        name = f"{prefix}-{uuid.uuid4()}"
+        path = os.path.join(self.root, name)
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            self._active.add(name)
+            self._last_used[name] = time.time()
+        return name, path
+
+    def release(self, path, retain=None):
+        """Mark a workspace as finished: delete it, or keep it for serving until evicted"""
+        name = os.path.basename(os.path.normpath(path))
+        retain = self.retain if retain is None else retain
+        with self._lock:
+            self._active.discard(name)
+            if retain:
+                self._last_used[name] = time.time()
+            else:
+                self._last_used.pop(name, None)
+        if not retain:
+            shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+        else:
+            self.maybe_sweep()
+
+    def touch(self, path):
+        """Record an access to a file inside a retained workspace (for LRU ordering)"""
+        rel = os.path.relpath(os.path.abspath(path), self.root)
+        name = rel.split(os.sep)[0]
+        if name and name not in ('.', '..'):
+            with self._lock:
+                if name in self._last_used:
+                    self._last_used[name] = time.time()
+
+    # --- Quota and age enforcement ---
+    def _retained(self):
+        """List (last_used, name, path) for every workspace directory that is not in use"""
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        with self._lock:
+            active = set(self._active)
+            last_used = dict(self._last_used)
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name in active or not os.path.isdir(path):
+                continue
+            try:
+                used = last_used.get(name, os.path.getmtime(path))
+            except OSError:
+                continue
+            entries.append((used, name, path))
+        return sorted(entries)
+
+    def _remove(self, name, path):
+        shutil.rmtree(path, ignore_errors=True)
+        with self._lock:
+            self._last_used.pop(name, None)
+            self._evicted += 1
+
+    def sweep(self):
+        """Remove expired workspaces, then evict LRU retained ones until under quota"""
+        self._last_sweep = time.time()
+        now = time.time()
+        usage = _dir_size(self.root) if os.path.isdir(self.root) else 0
+        entries = self._retained()
+        for used, name, path in entries:
+            expired = now - used > self.max_age
+            if not expired and usage <= self.quota_bytes:
+                break  # entries are oldest first, so nothing further qualifies
+            size = _dir_size(path)
+            self._remove(name, path)
+            usage -= size
+        with self._lock:
+            self._used_bytes = usage
+            # Workspaces left by an earlier process are tracked from here on
+            for used, name, path in entries:
+                if os.path.isdir(path):
+                    self._last_used.setdefault(name, used)
+        return usage
+
+    def maybe_sweep(self):
+        # Lambda freezes background threads between invocations, so sweeping is
+        # also driven from the request path, rate limited by sweep_interval
+        if time.time() - self._last_sweep >= self.sweep_interval:
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Workspace sweep failed: {str(e)}")
+
+    def start_sweeper(self):
+        """Start the periodic background sweeper thread (idempotent)"""
+        if self._sweeper is not None:
+            return
+
+        def _run():
+            while not self._stop.wait(self.sweep_interval):
+                self.maybe_sweep()
+
+        self._sweeper = threading.Thread(target=_run, name='workspace-sweeper', daemon=True)
+        self._sweeper.start()
+
+    def stop_sweeper(self):
+        self._stop.set()
+
+    def usage(self):
+        """Tracked counters; bytes are as measured by the last sweep, so this never walks the tree"""
+        with self._lock:
+            return {
+                'used_bytes': self._used_bytes,
+                'quota_bytes': self.quota_bytes,
+                'active_workspaces': len(self._active),
+                'retained_workspaces': len(self._last_used.keys() - self._active),
+                'evicted_workspaces': self._evicted,
+                'last_sweep': self._last_sweep,
+            }